@@ -0,0 +1,226 @@
+'''Measures the latency of whole conversation turns, with every external part replaced by a local fake (see fakes.py).
+
+The real run_conversation loop runs in voice mode with a remote microphone and speaker on the in-process MQTT broker,
+the LLM is an OpenAI-compatible server on localhost with a canned answer, and STT/TTS are engines with a
+configurable compute time. The database is a temporary one. For every history length, a conversation with that many
+turns is created and resumed, then --turns turns are measured. Reported per stage and per turn (p50/p95):
+  response latency: from the transcribed input reaching the conversation loop to the first audio at the speaker
+  turn: time between two consecutive inputs reaching the conversation loop
+Run from the repository root: python benchmarks/e2e_benchmark.py [--history 1 50 200] [--turns 20] [--json results.json]'''
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lachsbuddy"))
+
+import config
+
+
+class StageTimer():
+    '''Collects durations per stage name. Stages may run on any thread.'''
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.samples[stage].append(seconds)
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return timed
+
+    def reset(self):
+        with self.lock:
+            samples = dict(self.samples)
+            self.samples = defaultdict(list)
+        return samples
+
+
+def configure(args):
+    '''Sets the config before the program modules are imported, as their defaults are read at import time.'''
+    config.INPUT_MODE = "voice"
+    config.MQTT_MIC = True
+    config.MQTT_SPEAKER = True
+    config.MQTT_BINARY_AUDIO = True
+    config.MQTT_STREAMING = not args.no_mqtt_streaming
+    config.MIC_ALWAYS_ON = False
+    config.CONFIRM_SEND = False
+    config.PLAY_SOUND = True
+    config.PIPELINE_MODE = not args.no_pipeline
+    config.LLM_STREAMING = not args.no_llm_streaming
+    config.TTS_STREAMING = not args.no_tts_streaming
+    config.LLM_NAME = "local-openai"
+    config.MEMORY_ENABLED = False
+    config.HOTWORD_SPOTTER = False
+    config.RESUME_CONVERSATION = None
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else float("nan")
+
+
+def populate_conversation(database, steps, output_dict):
+    '''Creates a conversation with the given number of turns and returns its id.'''
+    _, _, listening_mode, conversation_id = database.start_new_conversation()
+    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    for step in range(steps):
+        database.insert_conversation(conversation_id, step, timestamp, config.LLM_NAME, "", "", "What should I cook tonight?",
+                                     "", output_dict, "", listening_mode)
+    database.database_writer.flush()
+    return conversation_id
+
+
+def run_benchmark(args):
+    import fakes
+    from mqtt_transport import LoopbackBroker, MQTTTransport
+    import mqtt_transport
+    import llm
+    import stt
+    import tts
+    import audio
+    import database
+    import history
+    import processing
+
+    timer = StageTimer()
+
+    # external parts
+    server = fakes.CannedLLMServer(first_token_delay=args.llm_first_token, chunk_delay=args.llm_chunk_delay)
+    broker = LoopbackBroker()
+    wav_path = os.path.join(os.getcwd(), "utterance.wav")
+    fakes.write_test_wav(wav_path, seconds=args.utterance_seconds)
+    fakes.WavMicrophone(broker, wav_path, recording_delay=args.recording_delay)
+
+    # the first audio of a turn is taken when the speaker receives it
+    turn_starts = []
+    response_latencies = []
+    speaker = fakes.NullSpeaker(broker, realtime=args.realtime_playback,
+                                on_first_audio=lambda: response_latencies.append(time.perf_counter() - turn_starts[-1]))
+
+    mqtt_transport.mqtt_transport = MQTTTransport(client=broker.client()).connect()
+    llm.llm_backend = llm.LLMBackend(api_key="benchmark", base_url=server.url)
+    tts_engine = fakes.FakeTTSEngine(real_time_factor=args.tts_rtf)
+    tts_engine.synthesize = timer.wrap("tts", tts_engine.synthesize)
+    tts.tts_engine = tts_engine
+    audio.play_effect = database.play_effect = lambda file: None
+
+    # stages of a turn, looked up by run_conversation at call time
+    for name in ["get_current_turns", "baseline_prompt", "get_llm_response", "parse_output", "insert_conversation"]:
+        setattr(processing, name, timer.wrap(name, getattr(processing, name)))
+    history.HistoryManager.render = timer.wrap("history render", history.HistoryManager.render)
+    processing.get_human_input = timer.wrap("get_human_input", processing.get_human_input)
+    processing.input_mode = "voice"
+
+    # the time an input reaches the conversation loop, in and out of the pipeline
+    input_times = []
+
+    def record_input(get):
+        def recorded(*args, **kwargs):
+            human_input = get(*args, **kwargs)
+            input_times.append(time.perf_counter())
+            if config.ENDWORD not in human_input[0].lower():
+                turn_starts.append(input_times[-1])
+                speaker.mark()
+            return human_input
+        return recorded
+
+    if config.PIPELINE_MODE:
+        processing.InputStage.get = record_input(processing.InputStage.get)
+    else:
+        processing.get_human_input = record_input(processing.get_human_input)
+
+    database.connect_to_database()
+    output_dict = processing.parse_structured_output(server.output + "}", tuple(config.VALID_VARIABLE_KEYS))
+
+    results = {}
+    for history_length in args.history:
+        conversation_id = populate_conversation(database, history_length, output_dict)
+        config.RESUME_CONVERSATION = conversation_id
+
+        transcripts = ["What should I cook tonight?"] * args.turns + [f"{config.ENDWORD} for now."]
+        stt_engine = fakes.FakeSTTEngine(transcripts, real_time_factor=args.stt_rtf)
+        stt_engine.transcribe = timer.wrap("stt", stt_engine.transcribe)
+        stt.stt_engines[(config.STT_MODEL_TYPE, config.STT_MODEL)] = stt_engine
+
+        timer.reset()
+        input_times.clear()
+        turn_starts.clear()
+        response_latencies.clear()
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else output):
+            start = time.perf_counter()
+            processing.run_conversation()
+            elapsed = time.perf_counter() - start
+
+        samples = timer.reset()
+        samples["response latency"] = list(response_latencies)
+        samples["turn"] = list(np.diff(input_times))
+        results[history_length] = {stage: {"p50": percentile(values, 50), "p95": percentile(values, 95), "n": len(values)}
+                                   for stage, values in samples.items()}
+        results[history_length]["total"] = {"seconds": elapsed, "turns": args.turns}
+
+    server.close()
+    return results
+
+
+def print_results(results):
+    for history_length, stages in results.items():
+        total = stages["total"]
+        print(f"\nhistory {history_length} turns: {total['turns']} turns in {total['seconds']:.2f} s")
+        print(f"  {'stage':<22}{'p50 ms':>10}{'p95 ms':>10}{'n':>6}")
+        for stage, values in stages.items():
+            if stage != "total":
+                print(f"  {stage:<22}{values['p50'] * 1000:>10.2f}{values['p95'] * 1000:>10.2f}{values['n']:>6}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--history", type=int, nargs="+", default=[1, 50, 200], help="history lengths in turns")
+    parser.add_argument("--turns", type=int, default=20, help="measured turns per history length")
+    parser.add_argument("--utterance-seconds", type=float, default=2.0, help="length of the recorded utterance")
+    parser.add_argument("--recording-delay", type=float, default=0.0, help="seconds until the microphone answers")
+    parser.add_argument("--stt-rtf", type=float, default=0.0, help="STT compute seconds per second of audio")
+    parser.add_argument("--tts-rtf", type=float, default=0.0, help="TTS compute seconds per second of audio")
+    parser.add_argument("--llm-first-token", type=float, default=0.0, help="seconds until the first LLM token")
+    parser.add_argument("--llm-chunk-delay", type=float, default=0.0, help="seconds between streamed LLM chunks")
+    parser.add_argument("--realtime-playback", action="store_true", help="confirm playback only after the audio's length")
+    parser.add_argument("--no-pipeline", action="store_true", help="disable config.PIPELINE_MODE")
+    parser.add_argument("--no-llm-streaming", action="store_true", help="disable config.LLM_STREAMING")
+    parser.add_argument("--no-tts-streaming", action="store_true", help="disable config.TTS_STREAMING")
+    parser.add_argument("--no-mqtt-streaming", action="store_true", help="disable config.MQTT_STREAMING")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the program's output")
+    args = parser.parse_args()
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    # the database is created relative to the working directory, so a temporary one is used
+    with tempfile.TemporaryDirectory() as working_dir:
+        os.makedirs(os.path.join(working_dir, "data"))
+        os.chdir(working_dir)
+        configure(args)
+        results = run_benchmark(args)
+        os.chdir(os.path.dirname(json_path or working_dir))
+
+    print_results(results)
+    if json_path:
+        with open(json_path, "w") as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,264 @@
+'''Deterministic local stand-ins for the external parts of a conversation turn, used by the benchmarks:
+an OpenAI-compatible HTTP server with a canned answer, a remote microphone that plays a WAV file and a remote
+speaker that discards the audio (both on the in-process MQTT broker), and STT/TTS engines with a configurable
+compute time. Each fake can be given a delay, so a deployment's latencies can be modelled.'''
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import wave
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lachsbuddy"))
+
+import config
+from mqtt_transport import (ACK, ACK_TOPIC, AUDIO, AUDIO_CHUNK, AUDIO_TOPIC, COMMAND_TOPIC, END_OF_STREAM, PLAY_AUDIO,
+                            REQUEST_AUDIO, pack_message, pack_stream_message, unpack_message)
+
+
+def canned_output(response="That sounds like a great plan, tell me more about it."):
+    '''Returns a valid LLM output in the order of the prompt, cut off before the closing brace by the stopping string.'''
+    values = {key: "NA" for key in config.VALID_VARIABLE_KEYS}
+    values.update({"human_input": "What should I cook tonight?", "human_emotion": "neutral",
+                   "reaction_emotion": "happiness", "intent": "ask for advice", "action": "answer",
+                   "response": response, "entities": "dinner"})
+    from llm import output_key_order
+    body = ",\n".join(f'"{key}": {json.dumps(values[key])}' for key in output_key_order())
+    return "{\n" + body + "\n"
+
+
+class CannedLLMServer():
+    '''OpenAI-compatible server on localhost that answers every chat completion with the same output.
+    Streams the output in chunks of chunk_chars characters, after first_token_delay seconds and with
+    chunk_delay seconds between chunks. Also serves deterministic embeddings.'''
+
+    def __init__(self, output=None, first_token_delay=0.0, chunk_delay=0.0, chunk_chars=4, embedding_size=64):
+        self.output = output if output is not None else canned_output()
+        self.first_token_delay = first_token_delay
+        self.chunk_delay = chunk_delay
+        self.chunk_chars = chunk_chars
+        self.embedding_size = embedding_size
+        self.requests = 0
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                server.requests += 1
+                if self.path.endswith("/embeddings"):
+                    self._send_json(server.embeddings(request))
+                elif request.get("stream"):
+                    self._send_stream(request)
+                else:
+                    time.sleep(server.first_token_delay)
+                    self._send_json(server.completion(request))
+
+            def _send_json(self, body):
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_stream(self, request):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                time.sleep(server.first_token_delay)
+                for event in server.stream_events(request):
+                    data = f"data: {event}\n\n".encode()
+                    self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+                    self.wfile.flush()
+                    time.sleep(server.chunk_delay)
+                self.wfile.write(b"0\r\n\r\n")
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+        threading.Thread(target=self.httpd.serve_forever, name="canned LLM server", daemon=True).start()
+
+    def completion(self, request):
+        return {"id": "canned", "object": "chat.completion", "created": 0, "model": request.get("model", "canned"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": self.output}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}}
+
+    def stream_events(self, request):
+        chunk = {"id": "canned", "object": "chat.completion.chunk", "created": 0, "model": request.get("model", "canned")}
+        for start in range(0, len(self.output), self.chunk_chars):
+            delta = {"content": self.output[start:start + self.chunk_chars]}
+            yield json.dumps(dict(chunk, choices=[{"index": 0, "delta": delta, "finish_reason": None}]))
+        yield json.dumps(dict(chunk, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        yield "[DONE]"
+
+    def embeddings(self, request):
+        texts = request["input"] if isinstance(request["input"], list) else [request["input"]]
+        data = []
+        for index, text in enumerate(texts):
+            seed = int.from_bytes(hashlib.sha256(str(text).encode()).digest()[:8], "little")
+            vector = np.random.default_rng(seed).standard_normal(self.embedding_size)
+            data.append({"object": "embedding", "index": index, "embedding": vector.tolist()})
+        return {"object": "list", "data": data, "model": request.get("model", "canned"),
+                "usage": {"prompt_tokens": 0, "total_tokens": 0}}
+
+    def close(self):
+        self.httpd.shutdown()
+
+
+def write_test_wav(path, seconds=2.0, sample_rate=16000):
+    '''Writes a mono 16 bit WAV file with a quiet tone, as a stand-in for a recorded utterance.'''
+    samples = 0.1 * np.sin(2 * np.pi * 220 * np.arange(int(seconds * sample_rate)) / sample_rate)
+    with wave.open(path, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes((samples * 32767).astype("<i2").tobytes())
+
+
+def read_wav(path):
+    '''Returns the first channel of a 16 bit WAV file as int16 samples and its sample rate.'''
+    with wave.open(path, "rb") as wav_file:
+        if wav_file.getsampwidth() != 2:
+            raise ValueError("Only 16 bit WAV files are supported")
+        samples = np.frombuffer(wav_file.readframes(wav_file.getnframes()), dtype="<i2")
+        return samples[::wav_file.getnchannels()].copy(), wav_file.getframerate()
+
+
+class WavMicrophone():
+    '''Remote microphone node on a LoopbackBroker. Answers every recording request with the samples of a WAV file,
+    streamed in chunks or as one message, like the real node. recording_delay simulates the time the human speaks.'''
+
+    def __init__(self, broker, wav_path, chunk_samples=4000, recording_delay=0.0):
+        self.samples, self.sample_rate = read_wav(wav_path)
+        self.chunk_samples = chunk_samples
+        self.recording_delay = recording_delay
+        self.client = broker.client()
+        self.client.on_message = self._on_message
+        self.client.subscribe(COMMAND_TOPIC)
+
+    @property
+    def seconds(self):
+        return len(self.samples) / self.sample_rate
+
+    def _on_message(self, client, userdata, message):
+        request = unpack_message(message.payload)
+        if request is None or request.message_type != REQUEST_AUDIO:
+            return
+        threading.Timer(self.recording_delay, self._send, (request.request_id, request.payload == b"\x01")).start()
+
+    def _send(self, request_id, streaming):
+        if not streaming:
+            self.client.publish(AUDIO_TOPIC, pack_message(AUDIO, request_id, self.samples.tobytes(), self.sample_rate))
+            return
+        sequence = 0
+        for start in range(0, len(self.samples), self.chunk_samples):
+            chunk = self.samples[start:start + self.chunk_samples].tobytes()
+            self.client.publish(AUDIO_TOPIC, pack_stream_message(AUDIO_CHUNK, request_id, sequence, chunk, self.sample_rate))
+            sequence += 1
+        self.client.publish(AUDIO_TOPIC, pack_stream_message(END_OF_STREAM, request_id, sequence, b"", self.sample_rate))
+
+
+class NullSpeaker():
+    '''Remote speaker node on a LoopbackBroker that discards the audio and confirms it.
+    With realtime=True, the confirmation is only sent once the audio would have finished playing.
+    on_first_audio is called whenever audio arrives after a call to mark(), e.g. to measure the time to first audio.'''
+
+    def __init__(self, broker, realtime=False, on_first_audio=None):
+        self.realtime = realtime
+        self.on_first_audio = on_first_audio
+        self.waiting_for_audio = False
+        self.seconds = {}
+        self.client = broker.client()
+        self.client.on_message = self._on_message
+        self.client.subscribe(COMMAND_TOPIC)
+
+    def mark(self):
+        self.waiting_for_audio = True
+
+    def _on_message(self, client, userdata, message):
+        request = unpack_message(message.payload)
+        if request is None or request.message_type not in (PLAY_AUDIO, AUDIO_CHUNK, END_OF_STREAM):
+            return
+
+        if request.payload and self.waiting_for_audio:
+            self.waiting_for_audio = False
+            if self.on_first_audio is not None:
+                self.on_first_audio()
+
+        if request.sample_rate:
+            self.seconds[request.request_id] = self.seconds.get(request.request_id, 0) + len(request.payload) / 2 / request.sample_rate
+        if request.message_type in (PLAY_AUDIO, END_OF_STREAM):
+            delay = self.seconds.pop(request.request_id, 0) if self.realtime else 0
+            threading.Timer(delay, self.client.publish, (ACK_TOPIC, pack_message(ACK, request.request_id, b"played"))).start()
+
+
+class NullSink():
+    '''Output sink for SpeechStream that discards the audio.'''
+
+    def write(self, audio):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeSTTEngine():
+    '''STT engine with the interface of stt.STTEngine that returns the given transcripts in turn.
+    Takes real_time_factor seconds of compute per second of audio.'''
+
+    def __init__(self, transcripts, real_time_factor=0.0):
+        self.transcripts = list(transcripts)
+        self.real_time_factor = real_time_factor
+        self.index = 0
+        self.loaded = True
+
+    def load(self):
+        return self
+
+    def warm_up(self, seconds=1):
+        return self
+
+    def transcribe(self, audio):
+        seconds = len(audio) / 16000 if isinstance(audio, np.ndarray) else len(audio.frame_data) / audio.sample_width / audio.sample_rate
+        time.sleep(seconds * self.real_time_factor)
+        transcript = self.transcripts[self.index % len(self.transcripts)]
+        self.index += 1
+        return transcript
+
+    def transcribe_batch(self, audios):
+        return [self.transcribe(audio) for audio in audios]
+
+
+class FakeTTSEngine():
+    '''TTS engine with the interface of tts.TTSEngine that returns silence of a realistic length
+    (seconds_per_char per character) and takes real_time_factor seconds of compute per second of audio.'''
+
+    def __init__(self, seconds_per_char=0.06, real_time_factor=0.0, sample_rate=24000):
+        self.seconds_per_char = seconds_per_char
+        self.real_time_factor = real_time_factor
+        self.sample_rate = sample_rate
+        self.loaded = True
+
+    def load(self):
+        return self
+
+    def warm_up(self, phrase="Hello there."):
+        return self
+
+    def synthesize(self, phrase):
+        from tts import float_to_segment
+        seconds = len(phrase) * self.seconds_per_char
+        time.sleep(seconds * self.real_time_factor)
+        return float_to_segment(np.zeros(int(seconds * self.sample_rate), dtype=np.float32), self.sample_rate)
@@ -0,0 +1,116 @@
+'''Checks and benchmarks the LLM output parser (and the text it streams) against a corpus of malformed outputs and random mutations of them.
+
+Run from the repository root: python benchmarks/parse_benchmark.py [--fuzz 5000] [--repeat 2000]'''
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lachsbuddy"))
+
+from parsing import StreamingFieldExtractor, parse_structured_output
+
+CORPUS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "parse_corpus.jsonl")
+
+
+def load_corpus(path=CORPUS_FILE):
+    with open(path) as corpus_file:
+        return [json.loads(line) for line in corpus_file if line.strip()]
+
+
+def check_corpus(corpus):
+    '''Parses every corpus entry and compares the response with the expected one. Returns the number of failures.'''
+    failures = 0
+    for entry in corpus:
+        output_dict = parse_structured_output(entry["raw"])
+        response = output_dict["response"] if output_dict is not None else None
+        if response != entry["response"]:
+            failures += 1
+            print(f"FAILED ({entry['note']}): expected {entry['response']!r}, got {response!r}")
+    print(f"corpus: {len(corpus) - failures}/{len(corpus)} entries parsed as expected")
+    return failures
+
+
+def stream_response(raw, chunk_size):
+    '''Feeds the output to a StreamingFieldExtractor in chunks of chunk_size characters and returns the streamed text.'''
+    streamed = []
+    extractor = StreamingFieldExtractor("response", on_text=streamed.append)
+    for index in range(0, len(raw), chunk_size):
+        extractor.feed(raw[index:index + chunk_size])
+    extractor.finish()
+    return "".join(streamed)
+
+
+def check_streaming(corpus, chunk_sizes=(1, 4, 16)):
+    '''Streams every corpus entry in chunks of each size and compares the streamed text with the expected response
+    (nothing for entries without one). Returns the number of failures.'''
+    failures = 0
+    for entry in corpus:
+        for chunk_size in chunk_sizes:
+            streamed = stream_response(entry["raw"], chunk_size)
+            if streamed != (entry["response"] or ""):
+                failures += 1
+                print(f"STREAM FAILED ({entry['note']}, {chunk_size} char chunks): "
+                      f"expected {entry['response']!r}, got {streamed!r}")
+    print(f"streaming: {len(corpus) * len(chunk_sizes) - failures}/{len(corpus) * len(chunk_sizes)} streams spoke the expected response")
+    return failures
+
+
+def mutate(raw, rng):
+    '''Applies a random malformation as LLMs tend to produce it.'''
+    mutation = rng.choice(["truncate", "newlines", "quotes", "colon", "whitespace", "junk"])
+    if mutation == "truncate":
+        return raw[:rng.randint(0, len(raw))]
+    if mutation == "newlines":
+        return raw.replace("\n", " ")
+    if mutation == "quotes":
+        return raw.replace('"', rng.choice(["", "'"]))
+    if mutation == "colon":
+        position = rng.randint(0, len(raw))
+        return raw[:position] + ": " + raw[position:]
+    if mutation == "whitespace":
+        return raw.replace(": ", ":" + " " * rng.randint(0, 3))
+    return raw + rng.choice(["\n}\n```", "<|im_end|>", "\n\nI hope this helps!", "}}"])
+
+
+def fuzz(corpus, iterations, seed=0):
+    '''Parses random mutations of the corpus. The parser must never raise. Returns the number of crashes.'''
+    rng = random.Random(seed)
+    crashes = 0
+    parsed = 0
+    for _ in range(iterations):
+        raw = rng.choice(corpus)["raw"]
+        for _ in range(rng.randint(1, 3)):
+            raw = mutate(raw, rng)
+        try:
+            parsed += parse_structured_output(raw) is not None
+        except Exception as e:
+            crashes += 1
+            print(f"CRASH {type(e).__name__}: {e} on {raw!r}")
+    print(f"fuzz: {iterations} mutated outputs, {parsed} with a response, {crashes} crashes")
+    return crashes
+
+
+def benchmark(corpus, repeat):
+    '''Reports the mean parse time per output.'''
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for entry in corpus:
+            parse_structured_output(entry["raw"])
+    elapsed = time.perf_counter() - start
+    print(f"speed: {elapsed / (repeat * len(corpus)) * 1e6:.1f} us per output ({repeat * len(corpus)} parses)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--fuzz", type=int, default=5000, help="number of mutated outputs to parse")
+    parser.add_argument("--repeat", type=int, default=2000, help="passes over the corpus for the speed measurement")
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    failures = check_corpus(corpus) + check_streaming(corpus) + fuzz(corpus, args.fuzz)
+    benchmark(corpus, args.repeat)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,125 @@
+'''Benchmarks the full-text search over the conversation history against the per-turn latency target.
+
+Builds a database with synthetic conversation turns and chatter and measures the search latency.
+The database is kept in the temp directory for later runs.
+Run from the repository root: python benchmarks/search_benchmark.py [--rows 1000000] [--queries 500] [--target-ms 10]'''
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lachsbuddy"))
+
+from search import create_search_index, search
+
+# the columns of the real tables that the search touches
+TABLES = ['''CREATE TABLE conversation_history (
+                conversation_id INTEGER, step INTEGER, timestamp DATETIME, human_input_raw TEXT,
+                human_input_corrected TEXT, ai_response TEXT, entities TEXT, PRIMARY KEY (conversation_id, step))''',
+          '''CREATE TABLE chatter (
+                chatter_id INTEGER PRIMARY KEY, timestamp DATETIME, human_input_raw TEXT, listening_mode TEXT)''']
+
+SYLLABLES = ["ka", "lo", "mi", "sen", "tra", "vel", "dor", "pi", "qua", "ru", "ne", "zo", "ber", "li", "ton", "fa"]
+
+
+def make_vocabulary(rng, size=30000):
+    return ["".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) for _ in range(size)]
+
+
+def make_sentence(rng, vocabulary, weights, length):
+    return " ".join(rng.choices(vocabulary, cum_weights=weights, k=length))
+
+
+def build_database(path, rows, seed=0):
+    '''Fills a new database with rows conversation turns and rows // 4 chatter entries.
+    The words follow a Zipf distribution, like natural language.'''
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng)
+    weights = []
+    total = 0.0
+    for rank in range(1, len(vocabulary) + 1):
+        total += 1 / rank
+        weights.append(total)
+
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    for table in TABLES:
+        connection.execute(table)
+    create_search_index(connection.cursor())
+
+    start = time.perf_counter()
+    batch_size = 10000
+    for offset in range(0, rows, batch_size):
+        turns = []
+        for i in range(offset, min(offset + batch_size, rows)):
+            human_input = make_sentence(rng, vocabulary, weights, rng.randint(4, 20))
+            turns.append((i // 20, i % 20, "2023-06-01 12:00:00", human_input, human_input,
+                          make_sentence(rng, vocabulary, weights, rng.randint(8, 40)),
+                          ", ".join(rng.choices(vocabulary, k=2))))
+        chatter = [("2023-06-01 12:00:00", make_sentence(rng, vocabulary, weights, rng.randint(3, 15)), "passive")
+                   for _ in range(len(turns) // 4)]
+        with connection:
+            connection.executemany("INSERT INTO conversation_history VALUES (?, ?, ?, ?, ?, ?, ?)", turns)
+            connection.executemany("INSERT INTO chatter (timestamp, human_input_raw, listening_mode) VALUES (?, ?, ?)",
+                                   chatter)
+        print(f"\rbuilding: {offset + len(turns)}/{rows} rows", end="", flush=True)
+    print(f"\rbuilding: {rows} rows in {time.perf_counter() - start:.1f} s (with index triggers)")
+    connection.execute("INSERT INTO conversation_history_fts (conversation_history_fts) VALUES ('optimize')")
+    connection.execute("INSERT INTO chatter_fts (chatter_fts) VALUES ('optimize')")
+    connection.commit()
+    return connection
+
+
+def make_queries(connection, count, seed=1):
+    '''Takes two to three words of random stored inputs as queries, like a human referring to an earlier topic.'''
+    rng = random.Random(seed)
+    max_rowid = connection.execute("SELECT MAX(rowid) FROM conversation_history").fetchone()[0]
+    queries = []
+    while len(queries) < count:
+        row = connection.execute("SELECT human_input_raw FROM conversation_history WHERE rowid = ?",
+                                 (rng.randint(1, max_rowid),)).fetchone()
+        if row is not None:
+            words = row[0].split()
+            queries.append(" ".join(rng.sample(words, min(len(words), rng.randint(2, 3)))))
+    return queries
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000, help="number of conversation turns in the database")
+    parser.add_argument("--queries", type=int, default=500, help="number of timed searches")
+    parser.add_argument("--target-ms", type=float, default=10, help="p95 latency target in milliseconds")
+    parser.add_argument("--db", default=None, help="database file, reused if it exists")
+    args = parser.parse_args()
+
+    path = args.db or os.path.join(tempfile.gettempdir(), f"lachsbuddy_search_benchmark_{args.rows}.db")
+    if os.path.exists(path):
+        connection = sqlite3.connect(path)
+    else:
+        connection = build_database(path, args.rows)
+
+    queries = make_queries(connection, args.queries)
+    search(connection, queries[0])  # warm up the page cache
+
+    latencies = []
+    hits = 0
+    for query in queries:
+        start = time.perf_counter()
+        results = search(connection, query)
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits += bool(results)
+
+    p95 = percentile(latencies, 0.95)
+    print(f"search: {len(queries)} queries, {hits} with results, p50 {percentile(latencies, 0.5):.2f} ms, "
+          f"p95 {p95:.2f} ms, max {max(latencies):.2f} ms (target p95 < {args.target_ms} ms)")
+    sys.exit(0 if p95 < args.target_ms else 1)
@@ -0,0 +1,102 @@
+'''Measures the startup time: import time of the program and time until the first text prompt is shown.
+
+Every run uses a fresh interpreter. The first prompt is measured in text mode (config.INPUT_MODE = "text"),
+the models keep loading in the background. With --wait-models, the time until all of them are ready is reported too.
+Run from the repository root: python benchmarks/startup_benchmark.py [--runs 5] [--top 10] [--wait-models]'''
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lachsbuddy")
+
+IMPORT_SCRIPT = '''
+import sys, time
+sys.path.insert(0, {package_dir!r})
+start = time.perf_counter()
+import processing
+print(time.perf_counter() - start)
+'''
+
+# replaces input() to stop the program at the first prompt
+FIRST_PROMPT_SCRIPT = '''
+import sys, time, builtins
+start = time.perf_counter()
+sys.path.insert(0, {package_dir!r})
+import config
+config.INPUT_MODE = "text"
+config.START_INACTIVE = True
+import processing
+
+def first_prompt(prompt=""):
+    print(time.perf_counter() - start)
+    if {wait_models!r}:
+        processing.loader.wait()
+        print(time.perf_counter() - start)
+    sys.stdout.flush()
+    raise SystemExit(0)
+
+builtins.input = first_prompt
+processing.startup_checks()
+processing.run_in_background()
+'''
+
+
+def run_script(script, working_dir):
+    '''Runs a script in a fresh interpreter and returns the numbers it printed.'''
+    result = subprocess.run([sys.executable, "-c", script], cwd=working_dir, capture_output=True, text=True)
+    numbers = []
+    for line in result.stdout.splitlines():
+        try:
+            numbers.append(float(line))
+        except ValueError:
+            pass
+    if result.returncode != 0 or not numbers:
+        raise RuntimeError(f"benchmark run failed:\n{result.stdout}\n{result.stderr}")
+    return numbers
+
+
+def slowest_imports(working_dir, top):
+    '''Returns the top modules by cumulative import time in microseconds, using python -X importtime.'''
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", IMPORT_SCRIPT.format(package_dir=PACKAGE_DIR)],
+                            cwd=working_dir, capture_output=True, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, module = [part.strip() for part in line[len("import time:"):].split("|")]
+            if cumulative.isdigit():
+                imports.append((int(cumulative), module))
+    return sorted(imports, reverse=True)[:top]
+
+
+def report(name, values):
+    print(f"{name}: median {statistics.median(values):.3f} s, min {min(values):.3f} s, max {max(values):.3f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="number of fresh interpreters per measurement")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest imports to list (0 to skip)")
+    parser.add_argument("--wait-models", action="store_true", help="also measure the time until all models are loaded")
+    args = parser.parse_args()
+
+    # the database is created relative to the working directory, so a temporary one is used
+    with tempfile.TemporaryDirectory() as working_dir:
+        os.makedirs(os.path.join(working_dir, "data"))
+
+        report("import processing", [run_script(IMPORT_SCRIPT.format(package_dir=PACKAGE_DIR), working_dir)[0]
+                                     for _ in range(args.runs)])
+
+        first_prompt_runs = [run_script(FIRST_PROMPT_SCRIPT.format(package_dir=PACKAGE_DIR, wait_models=args.wait_models),
+                                        working_dir) for _ in range(args.runs)]
+        report("time to first prompt", [numbers[0] for numbers in first_prompt_runs])
+        if args.wait_models:
+            report("time until models are ready", [numbers[1] for numbers in first_prompt_runs])
+
+        if args.top:
+            print("slowest imports (cumulative):")
+            for microseconds, module in slowest_imports(working_dir, args.top):
+                print(f"  {microseconds / 1e6:.3f} s  {module}")
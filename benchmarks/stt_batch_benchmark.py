@@ -0,0 +1,109 @@
+'''Measures the STT throughput for different batch sizes.
+
+For every batch size, the same utterances are transcribed with STTEngine.transcribe_batch in batches of that size
+(batch size 1 is the unbatched path). Reports utterances per second, seconds of audio per second and the latency of
+a batch. With --concurrent, the utterances are instead submitted by that many threads at once through the
+MicroBatcher, to see what the collection window adds.
+Utterances are read from a directory of 16 bit WAV files, or synthesized as noise bursts if none is given (fine for
+throughput, the transcripts are meaningless).
+Run from the repository root: python benchmarks/stt_batch_benchmark.py [--wav-dir recordings] [--batch-sizes 1 2 4 8 16]'''
+
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lachsbuddy"))
+
+import config
+from stt import STT_SAMPLE_RATE, STTEngine
+from pipeline import MicroBatcher
+
+
+def load_utterances(wav_dir, count, seconds):
+    '''Returns count 16 kHz float32 utterances, from the WAV files in wav_dir (repeated if needed) or synthesized.'''
+    if wav_dir:
+        from fakes import read_wav
+        utterances = []
+        for name in sorted(os.listdir(wav_dir)):
+            if name.lower().endswith(".wav"):
+                samples, sample_rate = read_wav(os.path.join(wav_dir, name))
+                if sample_rate != STT_SAMPLE_RATE:
+                    positions = np.arange(0, len(samples), sample_rate / STT_SAMPLE_RATE)
+                    samples = np.interp(positions, np.arange(len(samples)), samples)
+                utterances.append(samples.astype(np.float32) / 32768)
+        if not utterances:
+            raise ValueError(f"No WAV files in {wav_dir}")
+        return [utterances[index % len(utterances)] for index in range(count)]
+
+    rng = np.random.default_rng(0)
+    length = int(seconds * STT_SAMPLE_RATE)
+    envelope = np.abs(np.sin(np.linspace(0, 6 * np.pi, length)))
+    return [(0.1 * rng.standard_normal(length) * envelope).astype(np.float32) for _ in range(count)]
+
+
+def run_batched(engine, utterances, batch_size):
+    '''Transcribes the utterances in batches of batch_size, returns the elapsed time and the latency of each batch.'''
+    latencies = []
+    start = time.perf_counter()
+    for index in range(0, len(utterances), batch_size):
+        batch_start = time.perf_counter()
+        engine.transcribe_batch(utterances[index:index + batch_size])
+        latencies.append(time.perf_counter() - batch_start)
+    return time.perf_counter() - start, latencies
+
+
+def run_concurrent(engine, utterances, batch_size, window, threads):
+    '''Submits the utterances from several threads through a MicroBatcher, returns the elapsed time and the latency
+    of each utterance from submission to result.'''
+    batcher = MicroBatcher("benchmark batcher", engine.transcribe_batch, batch_size, window)
+    latencies = []
+    lock = threading.Lock()
+
+    def submit_all(part):
+        for samples in part:
+            submitted = time.perf_counter()
+            batcher.submit(samples).result()
+            with lock:
+                latencies.append(time.perf_counter() - submitted)
+
+    workers = [threading.Thread(target=submit_all, args=(utterances[index::threads],)) for index in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start, latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--model-type", default=config.STT_MODEL_TYPE)
+    parser.add_argument("--model", default=config.STT_MODEL)
+    parser.add_argument("--wav-dir", help="directory with 16 bit WAV utterances")
+    parser.add_argument("--utterances", type=int, default=32, help="number of utterances per batch size")
+    parser.add_argument("--seconds", type=float, default=4.0, help="length of the synthesized utterances")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--concurrent", type=int, default=0, help="submit from this many threads through the batcher")
+    parser.add_argument("--window", type=float, default=config.STT_BATCH_WINDOW, help="collection window in seconds")
+    args = parser.parse_args()
+
+    utterances = load_utterances(args.wav_dir, args.utterances, args.seconds)
+    audio_seconds = sum(len(samples) for samples in utterances) / STT_SAMPLE_RATE
+    engine = STTEngine(model_type=args.model_type, model_name=args.model).warm_up()
+
+    print(f"{args.model_type} {args.model}: {len(utterances)} utterances, {audio_seconds:.1f} s of audio")
+    latency_name = "utterance latency" if args.concurrent else "batch latency"
+    print(f"{'batch size':>10}{'utt/s':>10}{'audio s/s':>11}{latency_name + ' p50/p95 ms':>32}")
+    for batch_size in args.batch_sizes:
+        if args.concurrent:
+            elapsed, latencies = run_concurrent(engine, utterances, batch_size, args.window, args.concurrent)
+        else:
+            elapsed, latencies = run_batched(engine, utterances, batch_size)
+        p95 = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0]
+        print(f"{batch_size:>10}{len(utterances) / elapsed:>10.2f}{audio_seconds / elapsed:>11.1f}"
+              f"{statistics.median(latencies) * 1000:>21.0f} / {p95 * 1000:.0f}")
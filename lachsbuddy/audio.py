@@ -1,159 +1,327 @@
 '''Handles audio I/O'''
 
-import speech_recognition as sr
-from io import BytesIO
-from pydub import AudioSegment
-from pydub.playback import play
+# speech_recognition, pydub and sounddevice are only imported when a device is used, so the module can be imported
+# without audio libraries or devices (text mode, MQTT nodes, benchmarks, ingest.py)
 import config
 import traceback
-from keys import OPENAI_API_BASE, OPENAI_API_KEY
-import paho.mqtt.subscribe as subscribe
-import paho.mqtt.publish as publish
-import json
-import base64
+import threading
+import queue
+import time
+from tts import get_tts_engine, segment_to_array, SpeechStream
+from stt import transcribe_utterance, transcribe_passive
+from mqtt_transport import get_mqtt_transport
+from timing import NULL_TIMER
 
 
-if config.STT_MODEL_TYPE == "whisper-api":
-    import openai
+if config.TTS_MODEL not in ["gtts", "bark", "silero"]:
+    print("audio.py: Please provide a valid text to speech model for the TTS_MODEL variable.")
+
+# one recognizer is reused for every recording, created with the first one
+recognizer = None
+
+
+class MicrophoneCapture():
+    '''Long-lived capture service that keeps the input device open.
+    Ambient noise is calibrated once when the device is opened, afterwards the energy threshold keeps adapting
+    from the silent frames read between phrases (speech_recognition's dynamic energy threshold).
+    Finished utterances are put into a queue and fetched with get_utterance().
+    While paused (e.g. during TTS playback), recorded phrases are dropped so the AI doesn't hear itself.'''
+
+    def __init__(self, device_index=config.INPUT_DEVICE_INDEX, calibration_seconds=config.MIC_CALIBRATION_SECONDS,
+                 max_queued=config.MIC_MAX_QUEUED_UTTERANCES):
+        self.device_index = device_index
+        self.calibration_seconds = calibration_seconds
+        import speech_recognition as sr
+        self.recognizer = sr.Recognizer()
+        self.recognizer.dynamic_energy_threshold = True
+        self.utterances = queue.Queue(maxsize=max_queued)
+        self.calibrated = threading.Event()
+        self.running = False
+        self.thread = None
+        # the exception that stopped the capture thread, raised again by get_utterance
+        self.error = None
+
+        # pause bookkeeping, nested pauses are counted
+        self.lock = threading.Lock()
+        self.pause_count = 0
+        self.pause_generation = 0
+
+    def start(self):
+        '''Opens the input device on a background thread and starts capturing.'''
+        if not self.running:
+            self.running = True
+            self.thread = threading.Thread(target=self._capture_loop, daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+
+    def pause(self):
+        with self.lock:
+            self.pause_count += 1
+            self.pause_generation += 1
+
+    def resume(self):
+        with self.lock:
+            self.pause_count = max(0, self.pause_count - 1)
+
+    def get_utterance(self, timeout=None, poll_interval=0.5):
+        '''Returns the next finished utterance as AudioData, blocking until one is available (raises queue.Empty
+        after timeout seconds if one is given). If the capture thread stopped, e.g. because the device was unplugged,
+        its exception is raised instead of waiting forever.'''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = poll_interval if deadline is None else max(0, min(poll_interval, deadline - time.monotonic()))
+            try:
+                return self.utterances.get(timeout=wait)
+            except queue.Empty:
+                if not self.running and self.utterances.empty():
+                    if self.error is not None:
+                        raise self.error
+                    raise Exception("Microphone capture stopped")
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+
+    def wait_until_calibrated(self, poll_interval=0.5):
+        '''Blocks until the ambient noise is calibrated. Raises the capture thread's exception if it stopped before.'''
+        while not self.calibrated.wait(poll_interval):
+            if not self.running:
+                if self.error is not None:
+                    raise self.error
+                raise Exception("Microphone capture stopped")
+        return self
+
+    def _capture_loop(self):
+        import speech_recognition as sr
+        try:
+            with sr.Microphone(device_index=self.device_index, sample_rate=16000) as source:
+                self.recognizer.adjust_for_ambient_noise(source, duration=self.calibration_seconds)
+                self.calibrated.set()
+
+                while self.running:
+                    generation = self.pause_generation
+                    try:
+                        audio = self.recognizer.listen(source, timeout=1)
+                    except sr.WaitTimeoutError:
+                        continue
+
+                    # drop phrases recorded while (or partially while) capture was paused
+                    with self.lock:
+                        if self.pause_count > 0 or generation != self.pause_generation:
+                            continue
+
+                    # drop the oldest utterance if nobody picked them up
+                    if self.utterances.full():
+                        self.utterances.get_nowait()
+                    self.utterances.put(audio)
+        except Exception as error:
+            self.error = error
+            traceback.print_exc()
+            print("(Microphone capture stopped)")
+        finally:
+            self.running = False
 
-if config.TTS_MODEL == "bark":
-    from bark import generate_audio, SAMPLE_RATE
-    import numpy as np
 
-elif config.TTS_MODEL == "gtts":
-    from gtts import gTTS
+microphone_capture = None
+microphone_capture_lock = threading.Lock()
 
-elif config.TTS_MODEL == "silero":
-    import torch
-    import sounddevice as sd
-    import time
 
-else:
-    print("audio.py: Please provide a valid text to speech model for the TTS_MODEL variable.")
+def get_microphone_capture():
+    '''Returns the shared microphone capture service, starting it on first use.'''
+    global microphone_capture
+    with microphone_capture_lock:
+        if microphone_capture is None or not microphone_capture.running:
+            microphone_capture = MicrophoneCapture().start()
+    return microphone_capture
+
 
-if config.STT_MODEL_TYPE == "silero":
-    silero_stt, decode, utils = torch.hub.load(repo_or_dir = 'snakers4/silero-models',
-                model='silero_stt', language='en',
-                device="cpu", trust_repo=True)
+def start_microphone():
+    '''Starts the shared microphone capture and returns it once the ambient noise is calibrated.'''
+    return get_microphone_capture().wait_until_calibrated()
 
 
+def pause_capture():
+    '''Pauses the shared microphone capture (if running) while the AI is making sounds.'''
+    if microphone_capture is not None and config.MIC_PAUSE_DURING_TTS:
+        microphone_capture.pause()
+
+
+def resume_capture():
+    if microphone_capture is not None and config.MIC_PAUSE_DURING_TTS:
+        microphone_capture.resume()
+
 
 def play_effect(file):
     '''This function plays a sound effect using the PyDub library.
     It takes a file path as input and plays the corresponding audio file.'''
-    play(AudioSegment.from_file(file))
-
-
-def play_tts(phrase, language_short=config.LANGUAGE_SHORT, playback_speed=1.2):
-    '''This function converts text to speech using the Google Text-to-Speech (gTTS) API and plays the resulting audio.
-    It takes three optional parameters:
-    phrase is the text to convert to speech,
-    language_short is the language to use (default is specified in the config module),
-    playback_speed is the speed at which to play the audio (default is 1.4 times normal speed).
-    If config.PLAY_SOUND is set to False, no audio will be played.'''
+    from pydub import AudioSegment
+    from pydub.playback import play
+    pause_capture()
+    try:
+        play(AudioSegment.from_file(file))
+    finally:
+        resume_capture()
+
+
+def play_tts(phrase, timer=NULL_TIMER):
+    '''This function converts text to speech using the shared TTS engine (see tts.py) and plays the resulting audio.
+    The TTS model is only loaded once, so repeated calls don't pay for the model load again.
+    If config.TTS_STREAMING is set, playback starts as soon as the first sentence is synthesized.
+    If config.PLAY_SOUND is set to False, no audio will be played.
+    Synthesis and playback durations are added to the "tts" and "playback" stages of timer.'''
     # check if sound playback is enabled
     if config.PLAY_SOUND:
         try:
-            # use gTTS to convert the text to a temporary audio file and store it in a byte stream
-            if config.TTS_MODEL == "gtts":
-                mp3_fp = BytesIO()
-                gtts_audio = gTTS(text=phrase, lang=language_short)
-                gtts_audio.write_to_fp(mp3_fp)
-                mp3_fp.seek(0)
-
-                # play the audio file, speeding it up if necessary
-                play(AudioSegment.from_file(mp3_fp, format="mp3").speedup(playback_speed=playback_speed))
-                mp3_fp.close()
-
-            # use Bark to convert the text to a temporary audio file and store it in a byte stream
-            elif config.TTS_MODEL == "bark":
-                bark_audio_raw = generate_audio(phrase, history_prompt=f"v2/{language_short}_speaker_0")
-                bark_audio_arr = (bark_audio_raw * np.iinfo(np.int16).max).astype(np.int16)
-
-                bark_audio = AudioSegment(
-                    data=bark_audio_arr.tobytes(),
-                    sample_width=bark_audio_arr.dtype.itemsize,
-                    frame_rate=SAMPLE_RATE,
-                    channels=1)
-
-                play(bark_audio.speedup(playback_speed=playback_speed))
-
-            elif config.TTS_MODEL == "silero":
-                language = 'en'
-                speaker = 'v3_en'
-                device = torch.device('cpu')
-                sample_rate = 24000
-                silero_tts,_ = torch.hub.load(repo_or_dir='snakers4/silero-models',
-                                model='silero_tts',
-                                language=language,
-                                speaker=speaker,
-                                device=device)
-                silero_audio = silero_tts.apply_tts(text=phrase, sample_rate=sample_rate, speaker="en_117")
-                
-                if config.MQTT_SPEAKER:
-                    audio = base64.b64encode(silero_audio.numpy()).decode()
-                    publish.single("system/client-io", payload=str(json.dumps({"PLAY AUDIO": audio})), hostname=config.BROKER_ADDRESS)
-                    
-                    #publish.single("system/client-io", payload=str(json.dumps({"PLAY AUDIO":bytes(silero_audio.numpy())})))
-                    print("sent audio")
-                    confirmation = subscribe.simple("system/io-client", hostname=config.BROKER_ADDRESS).payload.decode()
-                    print(confirmation)
-
-                else:
-                    sd.play(silero_audio, sample_rate)
-                    sd.wait()
+            if config.TTS_STREAMING:
+                speech = open_speech_stream(timer=timer)
+                speech.feed(phrase)
+                speech.finish()
+                speech.wait()
             else:
-                raise Exception("Invalid TTS model, check TTS_MODEL in the config file.")
+                with timer.stage("tts"):
+                    audio = get_tts_engine().synthesize(phrase)
+                pause_capture()
+                try:
+                    with timer.stage("playback"):
+                        play_audio(audio)
+                finally:
+                    resume_capture()
 
         except:
             traceback.print_exc()
             print("(Audio generation failed)")
 
 
-def listen_mic(stt_model):
-    global client
+def open_speech_stream(timer=NULL_TIMER):
+    '''Returns a SpeechStream that speaks the text fed into it sentence by sentence on the configured output.'''
+    return SpeechStream(sink=MQTTAudioSink() if config.MQTT_SPEAKER else LocalAudioSink(), timer=timer)
+
+
+class LocalAudioSink():
+    '''Output sink for SpeechStream that writes all segments into one sounddevice output stream.
+    The stream is opened on the first write using that segment's sample rate.'''
+
+    def __init__(self):
+        self.stream = None
+
+    def write(self, audio):
+        if self.stream is None:
+            import sounddevice as sd
+            pause_capture()
+            self.stream = sd.OutputStream(samplerate=audio.frame_rate, channels=1, dtype='int16')
+            self.stream.start()
+        self.stream.write(segment_to_array(audio))
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+            resume_capture()
+
+
+class MQTTAudioSink():
+    '''Output sink for SpeechStream that sends segments to the MQTT speaker, of the given transport or the shared one.
+    With config.MQTT_STREAMING, all segments go into one chunked playback stream, otherwise each is sent on its own.'''
+
+    def __init__(self, transport=None):
+        self.transport = transport
+        self.started = False
+        self.stream = None
+
+    def write(self, audio):
+        if not self.started:
+            pause_capture()
+            self.started = True
+
+        if config.MQTT_STREAMING and config.MQTT_BINARY_AUDIO:
+            if self.stream is None:
+                self.stream = (self.transport or get_mqtt_transport()).open_playback_stream(audio.frame_rate)
+            self.stream.write(segment_to_array(audio))
+        else:
+            play_audio(audio, self.transport)
+
+    def close(self):
+        try:
+            if self.stream is not None:
+                print(self.stream.close())
+        finally:
+            self.stream = None
+            if self.started:
+                self.started = False
+                resume_capture()
+
+
+def play_audio(audio, transport=None):
+    '''Plays a mono 16 bit AudioSegment, either locally or on another device using MQTT if config.MQTT_SPEAKER is set
+    or a transport is given.'''
+    if (config.MQTT_SPEAKER or transport is not None) and config.MQTT_STREAMING and config.MQTT_BINARY_AUDIO:
+        stream = (transport or get_mqtt_transport()).open_playback_stream(audio.frame_rate)
+        stream.write(segment_to_array(audio))
+        print("sent audio")
+        print(stream.close())
+
+    elif config.MQTT_SPEAKER or transport is not None:
+        print("sent audio")
+        confirmation = (transport or get_mqtt_transport()).play_audio(segment_to_array(audio), audio.frame_rate)
+        print(confirmation)
+
+    elif config.TTS_MODEL == "silero":
+        import sounddevice as sd
+        sd.play(segment_to_array(audio), audio.frame_rate)
+        sd.wait()
+
+    else:
+        from pydub.playback import play
+        play(audio)
+
+
+def listen_mic(stt_model, listening_mode="active", timer=NULL_TIMER):
     '''
     This function listens to audio input from a microphone using the SpeechRecognition library.
-    It takes a whisper speech to text model as input, which is used to transcribe the audio input.
-    The function adjusts for ambient noise and prompts the user to speak before recording the audio.
+    It takes a STT model name as input, which is used to transcribe the audio input with the already loaded STT engine.
+    In the "passive" listening mode, the hotword spotter decides first whether the audio is worth transcribing.
+    If config.MIC_ALWAYS_ON is set, the utterance is taken from the continuously open capture service,
+    otherwise the function opens the microphone and adjusts for ambient noise before recording.
     The resulting transcribed text string is returned as output.
+    Recording and transcription durations are added to the "capture" and "stt" stages of timer.
     '''
-    r = sr.Recognizer()
+    with timer.stage("capture"):
+        audio = record_audio()
+
+    # transcribe audio with the resident model
+    with timer.stage("stt"):
+        if listening_mode == "passive" and config.HOTWORD_SPOTTER:
+            return transcribe_passive(audio, stt_model)
+
+        return transcribe_utterance(audio, stt_model)
+
+
+def record_audio():
+    '''Records one utterance from the configured microphone and returns it as AudioData.'''
+    global recognizer
+    import speech_recognition as sr
 
     # get audio from another device using MQTT
     if config.MQTT_MIC:
-        publish.single("system/client-io", payload=json.dumps({"REQUESTING AUDIO":""}), hostname=config.BROKER_ADDRESS)
         print(config.style.MAGENTA + "Recording started, speak now" + config.style.RESET)
-        raw_audio = subscribe.simple("speech/io-client", hostname=config.BROKER_ADDRESS).payload
+        raw_audio, sample_rate, sample_width = get_mqtt_transport().request_audio()
         print(config.style.MAGENTA + "Recording complete" + config.style.RESET)
-        audio = sr.AudioData((BytesIO(raw_audio).read()), 16000, 1)
+        return sr.AudioData(raw_audio, sample_rate, sample_width)
+
+    elif config.MIC_ALWAYS_ON:
+        print(config.style.MAGENTA + "Recording started, speak now" + config.style.RESET)
+        audio = get_microphone_capture().get_utterance()
+        print(config.style.MAGENTA + "Recording complete" + config.style.RESET)
+        return audio
 
     else:
+        if recognizer is None:
+            recognizer = sr.Recognizer()
         with sr.Microphone(device_index=config.INPUT_DEVICE_INDEX, sample_rate=16000) as source:
-            r.adjust_for_ambient_noise(source)
+            recognizer.adjust_for_ambient_noise(source)
             print(config.style.MAGENTA + "Recording started, speak now" + config.style.RESET)
-            audio = r.listen(source)
+            audio = recognizer.listen(source)
             print(config.style.MAGENTA + "Recording complete" + config.style.RESET)
-            
-
-    # transcribe audio
-    if config.STT_MODEL_TYPE == "whisper":
-        transcribed_text = r.recognize_whisper(audio, model=stt_model, language = "en")
-
-    # currently broken
-    elif config.STT_MODEL_TYPE == "whisper-api":
-        audio_file = BytesIO(audio.get_wav_data())
-
-        whisper = openai.OpenAI(
-            api_key=OPENAI_API_KEY, 
-            base_url=OPENAI_API_BASE)
-
-        transcribed_text = whisper.audio.transcriptions.create(model=stt_model, file=audio_file, response_format = "text")
-
-    elif config.STT_MODEL_TYPE == "silero":
-        audio = AudioSegment.from_file(BytesIO(audio.get_wav_data()))
-        transcribed_text = decode(silero_stt(torch.FloatTensor(audio.get_array_of_samples()).view(1, -1))[0])  
-
-    return transcribed_text
-
-
+            return audio
@@ -17,6 +17,30 @@ CONFIRM_SEND = False
 # Whether chatter in inactive mode will also be recorded in the database.
 LOG_CHATTER = True
 
+# Whether to keep the microphone open between recordings. The ambient noise is then only calibrated once and
+# adapted in the background, instead of spending about a second on calibration before every recording.
+MIC_ALWAYS_ON = True
+
+# seconds of ambient noise used for the initial microphone calibration
+MIC_CALIBRATION_SECONDS = 1
+
+# utterances that are kept while nobody is listening, older ones are dropped
+MIC_MAX_QUEUED_UTTERANCES = 5
+
+# Whether to pause the microphone while the AI is speaking so it doesn't record itself.
+# Set to False if you use headphones and want to be able to talk over the AI.
+MIC_PAUSE_DURING_TTS = True
+
+# Whether to overlap the stages of a conversation turn: the next voice input is recorded and transcribed in the background
+# (text input stays in the foreground),
+# database writes and history fetches run on a worker thread and the next turn doesn't wait for the playback to end.
+# Not used if CONFIRM_SEND is enabled, or for voice input from a local microphone without MIC_ALWAYS_ON (it can't be
+# paused during playback, so the AI would record itself).
+PIPELINE_MODE = True
+
+# number of items that may wait between two pipeline stages
+PIPELINE_QUEUE_SIZE = 4
+
 # Whether to output AI responses as sound
 PLAY_SOUND = True
 
@@ -26,6 +50,22 @@ PLAY_SOUND = True
 # "bark" - experimental model that may confabulate the output to an extent and is not very accurate
 TTS_MODEL = "silero"
 
+# Whether to synthesize a dummy sentence at startup so the first AI response doesn't pay for the model initialization
+TTS_WARM_UP = True
+
+# Whether to split responses into sentences and start speaking after the first one is synthesized
+# instead of waiting for the whole response
+TTS_STREAMING = True
+
+# sentences shorter than this many characters are merged with the next one before synthesis
+TTS_STREAM_MIN_CHARS = 20
+
+# number of synthesized sentences that may wait for playback
+TTS_STREAM_BUFFER = 2
+
+# playback speed multiplier for the gtts and bark voices
+TTS_PLAYBACK_SPEED = 1.2
+
 # words to active and exit the active mode
 HOTWORD = "activate"
 ENDWORD = "exit"
@@ -41,12 +81,49 @@ STT_MODEL_TYPE = "whisper"
 # .en models only recognize English output, can be faster
 STT_MODEL = "base.en"
 
+# Whether to use a cheap first stage in the inactive mode instead of transcribing every utterance with STT_MODEL.
+# Utterances without speech are skipped, and if LOG_CHATTER is False, STT_MODEL only runs once a small whisper model
+# has picked up the hotword. Spotting needs the whisper package, without it every utterance with speech is transcribed.
+HOTWORD_SPOTTER = True
+
+# small whisper model used to spot the hotword and the number of tokens it may decode
+HOTWORD_MODEL = "tiny.en"
+HOTWORD_MAX_TOKENS = 12
+
+# energy gate: a 30ms frame counts as speech if its RMS (audio range -1 to 1) is above VAD_MIN_RMS,
+# and an utterance needs at least VAD_MIN_SPEECH_SECONDS of such frames
+VAD_MIN_RMS = 0.01
+VAD_MIN_SPEECH_SECONDS = 0.3
+
+# Bulk ingestion of recordings (ingest.py): recordings are split into utterances at pauses of at least
+# INGEST_MIN_SILENCE_SECONDS, and transcripts are committed in transactions of about INGEST_TRANSACTION_ROWS rows
+INGEST_MIN_SILENCE_SECONDS = 0.8
+INGEST_TRANSACTION_ROWS = 5000
+
+# Whether to collect utterances that are transcribed at the same time (several MQTT mics, server mode) for up to
+# STT_BATCH_WINDOW seconds and transcribe them in one batched forward pass of at most STT_BATCH_SIZE utterances.
+# Only helps if utterances arrive concurrently, a single microphone only pays the window. Always on in server mode.
+STT_BATCHING = False
+STT_BATCH_WINDOW = 0.05
+STT_BATCH_SIZE = 8
+
+# Whether to run a short silent clip through the STT model at startup so the first utterance isn't slowed down
+STT_WARM_UP = True
+
 # LLM to use. 
 # "local-openai" - a local model accessed via a local OpenAI-compatible API
 # "bard" - Bard API - will likely be removed!
 # an OpenAI model, such as "gpt-3.5-turbo" (=ChatGPT)
 LLM_NAME = "local-openai"
 
+# Whether to stream the LLM output token by token. The "response" value is then spoken while it is still being
+# generated, instead of after the whole output is complete. Requires an OpenAI-compatible API.
+LLM_STREAMING = True
+
+# Whether to ask the LLM for the "response" key right after the emotions instead of near the end of the output,
+# so streamed responses can be spoken earlier
+LLM_RESPONSE_EARLY = True
+
 # Short and long key for the language you want to use for text to speech output.
 # Languages other than English aren't currently supported
 LANGUAGE = "english"
@@ -55,14 +132,99 @@ LANGUAGE_SHORT = "en"
 # set the number of previous steps to store in the conversation history
 HISTORY_STEPS = 200
 
+# approximate number of tokens the conversation history may take up in the prompt. Once it's exceeded, older turns
+# are summarized in the background, only the last HISTORY_VERBATIM_TURNS turns are always kept word for word.
+HISTORY_TOKEN_BUDGET = 1500
+HISTORY_VERBATIM_TURNS = 6
+
+# max length of the running summary of older turns
+HISTORY_SUMMARY_MAX_WORDS = 150
+
+# characters per token used to estimate the prompt size
+HISTORY_CHARS_PER_TOKEN = 4
+
+# Whether to remember finished turns and chatter across conversations. They are embedded in the background and the
+# most similar memories are added to the prompt. Needs an OpenAI-compatible embeddings endpoint and costs one
+# embedding request per turn.
+MEMORY_ENABLED = False
+
+# embedding model, folder of the vector store and max number of memories it keeps. Once it's full,
+# the oldest memories are overwritten. The store takes about MEMORY_CAPACITY * (2 * dimensions + 8) bytes on disk.
+EMBEDDING_MODEL = "text-embedding-ada-002"
+MEMORY_DIRECTORY = ".//data//memory"
+MEMORY_CAPACITY = 20000
+
+# number of memories added to the prompt, the minimum cosine similarity for a memory to be used and the number of
+# nearest candidates from the approximate search that are compared exactly
+MEMORY_RESULTS = 3
+MEMORY_MIN_SIMILARITY = 0.8
+MEMORY_CANDIDATES = 256
+
+# database writes are grouped into one transaction per DB_COMMIT_INTERVAL seconds or DB_BATCH_SIZE statements
+DB_BATCH_SIZE = 100
+DB_COMMIT_INTERVAL = 1.0
+
+# SQLite page cache size in KB
+DB_CACHE_KB = 20000
+
+# Whether to record how long each stage of a conversation step takes (capture, STT, history, prompt, LLM time to first
+# token and total, parsing, TTS and playback) in the step_timing table. Export them with timing.py.
+TIMING_ENABLED = False
+
+# node label of the exported timings, the host name if None
+TIMING_NODE_NAME = None
+
+# number of results and words per snippet returned by the full-text search over past conversations and chatter
+SEARCH_RESULTS = 5
+SEARCH_SNIPPET_WORDS = 12
+
+# max matches that are ranked per search. If a query matches more rows (e.g. only common words), the most recent
+# matches are ranked. Ranking costs about 10 microseconds per match, this keeps a search within a few milliseconds.
+SEARCH_MAX_CANDIDATES = 200
+
+# words that occur in more than this fraction of the recent rows are ignored by the search, like stopwords
+SEARCH_COMMON_TERM_FRACTION = 0.01
+
 # emotions that should be distinguishable
 EMOTION_LIST = ["neutral", "happiness", "fear", "anger", "surprise", "disgust", "sadness"]
 
 VALID_VARIABLE_KEYS = ['human_input', 'human_emotion', 'reaction_emotion', 'intent', 'action', 'tool', 'tool_input',
                            'response', 'entities']
 
-# Max tries for fixing the output parsing
-LLM_PARSER_MAX_RETRIES = 0
+# Max number of new LLM requests if the output can't be parsed. The input has to be repeated afterwards.
+LLM_PARSER_MAX_RETRIES = 2
+
+# seconds to wait for the LLM server, number of retries for failed requests and the base delay in seconds between
+# retries, which doubles with every attempt
+LLM_TIMEOUT = 60
+LLM_REQUEST_RETRIES = 3
+LLM_RETRY_BACKOFF = 0.5
+
+# max number of open connections to the LLM server. In server mode, sessions beyond it wait for a free connection.
+LLM_MAX_CONNECTIONS = 10
+
+# Whether to ask the server to keep the static start of the prompt (setting, tools, output format) in its prompt cache.
+# The static part is identical every turn, so only history and input have to be processed again.
+LLM_PROMPT_CACHE = True
+
+# Whether to generate a grammar for local OpenAI-compatible servers from VALID_VARIABLE_KEYS, EMOTION_LIST and the
+# available tools. It fixes the key order and formatting and restricts emotions and tools to their valid values.
+# If False, the generic JSON grammar in LLM_GRAMMAR_FILE is used instead.
+LLM_GENERATED_GRAMMAR = True
+LLM_GRAMMAR_FILE = "./grammars/json.gbnf"
+
+# max tokens of an LLM output. With the generated grammar, this is raised to what the LLM_GRAMMAR_MAX_CHARS caps
+# allow (see llm.output_max_tokens), so the grammar can't be cut off in the middle of the object.
+LLM_MAX_TOKENS = 300
+
+# max characters per value in the generated grammar. Keys that aren't listed are unlimited.
+# Uses the {m,n} repetition syntax, which requires a recent llama.cpp based server.
+LLM_GRAMMAR_MAX_CHARS = {"human_input": 300, "intent": 100, "action": 100, "tool_input": 100, "response": 600,
+                         "entities": 100}
+
+# Which conversation to continue when the active mode is entered.
+# None: start a new conversation, "last": resume the most recent conversation, a number: resume that conversation
+RESUME_CONVERSATION = None
 
 # Whether to strart in the inactive mode, requiring you to activate the AI using the hotword
 START_INACTIVE = False
@@ -78,6 +240,35 @@ MQTT_SPEAKER = False
 BROKER_ADDRESS = "localhost"
 BROKER_PORT = 1883  # Standard MQTT port
 
+# Whether to send audio as int16 PCM with a small binary header instead of base64 encoded float32 inside JSON.
+# Only enable it once your remote speaker/microphone speaks the binary protocol (see the README and mqtt_transport.py),
+# nodes using the JSON messages don't understand it.
+MQTT_BINARY_AUDIO = False
+
+# Whether to stream audio to/from the remote devices in small chunks, so playback can start on the first chunk
+# instead of waiting for one large message. Requires MQTT_BINARY_AUDIO and a node that handles the chunked messages.
+MQTT_STREAMING = False
+
+# samples per streamed chunk (4000 = 1/6 second at the 24kHz TTS sample rate)
+MQTT_CHUNK_SAMPLES = 4000
+
+# seconds to wait for the broker connection and for a confirmation from the remote speaker (on top of the audio length)
+MQTT_TIMEOUT = 10
+
+########### Server mode
+# server.py serves several devices from one process with shared STT, TTS and LLM. Every device gets its own session
+# on the topics below "lachsbuddy/<client id>/" and joins by publishing its client id on "lachsbuddy/sessions".
+# Devices listed here get a session right away.
+SERVER_CLIENTS = []
+
+# max number of concurrent sessions, devices that announce themselves beyond it are turned away
+SERVER_MAX_SESSIONS = 16
+
+# TTS requests of different sessions are collected for up to TTS_BATCH_WINDOW seconds and run as one batch of at most
+# TTS_BATCH_SIZE phrases. STT requests are always batched in server mode, see STT_BATCH_WINDOW.
+TTS_BATCH_WINDOW = 0.02
+TTS_BATCH_SIZE = 8
+
 ########### Technical stuff, probably irrelevant for most users
 
 # Define colors for printing
@@ -2,16 +2,50 @@
 
 import sqlite3
 import config
+import threading
+import traceback
+import atexit
+import queue
+import time
+import json
+from collections import deque, OrderedDict
 from audio import play_effect
+from search import create_search_index, repair_search_index, search
+
+conn = None
+database_writer = None
+
+# last conversation id handed out, so concurrent sessions don't get the same id before their first step is written
+last_conversation_id = 0
+
+# last step covered by the running summary of each conversation, so the snapshot can leave the summarized turns out
+summarized_steps = {}
+
+# the connection is shared with the database worker of the pipeline, so all access goes through this lock
+db_lock = threading.RLock()
+
+# version of the schema, stored in the database file as PRAGMA user_version
+SCHEMA_VERSION = 2
 
 def connect_to_database():
     '''
     Connects to the conversation history database and creates a table to store conversation data if it doesn't exist.
+    The connection is only opened once and reused afterwards. Older database files are migrated to the current schema.
     '''
-    global c, conn
-    conn = sqlite3.connect('.//data//conversation_history.db')
+    global c, conn, database_writer
+    if conn is not None:
+        return
+
+    conn = sqlite3.connect('.//data//conversation_history.db', check_same_thread=False)
     c = conn.cursor()
 
+    # WAL lets reads run alongside writes and only needs an fsync on checkpoints with synchronous=NORMAL
+    c.execute("PRAGMA journal_mode=WAL")
+    c.execute("PRAGMA synchronous=NORMAL")
+    c.execute("PRAGMA temp_store=MEMORY")
+    c.execute(f"PRAGMA cache_size=-{config.DB_CACHE_KB}")
+    c.execute("PRAGMA busy_timeout=5000")
+
     c.execute('''CREATE TABLE IF NOT EXISTS conversation_history (
                 conversation_id INTEGER,
                 step INTEGER,
@@ -33,16 +67,246 @@ def connect_to_database():
                 memory TEXT,
                 listening_mode TEXT,
                 PRIMARY KEY (conversation_id, step))''')
+
+    # running summary of the older part of each conversation
+    c.execute('''CREATE TABLE IF NOT EXISTS conversation_summary (
+                conversation_id INTEGER PRIMARY KEY,
+                summarized_step INTEGER,
+                summary TEXT)''')
+
+    # state needed to resume a conversation (last step and the turns after the summary), updated with every step
+    c.execute('''CREATE TABLE IF NOT EXISTS conversation_snapshot (
+                conversation_id INTEGER PRIMARY KEY,
+                step INTEGER,
+                turns TEXT)''')
+
+    # texts of the long-term memory, by their slot in the vector store
+    c.execute('''CREATE TABLE IF NOT EXISTS memory (
+                slot INTEGER PRIMARY KEY,
+                timestamp DATETIME,
+                source TEXT,
+                conversation_id INTEGER,
+                text TEXT)''')
+
+    # background chatter, kept apart so it doesn't pile up NULL keys in the conversation primary key
+    c.execute('''CREATE TABLE IF NOT EXISTS chatter (
+                chatter_id INTEGER PRIMARY KEY,
+                timestamp DATETIME,
+                human_input_raw TEXT,
+                listening_mode TEXT)''')
+
+    # recordings ingested by ingest.py and their transcripts in the chatter table (segments rows from first_chatter_id on)
+    c.execute('''CREATE TABLE IF NOT EXISTS ingested_file (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime REAL,
+                duration REAL,
+                segments INTEGER,
+                first_chatter_id INTEGER,
+                ingested_at DATETIME)''')
+
+    # duration of each stage of a conversation step in seconds (see timing.py), next to the step in conversation_history
+    c.execute('''CREATE TABLE IF NOT EXISTS step_timing (
+                conversation_id INTEGER,
+                step INTEGER,
+                stage TEXT,
+                value REAL,
+                PRIMARY KEY (conversation_id, step, stage))''')
+
+    c.execute("CREATE INDEX IF NOT EXISTS conversation_history_timestamp ON conversation_history (timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS conversation_history_listening_mode ON conversation_history (listening_mode)")
+    c.execute("CREATE INDEX IF NOT EXISTS chatter_timestamp ON chatter (timestamp)")
     conn.commit()
 
+    migrate_database()
+
+    # batch writes into few transactions, make sure everything is written on exit
+    database_writer = DatabaseWriter()
+    atexit.register(database_writer.flush)
+
+
+def migrate_database():
+    '''Migrates database files created by older versions to SCHEMA_VERSION.
+    Version 1 moves chatter rows (NULL conversation_id) from conversation_history into the chatter table.
+    Version 2 adds the full-text search indexes.'''
+    version = c.execute("PRAGMA user_version").fetchone()[0]
+
+    if version < 1:
+        print(config.style.MAGENTA + "Migrating the conversation database, this may take a moment" + config.style.RESET)
+        with conn:
+            c.execute('''INSERT INTO chatter (timestamp, human_input_raw, listening_mode)
+                        SELECT timestamp, human_input_raw, listening_mode FROM conversation_history
+                        WHERE conversation_id IS NULL ORDER BY rowid''')
+            c.execute("DELETE FROM conversation_history WHERE conversation_id IS NULL")
+
+    if version < 2:
+        with conn:
+            create_search_index(c)
+
+    if version < SCHEMA_VERSION:
+        c.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.commit()
+
+    # the database file may have been vacuumed since the last start
+    with conn:
+        if repair_search_index(c):
+            print(config.style.MAGENTA + "Rebuilt the search index" + config.style.RESET)
+
+
+class DatabaseWriter():
+    '''Group-commit writer. Inserts are queued and written by a background thread, which collects them for up to
+    config.DB_COMMIT_INTERVAL seconds (or config.DB_BATCH_SIZE statements) and commits them in one transaction,
+    instead of paying one commit per insert.'''
+
+    def __init__(self, batch_size=config.DB_BATCH_SIZE, commit_interval=config.DB_COMMIT_INTERVAL):
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.statements = queue.Queue()
+        self.thread = threading.Thread(target=self._write_loop, name="database writer", daemon=True)
+        self.thread.start()
+
+    def execute(self, sql, parameters=()):
+        '''Queues a statement. It is committed with the next batch.'''
+        self.statements.put((sql, parameters))
+
+    def flush(self):
+        '''Blocks until all statements queued so far are committed.'''
+        written = threading.Event()
+        self.statements.put((None, written))
+        written.wait()
+
+    def _write_loop(self):
+        while True:
+            batch = [self.statements.get()]
+            deadline = time.monotonic() + self.commit_interval
+
+            # collect more statements until the batch is full, the interval is over or a flush is requested
+            while len(batch) < self.batch_size and batch[-1][0] is not None:
+                try:
+                    batch.append(self.statements.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            self._commit(batch)
+
+    def _commit(self, batch):
+        statements = [(sql, parameters) for sql, parameters in batch if sql is not None]
+        with db_lock:
+            try:
+                with conn:
+                    for sql, parameters in statements:
+                        conn.execute(sql, parameters)
+            except sqlite3.Error:
+                # write the batch statement by statement so a single bad row doesn't discard the others
+                for sql, parameters in statements:
+                    try:
+                        with conn:
+                            conn.execute(sql, parameters)
+                    except sqlite3.Error:
+                        traceback.print_exc()
+                        print("(Database write failed)")
+
+        for sql, written in batch:
+            if sql is None:
+                written.set()
+
+
+class ConversationCache():
+    '''Formatted history of the active conversations, kept in memory as one append-only deque per conversation.
+    insert_conversation appends each new step, so the database only has to be read on a cold start or resume.
+    conversation_id is the current conversation of the single-user loop. Several sessions (server.py) pass their
+    conversation ids explicitly, the least recently used conversations are dropped beyond max_conversations.'''
+
+    def __init__(self, history_steps=config.HISTORY_STEPS, max_conversations=config.SERVER_MAX_SESSIONS + 1):
+        self.conversation_id = None
+        self.history_steps = history_steps
+        self.max_conversations = max_conversations
+        self.conversations = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _turns(self, conversation_id):
+        # the caller holds the lock
+        if conversation_id not in self.conversations:
+            self.conversations[conversation_id] = deque(maxlen=self.history_steps + 1)
+            while len(self.conversations) > self.max_conversations:
+                self.conversations.popitem(last=False)
+        self.conversations.move_to_end(conversation_id)
+        return self.conversations[conversation_id]
+
+    def __contains__(self, conversation_id):
+        with self.lock:
+            return conversation_id in self.conversations
+
+    def load(self, conversation_id, turns):
+        '''Caches the (step, formatted turn) tuples of a conversation without switching to it.'''
+        with self.lock:
+            cached_turns = self._turns(conversation_id)
+            cached_turns.clear()
+            cached_turns.extend(turns)
+
+    def reset(self, conversation_id, turns=()):
+        '''Switches to another conversation, starting with the given (step, formatted turn) tuples.'''
+        with self.lock:
+            self.conversation_id = conversation_id
+            cached_turns = self._turns(conversation_id)
+            cached_turns.clear()
+            cached_turns.extend(turns)
+
+    def append(self, conversation_id, step, human_input, ai_response):
+        with self.lock:
+            if conversation_id != self.conversation_id and conversation_id not in self.conversations:
+                self.conversation_id = conversation_id
+            if human_input != '':
+                self._turns(conversation_id).append((step, f'Human: {human_input}\nAI: {ai_response}'))
+
+    def get_turns(self, conversation_id=None):
+        with self.lock:
+            if conversation_id is None:
+                conversation_id = self.conversation_id
+            return list(self.conversations.get(conversation_id, ()))
+
+
+conversation_cache = ConversationCache()
+
 
 def get_current_history(history_steps=config.HISTORY_STEPS):
     '''
     Retrieves conversation history from the database based on the specified number of steps.
     Returns a formatted string with the conversation history.
     '''
+    return '\n'.join(turn for _, turn in get_current_turns(history_steps))
+
+
+def get_current_turns(history_steps=config.HISTORY_STEPS, conversation_id=None):
+    '''
+    Returns the most recent steps of the current conversation (or of the given one) as a list of (step, formatted turn)
+    tuples, ordered by step.
+    The turns come from the in-memory conversation cache, the database is only read if the cache is empty (cold start).
+    '''
+    if conversation_id is not None:
+        if conversation_id not in conversation_cache:
+            database_writer.flush()
+            conversation_cache.load(conversation_id, load_conversation_turns(conversation_id)[1])
+        return conversation_cache.get_turns(conversation_id)[-(history_steps + 1):]
+
+    if conversation_cache.conversation_id is None:
+        database_writer.flush()
+        with db_lock:
+            conversation_id = conn.execute("SELECT MAX(conversation_id) FROM conversation_history").fetchone()[0]
+        conversation_cache.reset(conversation_id, load_current_turns())
+
+    return conversation_cache.get_turns()[-(history_steps + 1):]
+
+
+def load_current_turns(history_steps=config.HISTORY_STEPS):
+    '''
+    Retrieves the most recent steps of the latest conversation from the database.
+    Returns a list of (step, formatted turn) tuples, ordered by step.
+    '''
     conv_history = []
-    cursor = conn.execute(f"""SELECT 
+    with db_lock:
+        rows = conn.execute(f"""SELECT 
+                            step,
                             human_input_corrected, 
                             ai_response 
                             FROM conversation_history 
@@ -52,24 +316,115 @@ def get_current_history(history_steps=config.HISTORY_STEPS):
                                 FROM (SELECT step FROM conversation_history 
                                 WHERE conversation_id = (SELECT MAX(conversation_id) 
                                 FROM conversation_history)))-{history_steps} 
-                            ORDER BY step""")
+                            ORDER BY step""").fetchall()
 
     # get SQL results and assemble list
-    for row in cursor.fetchall():
-        if row[0] != '':
-            conv_history.append(f'Human: {row[0]}\nAI: {row[1]}')
+    for row in rows:
+        if row[1] != '':
+            conv_history.append((row[0], f'Human: {row[1]}\nAI: {row[2]}'))
 
-    # turn into string
-    conv_history = '\n'.join(conv_history)
     return conv_history
 
 
+def search_history(text, limit=config.SEARCH_RESULTS, include_chatter=True, match_any=False):
+    '''
+    Full-text search over all conversations and (if include_chatter) the background chatter.
+    Returns up to limit dicts with source ("conversation" or "chatter"), conversation_id, step, timestamp,
+    snippet and rank, best match first.
+    '''
+    database_writer.flush()
+    with db_lock:
+        return search(conn, text, limit, include_chatter, match_any)
+
+
+def load_conversation_turns(conversation_id, history_steps=config.HISTORY_STEPS):
+    '''
+    Retrieves the most recent steps of a conversation from the database, using the primary key index.
+    Returns the last step (or None if the conversation doesn't exist) and a list of (step, formatted turn) tuples, ordered by step.
+    '''
+    with db_lock:
+        rows = conn.execute("""SELECT step, human_input_corrected, ai_response FROM conversation_history
+                            WHERE conversation_id = ? ORDER BY step DESC LIMIT ?""",
+                            (conversation_id, history_steps + 1)).fetchall()
+    turns = [(row[0], f'Human: {row[1]}\nAI: {row[2]}') for row in reversed(rows) if row[1] != '']
+    return (rows[0][0] if rows else None), turns
+
+
+def load_summary(conversation_id):
+    '''Returns the running summary of a conversation and the last step it covers, or ("", -1) if there is none.'''
+    with db_lock:
+        row = conn.execute("SELECT summary, summarized_step FROM conversation_summary WHERE conversation_id = ?",
+                           (conversation_id,)).fetchone()
+    summary, summarized_step = (row[0], row[1]) if row is not None else ("", -1)
+    summarized_steps[conversation_id] = summarized_step
+    return summary, summarized_step
+
+
+def save_summary(conversation_id, summarized_step, summary):
+    '''Stores the running summary of a conversation, covering all steps up to summarized_step.'''
+    with db_lock:
+        c.execute("INSERT OR REPLACE INTO conversation_summary (conversation_id, summarized_step, summary) VALUES (?, ?, ?)",
+                  (conversation_id, summarized_step, summary))
+        conn.commit()
+    summarized_steps[conversation_id] = summarized_step
+
+
+def insert_memory(slot, timestamp, source, conversation_id, text):
+    '''Stores the text of a memory in its slot of the vector store, replacing the memory that was there before.'''
+    database_writer.execute("INSERT OR REPLACE INTO memory (slot, timestamp, source, conversation_id, text) VALUES (?, ?, ?, ?, ?)",
+                            (slot, timestamp, source, conversation_id, text))
+
+
+def load_memories(slots):
+    '''Returns a dict of slot: (timestamp, source, conversation_id, text) for the given slots.'''
+    database_writer.flush()
+    with db_lock:
+        rows = conn.execute(f"SELECT slot, timestamp, source, conversation_id, text FROM memory WHERE slot IN ({','.join('?' * len(slots))})",
+                            list(slots)).fetchall()
+    return {row[0]: row[1:] for row in rows}
+
+
 def insert_chatter(timestamp, transcribed_text, listening_mode):
     '''inserts chatter into the database.
     Takes a datetime timestamp, the transcribed text as a string and the current listening mode as a string.'''
-    c.execute("INSERT INTO conversation_history (timestamp, human_input_raw, listening_mode) VALUES (?, ?, ?)",
-              (timestamp, transcribed_text, listening_mode))
-    conn.commit()
+    database_writer.execute("INSERT INTO chatter (timestamp, human_input_raw, listening_mode) VALUES (?, ?, ?)",
+                            (timestamp, transcribed_text, listening_mode))
+
+
+def load_ingested_files():
+    '''Returns {path: (size, mtime)} of the recordings that were ingested already.'''
+    with db_lock:
+        return {path: (size, mtime) for path, size, mtime in conn.execute("SELECT path, size, mtime FROM ingested_file")}
+
+
+def insert_recordings(recordings, listening_mode="recording"):
+    '''Bulk insert of transcribed recordings in one transaction, bypassing the database writer.
+    recordings is a list of (path, size, mtime, duration, [(timestamp, text), ...]) tuples. The transcripts go into
+    the chatter table and each recording into ingested_file, so a recording is either ingested completely or not at all.'''
+    database_writer.flush()
+    ingested_at = time.strftime('%Y-%m-%d %H:%M:%S')
+    with db_lock, conn:
+        for path, size, mtime, duration, transcripts in recordings:
+            # a recording that changed since it was ingested replaces its old transcripts
+            previous = conn.execute("SELECT segments, first_chatter_id FROM ingested_file WHERE path = ?", (path,)).fetchone()
+            if previous is not None:
+                conn.execute("DELETE FROM chatter WHERE chatter_id >= ? AND chatter_id < ?",
+                             (previous[1], previous[1] + previous[0]))
+
+            first_chatter_id = conn.execute("SELECT COALESCE(MAX(chatter_id), 0) + 1 FROM chatter").fetchone()[0]
+            conn.executemany("INSERT INTO chatter (chatter_id, timestamp, human_input_raw, listening_mode) VALUES (?, ?, ?, ?)",
+                             [(first_chatter_id + index, timestamp, text, listening_mode)
+                              for index, (timestamp, text) in enumerate(transcripts)])
+            conn.execute("INSERT OR REPLACE INTO ingested_file (path, size, mtime, duration, segments, first_chatter_id, ingested_at)"
+                         " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (path, size, mtime, duration, len(transcripts), first_chatter_id, ingested_at))
+
+
+def insert_timings(conversation_id, step, timings):
+    '''Stores the (stage, value) pairs of a StepTimer for a conversation step. Stages that are stored again are replaced.'''
+    for stage, value in timings:
+        database_writer.execute("INSERT OR REPLACE INTO step_timing (conversation_id, step, stage, value) VALUES (?, ?, ?, ?)",
+                                (conversation_id, step, stage, value))
 
 
 def insert_conversation(conversation_id, step, timestamp, model, prompt_template, prompt_formatted,
@@ -88,7 +443,7 @@ def insert_conversation(conversation_id, step, timestamp, model, prompt_template
     conv_history: A string of the conversation history.
     listening_mode: The listening mode at the time of the input as a string.
     '''
-    c.execute(
+    database_writer.execute(
         "INSERT INTO conversation_history (conversation_id, step, timestamp, model, prompt_template,"
         " prompt_formatted, human_input_raw, human_input_corrected, llm_output_raw, ai_response, human_emotion, "
         "ai_emotion, intent, action, tool, tool_input, entities, memory, listening_mode)"
@@ -101,27 +456,75 @@ def insert_conversation(conversation_id, step, timestamp, model, prompt_template
          str(llm_output_dict['tool_input']), str(str(llm_output_dict['entities']).lower().replace('"', '')),
          str(conv_history), listening_mode))
 
-    conn.commit()
+    # keep the in-memory history and the snapshot for resuming up to date. The snapshot only holds the turns after
+    # the summarized step, the older ones are covered by the summary that is loaded on resume
+    conversation_cache.append(conversation_id, step, llm_output_dict['human_input'], llm_output_dict['response'].replace('"', ''))
+    summarized_step = summarized_steps.get(conversation_id)
+    if summarized_step is None:
+        summarized_step = load_summary(conversation_id)[1]
+    turns = [turn for turn in conversation_cache.get_turns(conversation_id) if turn[0] > summarized_step]
+    database_writer.execute("INSERT OR REPLACE INTO conversation_snapshot (conversation_id, step, turns) VALUES (?, ?, ?)",
+                            (conversation_id, step, json.dumps(turns)))
+
+
+def resume_conversation(conversation_id="last", announce=True):
+    '''Continues a past conversation, given by its id or "last" for the most recent one.
+    The step counter and the history are restored from the conversation's snapshot, without reading its rows.
+    The snapshot holds the turns after the summarized step, the earlier ones are rebuilt from the conversation's
+    summary by HistoryManager.
+    Conversations from before snapshots existed are loaded once from their most recent rows.
+    Returns the same values as start_new_conversation, which is used instead if the conversation doesn't exist.
+    announce: whether to print info and play a sound.'''
+    database_writer.flush()
+    with db_lock:
+        if conversation_id == "last":
+            conversation_id = conn.execute("SELECT MAX(conversation_id) FROM conversation_history").fetchone()[0]
+        snapshot = conn.execute("SELECT step, turns FROM conversation_snapshot WHERE conversation_id = ?",
+                                (conversation_id,)).fetchone()
+
+    if snapshot is not None:
+        last_step, turns = snapshot[0], [tuple(turn) for turn in json.loads(snapshot[1])]
+    else:
+        last_step, turns = load_conversation_turns(conversation_id)
 
+    if last_step is None:
+        print(config.style.MAGENTA + f"Conversation {conversation_id} doesn't exist, starting a new one" + config.style.RESET)
+        return start_new_conversation(announce)
 
+    conversation_cache.reset(conversation_id, turns)
 
-def start_new_conversation():
+    if announce:
+        play_effect(".//resources//enable_active_mode.wav")
+        print(config.style.MAGENTA + f"Hotword recognized, resuming conversation {conversation_id}. If you want to return to inactive mode, say the endword '{config.ENDWORD}'" + config.style.RESET)
+
+    return last_step + 1, "", "active", conversation_id
+
+
+def start_new_conversation(announce=True):
     '''Sets metadata for a new active conversation.
     Returns the step as 0, an empty conversation history, listening mode set to "active",
-    generates a new conversation_id and prints out info as well as playing a sound.'''
+    generates a new conversation_id and, if announce is set, prints out info as well as playing a sound.'''
+    global last_conversation_id
     step = 0
     conv_history = ""
     listening_mode = "active"
 
     # create new conversation_id, set to 1 if none available
-    try:
-        c.execute('SELECT MAX(conversation_id) FROM conversation_history')
-        conversation_id = int(c.fetchone()[0]) + 1
+    database_writer.flush()
+    with db_lock:
+        try:
+            conversation_id = int(c.execute('SELECT MAX(conversation_id) FROM conversation_history').fetchone()[0]) + 1
+
+        except TypeError:
+            conversation_id = 1
+
+        conversation_id = max(conversation_id, last_conversation_id + 1)
+        last_conversation_id = conversation_id
 
-    except TypeError:
-        conversation_id = 1
+    conversation_cache.reset(conversation_id)
 
-    play_effect(".//resources//enable_active_mode.wav")
-    print(config.style.MAGENTA + f"Hotword recognized, active mode enabled. If you want to return to inactive mode, say the endword '{config.ENDWORD}'" + config.style.RESET)
+    if announce:
+        play_effect(".//resources//enable_active_mode.wav")
+        print(config.style.MAGENTA + f"Hotword recognized, active mode enabled. If you want to return to inactive mode, say the endword '{config.ENDWORD}'" + config.style.RESET)
 
     return step, conv_history, listening_mode, conversation_id
@@ -0,0 +1,102 @@
+'''Handles the conversation history that is put into the prompt'''
+
+from database import load_summary, save_summary
+from pipeline import StageWorker
+import config
+import threading
+
+SUMMARY_PROMPT = """Update the summary of a conversation between a human and an AI friend with the new conversation turns.
+Keep names, facts, preferences and open questions, leave out small talk. Answer with the updated summary only, in at most {max_words} words.
+
+Current summary:
+{summary}
+
+New conversation turns:
+{turns}
+
+Updated summary:"""
+
+
+def estimate_tokens(text, chars_per_token=config.HISTORY_CHARS_PER_TOKEN):
+    '''Cheap token estimate, good enough to keep the prompt within a budget.'''
+    return len(text) // chars_per_token + 1
+
+
+class HistoryManager():
+    '''Keeps the history in the prompt within a token budget.
+    The last verbatim_turns turns are always kept word for word. Once the history exceeds the budget, older turns
+    are folded into a running summary by the LLM on a background thread. The summary is updated incrementally
+    (previous summary + new turns) and stored in the database. Until it is ready, the oldest turns are left out.'''
+
+    def __init__(self, conversation_id, llm, token_budget=config.HISTORY_TOKEN_BUDGET,
+                 verbatim_turns=config.HISTORY_VERBATIM_TURNS):
+        self.conversation_id = conversation_id
+        self.llm = llm
+        self.token_budget = token_budget
+        self.verbatim_turns = verbatim_turns
+        self.summary, self.summarized_step = load_summary(conversation_id)
+        self.summary_pending = False
+        self.lock = threading.Lock()
+
+    def render(self, turns):
+        '''Takes the (step, formatted turn) tuples of the conversation and returns the history string for the prompt.'''
+        with self.lock:
+            summary = self.summary
+            summarized_step = self.summarized_step
+
+        turns = [(step, turn) for step, turn in turns if step > summarized_step]
+        summary_text = f"Summary of the earlier conversation: {summary}\n" if summary else ""
+
+        # keep as many recent turns as fit into the budget, but at least the verbatim ones
+        kept = []
+        used_tokens = estimate_tokens(summary_text)
+        for index, (step, turn) in enumerate(reversed(turns)):
+            used_tokens += estimate_tokens(turn)
+            if used_tokens > self.token_budget and index >= self.verbatim_turns:
+                break
+            kept.append(turn)
+
+        # fold everything older than the verbatim turns into the summary once the budget is exceeded
+        if len(kept) < len(turns) or used_tokens > self.token_budget:
+            self.schedule_summary(turns[:max(0, len(turns) - self.verbatim_turns)])
+
+        return summary_text + '\n'.join(reversed(kept))
+
+    def schedule_summary(self, turns):
+        '''Updates the summary with the given turns on the background worker, unless an update is already running.'''
+        if not turns:
+            return
+        with self.lock:
+            if self.summary_pending:
+                return
+            self.summary_pending = True
+        get_summary_worker().submit(self._update_summary, turns)
+
+    def _update_summary(self, turns):
+        try:
+            prompt = SUMMARY_PROMPT.format(max_words=config.HISTORY_SUMMARY_MAX_WORDS, summary=self.summary or "NA",
+                                           turns='\n'.join(turn for _, turn in turns))
+            summary = self.llm.complete(messages=[{"role": "user", "content": prompt}],
+                                        max_tokens=int(config.HISTORY_SUMMARY_MAX_WORDS * 2),
+                                        temperature=0.2,
+                                        model="gpt-3.5-turbo").choices[0].message.content.strip()
+            summarized_step = turns[-1][0]
+            save_summary(self.conversation_id, summarized_step, summary)
+
+            with self.lock:
+                self.summary = summary
+                self.summarized_step = summarized_step
+        finally:
+            with self.lock:
+                self.summary_pending = False
+
+
+summary_worker = None
+
+
+def get_summary_worker():
+    '''Returns the shared worker that updates running summaries in the background.'''
+    global summary_worker
+    if summary_worker is None:
+        summary_worker = StageWorker("history summarizer")
+    return summary_worker
@@ -0,0 +1,145 @@
+'''Transcribes recorded audio in bulk and stores it as chatter in the database.
+
+Every WAV/MP3 file in a directory (and its subdirectories) is split into utterances at pauses, the utterances are
+transcribed in batches on a pool of processes that each keep one STT model loaded, and the transcripts are inserted
+into the chatter table (listening mode "recording") in large transactions. The timestamp of an utterance is the
+start of the recording plus its offset, where the start is taken from the file's modification time minus its
+duration, as recorders write the file until the recording ends.
+Ingested files are recorded in the ingested_file table together with their size and modification time, so an
+interrupted run can just be started again: finished files are skipped, changed files are ingested again.
+Run: python ingest.py ../recordings [--workers 4]'''
+
+import argparse
+import datetime
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import config
+from stt import STT_SAMPLE_RATE, STTEngine, segment_speech
+
+AUDIO_EXTENSIONS = (".wav", ".mp3")
+
+# the STT engine of a worker process, loaded once by init_worker
+worker_engine = None
+
+
+def find_recordings(directory):
+    '''Returns the paths of all recordings below a directory, sorted.'''
+    paths = []
+    for root, _, files in os.walk(directory):
+        paths += [os.path.join(root, name) for name in files if name.lower().endswith(AUDIO_EXTENSIONS)]
+    return sorted(os.path.abspath(path) for path in paths)
+
+
+def load_recording(path):
+    '''Decodes a recording to a 16 kHz mono float32 array in the range [-1, 1].'''
+    from pydub import AudioSegment
+    audio = AudioSegment.from_file(path).set_channels(1).set_frame_rate(STT_SAMPLE_RATE).set_sample_width(2)
+    return np.frombuffer(audio.raw_data, dtype=np.int16).astype(np.float32) / 32768
+
+
+def init_worker(model_type, model_name, torch_threads):
+    global worker_engine
+    # only the local models run on torch, the API model doesn't need it installed
+    if model_type in ["whisper", "silero"]:
+        import torch
+        torch.set_num_threads(torch_threads)
+    worker_engine = STTEngine(model_type=model_type, model_name=model_name).load()
+
+
+def transcribe_recording(path, batch_size):
+    '''Runs in a worker process. Returns the duration of the recording in seconds and (offset in seconds, text) tuples
+    of its utterances.'''
+    samples = load_recording(path)
+    segments = segment_speech(samples)
+    transcripts = []
+    for index in range(0, len(segments), batch_size):
+        batch = segments[index:index + batch_size]
+        texts = worker_engine.transcribe_batch([samples[start:end] for start, end in batch])
+        transcripts += [(start / STT_SAMPLE_RATE, text.strip()) for (start, _), text in zip(batch, texts) if text.strip()]
+    return len(samples) / STT_SAMPLE_RATE, transcripts
+
+
+def to_rows(path, size, mtime, duration, transcripts):
+    '''Turns the offsets of a recording's transcripts into timestamps, see the module description.'''
+    start = datetime.datetime.fromtimestamp(mtime) - datetime.timedelta(seconds=duration)
+    return (path, size, mtime, duration,
+            [((start + datetime.timedelta(seconds=offset)).strftime('%Y-%m-%d %H:%M:%S'), text) for offset, text in transcripts])
+
+
+def ingest(directory, workers, model_type=config.STT_MODEL_TYPE, model_name=config.STT_MODEL,
+           batch_size=config.STT_BATCH_SIZE, transaction_rows=config.INGEST_TRANSACTION_ROWS):
+    '''Ingests all new or changed recordings below directory. Returns the number of ingested files and utterances.'''
+    from database import connect_to_database, load_ingested_files, insert_recordings
+    connect_to_database()
+
+    ingested = load_ingested_files()
+    pending = []
+    for path in find_recordings(directory):
+        stat = os.stat(path)
+        if ingested.get(path) != (stat.st_size, stat.st_mtime):
+            pending.append((path, stat.st_size, stat.st_mtime))
+    print(config.style.MAGENTA + f"{len(pending)} recordings to ingest" + config.style.RESET)
+
+    # split the CPU threads between the workers instead of letting each of them use all of them
+    torch_threads = max(1, (os.cpu_count() or 1) // workers)
+    files_done = utterances_done = 0
+    buffered = []
+    start_time = time.perf_counter()
+
+    def commit():
+        nonlocal buffered
+        if buffered:
+            insert_recordings(buffered)
+            buffered = []
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(model_type, model_name, torch_threads)) as executor:
+        futures = {executor.submit(transcribe_recording, path, batch_size): (path, size, mtime)
+                   for path, size, mtime in pending}
+        try:
+            for future in as_completed(futures):
+                path, size, mtime = futures[future]
+                try:
+                    duration, transcripts = future.result()
+                except Exception:
+                    traceback.print_exc()
+                    print(f"({path} could not be ingested)")
+                    continue
+
+                buffered.append(to_rows(path, size, mtime, duration, transcripts))
+                files_done += 1
+                utterances_done += len(transcripts)
+                print(f"{files_done}/{len(pending)} {os.path.basename(path)}: {len(transcripts)} utterances, "
+                      f"{duration:.0f} s of audio")
+
+                if sum(len(rows[4]) for rows in buffered) >= transaction_rows:
+                    commit()
+        except KeyboardInterrupt:
+            # keep what is done, the rest is ingested on the next run
+            for future in futures:
+                future.cancel()
+            print(config.style.MAGENTA + "Interrupted, the remaining recordings are ingested on the next run" + config.style.RESET)
+        finally:
+            commit()
+
+    print(config.style.MAGENTA + f"Ingested {files_done} recordings with {utterances_done} utterances "
+          f"in {time.perf_counter() - start_time:.0f} s" + config.style.RESET)
+    return files_done, utterances_done
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory", help="directory with WAV/MP3 recordings")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 1) // 4),
+                        help="number of STT processes, each loads its own model")
+    parser.add_argument("--model-type", default=config.STT_MODEL_TYPE)
+    parser.add_argument("--model", default=config.STT_MODEL)
+    parser.add_argument("--batch-size", type=int, default=config.STT_BATCH_SIZE, help="utterances per STT batch")
+    parser.add_argument("--transaction-rows", type=int, default=config.INGEST_TRANSACTION_ROWS,
+                        help="utterances per database transaction")
+    args = parser.parse_args()
+
+    ingest(args.directory, args.workers, args.model_type, args.model, args.batch_size, args.transaction_rows)
@@ -1,24 +1,171 @@
 '''Handles LLM initialization and prompting'''
 
-from langchain import LLMChain
-from langchain.prompts import PromptTemplate
-from langchain.agents import Tool
 from keys import *
 import config
 
-from langchain.callbacks.manager import CallbackManagerForLLMRun
-from langchain.llms.base import LLM
-import openai
+# langchain, openai and httpx take long to import, so they are only imported when they're needed
+# (or in the background at startup, see initialize_llm)
+import os
+import time
+import threading
+from functools import lru_cache
+import hashlib
+
+
+class GrammarCache():
+    '''Keeps grammar files in memory. A file is only read again if its modification time changed.'''
+
+    def __init__(self):
+        self.grammars = {}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        modified = os.path.getmtime(path)
+        with self.lock:
+            if path not in self.grammars or self.grammars[path][0] != modified:
+                with open(path) as grammar_file:
+                    self.grammars[path] = (modified, grammar_file.read())
+            return self.grammars[path][1]
+
+
+grammar_cache = GrammarCache()
+
+
+def load_grammar(path=config.LLM_GRAMMAR_FILE):
+    '''Returns the content of a grammar file, cached across turns.'''
+    return grammar_cache.get(path)
+
+
+def build_output_grammar(output_keys, emotion_list, tool_names, max_chars):
+    '''Generates a GBNF grammar that only allows the output format of baseline_prompt:
+    the keys in a fixed order and fixed formatting, emotions and tools restricted to their valid values
+    and every other value limited to a single line of at most max_chars[key] characters.'''
+    emotions = " | ".join(f'"{emotion}"' for emotion in emotion_list)
+    tools = " | ".join(f'"{tool}"' for tool in ["NA"] + list(tool_names))
+
+    fields = []
+    rules = []
+    for key in output_keys:
+        rule = key.replace("_", "-")
+        fields.append(f'"\\"{key}\\": " {rule}')
+
+        if key in ["human_emotion", "reaction_emotion"]:
+            rules.append(f'{rule} ::= "\\"" ({emotions}) "\\""')
+        elif key == "tool":
+            rules.append(f'{rule} ::= "\\"" ({tools}) "\\""')
+        elif key in max_chars:
+            rules.append(f'{rule} ::= "\\"" char{{0,{max_chars[key]}}} "\\""')
+        else:
+            rules.append(f'{rule} ::= "\\"" char* "\\""')
+
+    root = 'root ::= "{\\n" ' + ' ",\\n" '.join(fields) + ' "\\n}"'
+    return "\n".join([root] + rules + ['char ::= [^"\\\\\\n]']) + "\n"
+
+
+def grammar_max_tokens(max_chars, chars_per_token=3, structure_tokens=120):
+    '''Returns how many tokens an output under the generated grammar can take when every capped value is at its
+    limit. Values are estimated pessimistically at chars_per_token, structure_tokens covers the keys, the
+    formatting and the emotion and tool values.'''
+    return -(-sum(max_chars.values()) // chars_per_token) + structure_tokens
+
+
+def output_max_tokens():
+    '''Returns max_tokens for LLM requests. With the generated grammar it's raised to what the grammar allows,
+    so an output isn't cut off before the object is closed.'''
+    if config.LLM_GENERATED_GRAMMAR:
+        return max(config.LLM_MAX_TOKENS, grammar_max_tokens(config.LLM_GRAMMAR_MAX_CHARS))
+    return config.LLM_MAX_TOKENS
+
+
+@lru_cache(maxsize=8)
+def get_output_grammar(tool_names=(), emotion_list=tuple(config.EMOTION_LIST), valid_variable_keys=tuple(config.VALID_VARIABLE_KEYS)):
+    '''Returns the generated output grammar for a set of tool names. Grammars are only generated once per set of arguments.'''
+    return build_output_grammar(output_key_order(valid_variable_keys), emotion_list, tool_names, config.LLM_GRAMMAR_MAX_CHARS)
+
+
+class LLMBackend():
+    '''Owns one OpenAI-compatible client for the whole session. The underlying HTTP connection pool keeps
+    connections to the inference server alive between turns. Failed requests (connection errors, timeouts,
+    rate limits and server errors) are retried with exponential backoff.'''
+
+    def __init__(self, api_key=OPENAI_API_KEY, base_url=OPENAI_API_BASE, timeout=config.LLM_TIMEOUT,
+                 max_retries=config.LLM_REQUEST_RETRIES, backoff=config.LLM_RETRY_BACKOFF,
+                 max_connections=config.LLM_MAX_CONNECTIONS):
+        import openai
+        import httpx
+
+        # errors that are worth sending the request again for
+        self.retry_errors = (openai.APIConnectionError, openai.APITimeoutError, openai.RateLimitError, openai.InternalServerError)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.http_client = httpx.Client(
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections,
+                                keepalive_expiry=300))
+        self.client = openai.OpenAI(api_key=api_key, base_url=base_url, timeout=timeout, max_retries=0,
+                                    http_client=self.http_client)
+
+        # keep the interface of the openai client
+        self.chat = self.client.chat
+
+    def complete(self, **request):
+        '''Sends a chat completion request, retrying failed attempts. Takes the arguments of chat.completions.create.'''
+        return self._with_retries(self.client.chat.completions.create, **request)
+
+    def embed(self, texts, model=config.EMBEDDING_MODEL):
+        '''Returns the embeddings of a list of texts as lists of floats, in the same order.'''
+        response = self._with_retries(self.client.embeddings.create, input=list(texts), model=model)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    def _with_retries(self, send, **request):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return send(**request)
+            except self.retry_errors:
+                if attempt == self.max_retries:
+                    raise
+                wait_seconds = self.backoff * 2 ** attempt
+                print(f"LLM request failed, retrying in {wait_seconds:.1f}s ({attempt + 1}/{self.max_retries})")
+                time.sleep(wait_seconds)
+
+    def close(self):
+        self.http_client.close()
+
+
+llm_backend = None
+llm_backend_lock = threading.Lock()
+
+
+def get_llm_backend():
+    '''Returns the shared LLM backend, creating it on first use.'''
+    global llm_backend
+    with llm_backend_lock:
+        if llm_backend is None:
+            llm_backend = LLMBackend()
+    return llm_backend
+
+
+def initialize_llm(model_name=config.LLM_NAME):
+    '''Imports the LLM libraries and opens the backend at startup (meant to run in the background),
+    so the first turn doesn't have to wait for them.'''
+    import langchain.prompts
+    import langchain.agents
+    if "openai" in model_name:
+        get_llm_backend()
 
 
 def llm_chain(model_name=config.LLM_NAME):
-    '''Takes a LLM name as input and returns an instance of the LLMChain class to be used as a model.'''
+    '''Takes a LLM name as input and returns an instance of the LLMChain class to be used as a model.
+    OpenAI-compatible models share one LLMBackend, so repeated calls reuse its connections.'''
     if "openai" in model_name: 
-        return openai.OpenAI(
-            api_key=OPENAI_API_KEY, 
-            base_url=OPENAI_API_BASE)
+        return get_llm_backend()
+
+    from langchain import LLMChain
+    from langchain.prompts import PromptTemplate
 
-    elif model_name == "bard":
+    if model_name == "bard":
+        from langchain.callbacks.manager import CallbackManagerForLLMRun
+        from langchain.llms.base import LLM
         from bardapi import Bard
         from typing import Any, List, Mapping, Optional
         bard = Bard(token_from_browser=True)
@@ -50,30 +197,10 @@ def llm_chain(model_name=config.LLM_NAME):
     return LLMChain(prompt=PromptTemplate(template="{text}", input_variables=["text"]), llm=model_name)
 
 
-def baseline_prompt(transcribed_text, tools="", tool_descriptions="", conv_history="", repair_attempt=False, emotion_list=config.EMOTION_LIST, valid_variable_keys= config.VALID_VARIABLE_KEYS):
-    '''Defines a prompt template that is used to interact with the LLM. It takes a transcribed text string, a list of tools,
-    a tool descriptions string, a conversation history string, and a list of emotions as inputs.
-    Returns a raw prompt template, a formatted prompt string and a list of valid variable keys.
-    This function also defines the desired output format of the LLM.'''
-
-    # Describe the setting to the LLM
-    PROMPT_MODE = "The following is a conversation between a human and an AI friend. You are the AI friend and respond like a humorous and friendly human. The human input may have transcription errors and require correction."
-    
-    # Desired output format
-    PROMPT_OUTPUT_SPECS = f"""Format all of your output as json and strictly stick to the following variable names and structure. If a variable doesn't apply or is unclear/unknown, set it as NA. Avoid non-alphanumeric characters:
-{{
-"{valid_variable_keys[0]}": raw current human input, correct possible transcription errors if necessary,
-"{valid_variable_keys[1]}": human input emotion, must be one of {emotion_list},
-"{valid_variable_keys[2]}": expected emotion of another human in reaction to the human input, must be one of {emotion_list},
-"{valid_variable_keys[3]}": intent of the human input,
-"{valid_variable_keys[4]}": action for the AI,
-"{valid_variable_keys[5]}": required tool for the action (if any, must be one of {[tool.name for tool in tools]},
-"{valid_variable_keys[6]}": input for the tool (if any),
-"{valid_variable_keys[7]}": verbal response to human input in tone of reaction_emotion, should not be longer than necessary. If using a tool, briefly explain what you will do,
-"{valid_variable_keys[8]}": entities or places mentioned by the human or ai.
-}}"""
-
-    PROMPT_OUTPUT_SPECS_GUIDANCE = '''
+# Describe the setting to the LLM
+PROMPT_MODE = "The following is a conversation between a human and an AI friend. You are the AI friend and respond like a humorous and friendly human. The human input may have transcription errors and require correction."
+
+PROMPT_OUTPUT_SPECS_GUIDANCE = '''
 ```json
 {
     human_input: {{human_input}},
@@ -89,8 +216,73 @@ def baseline_prompt(transcribed_text, tools="", tool_descriptions="", conv_histo
 ```
 '''
 
+
+class PrefixPromptTemplate():
+    '''Prompt template made of a static prefix and a suffix template that is formatted every turn.
+    The prefix is byte-identical across turns, so inference servers can keep it in their KV/prompt cache.
+    cache_key identifies the prefix and changes whenever its content does.'''
+
+    def __init__(self, prefix, suffix_template):
+        self.prefix = prefix
+        self.suffix_template = suffix_template
+        self.cache_key = hashlib.sha1(prefix.encode()).hexdigest()[:16]
+
+    def format(self, **kwargs):
+        return self.prefix + self.suffix_template.format(**kwargs)
+
+    def __str__(self):
+        return self.prefix + self.suffix_template
+
+
+@lru_cache(maxsize=8)
+def output_specs(tool_names=(), emotion_list=tuple(config.EMOTION_LIST), valid_variable_keys=tuple(config.VALID_VARIABLE_KEYS)):
+    '''Returns the description of the desired output format, with the keys in the order the LLM should generate them.'''
+    emotion_list = list(emotion_list)
+    key_descriptions = {
+        "human_input": "raw current human input, correct possible transcription errors if necessary",
+        "human_emotion": f"human input emotion, must be one of {emotion_list}",
+        "reaction_emotion": f"expected emotion of another human in reaction to the human input, must be one of {emotion_list}",
+        "intent": "intent of the human input",
+        "action": "action for the AI",
+        "tool": f"required tool for the action (if any, must be one of {list(tool_names)}",
+        "tool_input": "input for the tool (if any)",
+        "response": "verbal response to human input in tone of reaction_emotion, should not be longer than necessary. If using a tool, briefly explain what you will do",
+        "entities": "entities or places mentioned by the human or ai",
+    }
+    output_keys = output_key_order(valid_variable_keys)
+    return """Format all of your output as json and strictly stick to the following variable names and structure. If a variable doesn't apply or is unclear/unknown, set it as NA. Avoid non-alphanumeric characters:
+{
+""" + ",\n".join(f'"{key}": {key_descriptions.get(key, key.replace("_", " "))}' for key in output_keys) + """.
+}"""
+
+
+@lru_cache(maxsize=8)
+def get_prompt_template(tool_descriptions="", tool_names=(), emotion_list=tuple(config.EMOTION_LIST),
+                        valid_variable_keys=tuple(config.VALID_VARIABLE_KEYS)):
+    '''Returns the conversation prompt template. All static content is put into the prefix, which is only built once.'''
+    prefix = f"""{PROMPT_MODE}\n
+You have access to the following tools: {tool_descriptions}\n
+{output_specs(tool_names, emotion_list, valid_variable_keys)}
+"""
+    suffix_template = """{memories}History of ongoing conversation: \n{conv_history}\n
+Raw current human input: {transcribed_text}\n
+"""
+    return PrefixPromptTemplate(prefix, suffix_template)
+
+
+def baseline_prompt(transcribed_text, tools="", tool_descriptions="", conv_history="", repair_attempt=False, emotion_list=config.EMOTION_LIST, valid_variable_keys= config.VALID_VARIABLE_KEYS, memories=""):
+    '''Defines a prompt template that is used to interact with the LLM. It takes a transcribed text string, a list of tools,
+    a tool descriptions string, a conversation history string, and a list of emotions as inputs.
+    memories is an optional section with memories of earlier conversations (see memory.format_memories).
+    Returns a raw prompt template, a formatted prompt string and a list of valid variable keys.
+    This function also defines the desired output format of the LLM.
+    The static part of the prompt (setting, tools and output format) comes first and is identical across turns,
+    history and human input are only appended to it (see PrefixPromptTemplate).'''
+    tool_names = tuple(tool.name for tool in tools)
+
     # Stitch the specifications together
     if repair_attempt:
+        PROMPT_OUTPUT_SPECS = output_specs(tool_names, tuple(emotion_list), tuple(valid_variable_keys))
         PROMPT_TEMPLATE = \
 """You have to fix an AI generated chatbot answer. \n
 Here is a wrongly parametrized AI generated answer of a chatbot:
@@ -102,6 +294,7 @@ To be parsed correctly, the answer needs to be a python dictionary strictly in t
 {PROMPT_OUTPUT_SPECS}"""
 
         # Creates a langchain PromptTemplate
+        from langchain.prompts import PromptTemplate
         prompt = PromptTemplate(
             input_variables=["PROMPT_OUTPUT_SPECS", "transcribed_text"],
             template=PROMPT_TEMPLATE)
@@ -110,33 +303,30 @@ To be parsed correctly, the answer needs to be a python dictionary strictly in t
         #print("Repair prompt: --------- \n" + prompt_formatted)
 
     else:
-        PROMPT_TEMPLATE = \
-"""{PROMPT_MODE}\n
-You have access to the following tools: {tool_descriptions}\n
-{PROMPT_OUTPUT_SPECS}
-History of ongoing conversation: \n{conv_history}\n
-Raw current human input: {transcribed_text}\n
-"""
-
-        # Creates a langchain PromptTemplate
-        prompt = PromptTemplate(
-            input_variables=["PROMPT_MODE", "PROMPT_OUTPUT_SPECS", "conv_history", "transcribed_text",
-                             "tool_descriptions"],
-            template=PROMPT_TEMPLATE)
+        # the template is cached, only history and input are formatted every turn
+        prompt = get_prompt_template(tool_descriptions, tool_names, tuple(emotion_list), tuple(valid_variable_keys))
+        prompt_formatted = prompt.format(memories=memories, conv_history=conv_history, transcribed_text=transcribed_text)
 
-        # Assemble the fully formatted prompt based on input
-        prompt_formatted = prompt.format(PROMPT_MODE=PROMPT_MODE, PROMPT_OUTPUT_SPECS=PROMPT_OUTPUT_SPECS,
-                                         conv_history=conv_history, transcribed_text=transcribed_text,
-                                         tool_descriptions=tool_descriptions)
+    return prompt, prompt_formatted
 
 
-    return prompt, prompt_formatted
+def output_key_order(valid_variable_keys=config.VALID_VARIABLE_KEYS, response_early=config.LLM_RESPONSE_EARLY):
+    '''Returns the output keys in the order the LLM should generate them.
+    If response_early is set, "response" directly follows "reaction_emotion" (its tone depends on it),
+    so a streamed response can be spoken before the remaining keys are generated.'''
+    output_keys = list(valid_variable_keys)
+    if response_early and "response" in output_keys and "reaction_emotion" in output_keys:
+        output_keys.remove("response")
+        output_keys.insert(output_keys.index("reaction_emotion") + 1, "response")
+    return output_keys
 
 
 def initialize_tools():
     '''
     Returns a list of tools available to the LLM and functions bound to them and a string that describes the tools.
     '''
+    from langchain.agents import Tool
+
     # set available tools
     tools = [
         Tool(
@@ -0,0 +1,172 @@
+'''Handles the long-term memory of past conversations and background chatter'''
+
+from database import insert_memory, load_memories
+from pipeline import StageWorker
+from llm import get_llm_backend
+import numpy as np
+import config
+import threading
+import json
+import os
+
+# number of set bits for every byte value, used for Hamming distances between sketches
+POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+class VectorStore():
+    '''Fixed-size store of normalized embeddings in memory-mapped files, so nothing has to be re-embedded or loaded
+    into memory at startup. Once capacity is reached, the oldest vectors are overwritten (ring buffer).
+
+    For the approximate nearest-neighbour search, every vector also gets a sketch of sketch_bits random hyperplane
+    signs (SimHash). Sketches are compared by Hamming distance, which approximates the angle between the vectors,
+    and only the closest candidates are compared exactly. Adding a vector only writes its own slot, so the index is
+    updated incrementally.
+
+    Files in directory: index.json (dimensions, count, ...), vectors.f16 (float16, capacity x dimensions)
+    and sketches.u8 (capacity x sketch_bits / 8).'''
+
+    def __init__(self, directory=config.MEMORY_DIRECTORY, capacity=config.MEMORY_CAPACITY, sketch_bits=64, seed=0):
+        self.directory = directory
+        self.capacity = capacity
+        self.sketch_bits = sketch_bits
+        self.seed = seed
+        self.dimensions = None
+        self.count = 0
+        self.lock = threading.Lock()
+
+        header_path = os.path.join(directory, "index.json")
+        if os.path.exists(header_path):
+            with open(header_path) as header_file:
+                header = json.load(header_file)
+            if (header["capacity"], header["sketch_bits"], header["seed"]) == (capacity, sketch_bits, seed):
+                self._open(header["dimensions"], "r+")
+                self.count = header["count"]
+            else:
+                print(config.style.MAGENTA + "The memory settings changed, starting with an empty memory" + config.style.RESET)
+
+    @property
+    def size(self):
+        return min(self.count, self.capacity)
+
+    def _open(self, dimensions, mode):
+        self.dimensions = dimensions
+        self.vectors = np.memmap(os.path.join(self.directory, "vectors.f16"), dtype=np.float16, mode=mode,
+                                 shape=(self.capacity, dimensions))
+        self.sketches = np.memmap(os.path.join(self.directory, "sketches.u8"), dtype=np.uint8, mode=mode,
+                                  shape=(self.capacity, self.sketch_bits // 8))
+        self.planes = np.random.default_rng(self.seed).standard_normal((self.sketch_bits, dimensions)).astype(np.float32)
+
+    def _save_header(self):
+        header_path = os.path.join(self.directory, "index.json")
+        with open(header_path + ".tmp", "w") as header_file:
+            json.dump({"dimensions": self.dimensions, "capacity": self.capacity, "sketch_bits": self.sketch_bits,
+                       "seed": self.seed, "count": self.count}, header_file)
+        os.replace(header_path + ".tmp", header_path)
+
+    def _sketch(self, vectors):
+        return np.packbits(vectors @ self.planes.T > 0, axis=-1)
+
+    def add(self, vector):
+        '''Stores a vector and returns its slot.'''
+        vector = np.asarray(vector, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1
+
+        with self.lock:
+            if self.dimensions != len(vector):
+                if self.dimensions is not None:
+                    print(config.style.MAGENTA + "The embedding size changed, starting with an empty memory" + config.style.RESET)
+                os.makedirs(self.directory, exist_ok=True)
+                self._open(len(vector), "w+")
+                self.count = 0
+
+            slot = self.count % self.capacity
+            self.vectors[slot] = vector
+            self.sketches[slot] = self._sketch(vector)
+            self.vectors.flush()
+            self.sketches.flush()
+
+            # the count is only increased once the slot is written, so a crash can't leave a half written vector
+            self.count += 1
+            self._save_header()
+        return slot
+
+    def search(self, vector, k, candidates=config.MEMORY_CANDIDATES):
+        '''Returns up to k (cosine similarity, slot) tuples of the nearest vectors, most similar first.'''
+        vector = np.asarray(vector, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1
+
+        with self.lock:
+            size = self.size
+            if size == 0 or self.dimensions != len(vector):
+                return []
+
+            # preselect candidates by the Hamming distance of their sketches, unless the store is small
+            if size > candidates:
+                distances = POPCOUNT[self.sketches[:size] ^ self._sketch(vector)].sum(axis=1, dtype=np.uint16)
+                slots = np.argpartition(distances, candidates)[:candidates]
+            else:
+                slots = np.arange(size)
+            similarities = self.vectors[slots].astype(np.float32) @ vector
+
+        best = np.argsort(-similarities)[:k]
+        return [(float(similarities[i]), int(slots[i])) for i in best]
+
+
+class LongTermMemory():
+    '''Remembers finished turns and chatter across conversations and recalls the ones most similar to the human input.
+    Texts are embedded and stored on a background worker, the texts themselves are kept in the database.'''
+
+    def __init__(self, store=None, backend=None):
+        self.store = store if store is not None else VectorStore()
+        self.backend = backend if backend is not None else get_llm_backend()
+        self.worker = StageWorker("memory worker")
+
+    def remember(self, text, timestamp, source, conversation_id=None):
+        '''Adds a text to the memory in the background. source is "conversation" or "chatter".'''
+        if text.strip() != "":
+            self.worker.submit(self._remember, text, timestamp, source, conversation_id)
+
+    def _remember(self, text, timestamp, source, conversation_id):
+        vector = self.backend.embed([text])[0]
+        slot = self.store.add(vector)
+        insert_memory(slot, timestamp, source, conversation_id, text)
+
+    def recall(self, text, exclude_conversation=None, k=config.MEMORY_RESULTS, min_similarity=config.MEMORY_MIN_SIMILARITY):
+        '''Returns up to k (timestamp, source, text) tuples of memories similar to the text, most similar first.
+        Memories of exclude_conversation are left out, since they are already part of the history.'''
+        if self.store.size == 0 or text.strip() == "":
+            return []
+
+        # ask for more neighbours than needed, some may belong to the current conversation
+        matches = [slot for similarity, slot in self.store.search(self.backend.embed([text])[0], k * 3)
+                   if similarity >= min_similarity]
+        if not matches:
+            return []
+
+        rows = load_memories(matches)
+        memories = []
+        for slot in matches:
+            if slot in rows and (exclude_conversation is None or rows[slot][2] != exclude_conversation):
+                timestamp, source, _, memory_text = rows[slot]
+                memories.append((timestamp, source, memory_text))
+        return memories[:k]
+
+
+def format_memories(memories):
+    '''Returns the memories as a prompt section, or an empty string if there are none.'''
+    if not memories:
+        return ""
+    lines = [f"({timestamp}, {'overheard' if source == 'chatter' else 'conversation'}) {text}"
+             for timestamp, source, text in memories]
+    return "Memories from earlier conversations: \n" + "\n".join(lines) + "\n\n"
+
+
+long_term_memory = None
+
+
+def get_memory():
+    '''Returns the shared long-term memory, creating it on first use.'''
+    global long_term_memory
+    if long_term_memory is None:
+        long_term_memory = LongTermMemory()
+    return long_term_memory
@@ -0,0 +1,403 @@
+'''Handles audio I/O with remote speaker/microphone nodes over MQTT using one long-lived client.
+
+Binary messages consist of a small header followed by mono int16 little-endian PCM:
+    magic b"LB" | version (1 byte) | message type (1 byte) | request id (uint32) | sample rate (uint32)
+The server publishes requests on COMMAND_TOPIC, the remote node answers with the same request id on
+ACK_TOPIC (played audio) or AUDIO_TOPIC (recorded audio).
+In streaming mode (config.MQTT_STREAMING), audio is split into AUDIO_CHUNK messages whose payload starts with a
+uint32 sequence number, followed by an END_OF_STREAM message carrying the number of chunks as its sequence number.
+A remote speaker can start playing on the first chunk and acknowledges after END_OF_STREAM. A REQUEST_AUDIO with
+the payload b"\x01" asks the remote microphone to stream its recording the same way.
+Remote nodes still using the old JSON/base64 protocol are supported by setting config.MQTT_BINARY_AUDIO to False.
+In the multi-session server (server.py), every device uses the same topics below its own prefix
+("lachsbuddy/<client id>/system/client-io" etc.) and announces itself by publishing its client id on SESSION_TOPIC.'''
+
+import numpy as np
+import config
+import threading
+import itertools
+import struct
+import queue
+import base64
+import json
+import time
+
+COMMAND_TOPIC = "system/client-io"
+ACK_TOPIC = "system/io-client"
+AUDIO_TOPIC = "speech/io-client"
+SESSION_TOPIC = "lachsbuddy/sessions"
+
+HEADER = struct.Struct("!2sBBII")
+MAGIC = b"LB"
+PROTOCOL_VERSION = 1
+
+# message types
+PLAY_AUDIO = 1
+REQUEST_AUDIO = 2
+AUDIO = 3
+ACK = 4
+AUDIO_CHUNK = 5
+END_OF_STREAM = 6
+
+SEQUENCE = struct.Struct("!I")
+
+
+class RequestCancelled(Exception):
+    '''Raised in callers waiting for a response once the transport is closed.'''
+
+
+class Message():
+    '''A decoded MQTT message. Messages using the old protocol have no header, their request_id is None.'''
+
+    def __init__(self, message_type, request_id, sample_rate, payload, sequence=None):
+        self.message_type = message_type
+        self.request_id = request_id
+        self.sample_rate = sample_rate
+        self.payload = payload
+        self.sequence = sequence
+
+
+def pack_message(message_type, request_id, payload=b"", sample_rate=0):
+    '''Returns the binary representation of a message.'''
+    return HEADER.pack(MAGIC, PROTOCOL_VERSION, message_type, request_id, sample_rate) + payload
+
+
+def unpack_message(data):
+    '''Decodes a binary message, returns None if the data doesn't start with a valid header.'''
+    if len(data) < HEADER.size or data[:2] != MAGIC:
+        return None
+    _, _, message_type, request_id, sample_rate = HEADER.unpack_from(data)
+    payload = data[HEADER.size:]
+
+    # stream messages carry their sequence number in front of the audio
+    if message_type in (AUDIO_CHUNK, END_OF_STREAM):
+        return Message(message_type, request_id, sample_rate, payload[SEQUENCE.size:], SEQUENCE.unpack_from(payload)[0])
+    return Message(message_type, request_id, sample_rate, payload)
+
+
+def pack_stream_message(message_type, request_id, sequence, payload=b"", sample_rate=0):
+    '''Returns the binary representation of an AUDIO_CHUNK or END_OF_STREAM message.'''
+    return pack_message(message_type, request_id, SEQUENCE.pack(sequence) + payload, sample_rate)
+
+
+class MQTTTransport():
+    '''Keeps one connection to the broker open and correlates requests with their responses.
+    Each request gets a request id, responses are routed back to the waiting caller by that id.
+    Responses without a header (old protocol) are handed to the oldest request waiting on that topic.
+    topic_prefix is put in front of every topic, so several devices can share one broker.
+    Waiting callers check every poll_interval seconds whether the transport was closed and raise RequestCancelled then.'''
+
+    poll_interval = 0.5
+
+    def __init__(self, broker_address=config.BROKER_ADDRESS, broker_port=config.BROKER_PORT,
+                 binary_audio=config.MQTT_BINARY_AUDIO, timeout=config.MQTT_TIMEOUT, client=None, topic_prefix=""):
+        self.broker_address = broker_address
+        self.command_topic = topic_prefix + COMMAND_TOPIC
+        self.ack_topic = topic_prefix + ACK_TOPIC
+        self.audio_topic = topic_prefix + AUDIO_TOPIC
+        self.broker_port = broker_port
+        self.binary_audio = binary_audio
+        self.timeout = timeout
+        if client is None:
+            # paho is only needed if MQTT is used
+            import paho.mqtt.client as mqtt
+            client = mqtt.Client()
+        self.client = client
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+        self.connected = threading.Event()
+        self.lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+
+        # request id -> (response topic, queue the response is put into)
+        self.pending = {}
+        # request id -> published request, for requests without any response yet (see resend_pending)
+        self.unanswered = {}
+        self.closed = threading.Event()
+
+    def connect(self):
+        '''Connects to the broker and starts the network loop on a background thread.'''
+        self.client.connect(self.broker_address, self.broker_port, keepalive=60)
+        self.client.loop_start()
+        if not self.connected.wait(self.timeout):
+            raise Exception(f"Could not connect to the MQTT broker at {self.broker_address}:{self.broker_port}")
+        return self
+
+    def close(self):
+        '''Disconnects from the broker. Callers still waiting for a response get a RequestCancelled.'''
+        self.closed.set()
+        self.client.loop_stop()
+        self.client.disconnect()
+
+    def resend_pending(self):
+        '''Publishes the requests that didn't get any response yet again, e.g. after the device restarted and lost them.'''
+        with self.lock:
+            requests = list(self.unanswered.values())
+        for payload in requests:
+            self.publish(payload)
+
+    def wait_response(self, responses, timeout=None):
+        '''Returns the next response from a queue of register(), raises queue.Empty after timeout seconds
+        (None waits as long as it takes).'''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self.closed.is_set():
+                raise RequestCancelled("The MQTT transport was closed")
+
+            wait = self.poll_interval if deadline is None else min(self.poll_interval, deadline - time.monotonic())
+            if wait <= 0:
+                raise queue.Empty
+            try:
+                return responses.get(timeout=wait)
+            except queue.Empty:
+                pass
+
+    def _on_connect(self, client, userdata, flags, rc):
+        # (re)subscribe on every connect so a reconnect keeps receiving responses
+        client.subscribe([(self.ack_topic, 0), (self.audio_topic, 0)])
+        self.connected.set()
+
+    def _on_message(self, client, userdata, message):
+        decoded = unpack_message(message.payload) if self.binary_audio else None
+
+        with self.lock:
+            if decoded is not None:
+                request_id = decoded.request_id
+            else:
+                decoded = Message(None, None, None, message.payload)
+                request_id = next((request_id for request_id in sorted(self.pending)
+                                   if self.pending[request_id][0] == message.topic), None)
+            waiting = self.pending.get(request_id)
+            # the device got the request, so it isn't sent again
+            self.unanswered.pop(request_id, None)
+
+        if waiting is not None:
+            waiting[1].put(decoded)
+
+    def register(self, response_topic):
+        '''Reserves a request id. Returns it with the queue that responses for it will be put into.'''
+        request_id = next(self.request_ids)
+        responses = queue.Queue()
+        with self.lock:
+            self.pending[request_id] = (response_topic, responses)
+        return request_id, responses
+
+    def unregister(self, request_id):
+        with self.lock:
+            self.pending.pop(request_id, None)
+            self.unanswered.pop(request_id, None)
+
+    def publish(self, payload):
+        self.client.publish(self.command_topic, payload)
+
+    def publish_request(self, request_id, payload):
+        '''Publishes a request that can be sent again with resend_pending until its first response arrives.'''
+        with self.lock:
+            self.unanswered[request_id] = payload
+        self.publish(payload)
+
+    def request(self, payload, response_topic, message_type=None, sample_rate=0, timeout=None):
+        '''Publishes a request on the command topic and blocks until the matching response arrives.
+        payload is sent as is in the old protocol and wrapped into a binary message otherwise.'''
+        request_id, responses = self.register(response_topic)
+
+        try:
+            if self.binary_audio:
+                payload = pack_message(message_type, request_id, payload, sample_rate)
+            self.publish_request(request_id, payload)
+            return self.wait_response(responses, timeout)
+
+        except queue.Empty:
+            raise TimeoutError(f"No response from the MQTT client on {response_topic}")
+
+        finally:
+            self.unregister(request_id)
+
+    def play_audio(self, samples, sample_rate):
+        '''Sends int16 samples to the remote speaker and waits for its confirmation. Returns the confirmation text.'''
+        if self.binary_audio:
+            payload = samples.astype('<i2').tobytes()
+        else:
+            float_samples = samples.astype(np.float32) / 32768
+            payload = json.dumps({"PLAY AUDIO": base64.b64encode(float_samples.tobytes()).decode()})
+
+        confirmation = self.request(payload, self.ack_topic, message_type=PLAY_AUDIO, sample_rate=sample_rate,
+                                    timeout=self.timeout + len(samples) / sample_rate)
+        return confirmation.payload.decode(errors="replace")
+
+    def open_playback_stream(self, sample_rate, chunk_samples=config.MQTT_CHUNK_SAMPLES):
+        '''Returns a PlaybackStream that sends audio to the remote speaker chunk by chunk.'''
+        return PlaybackStream(self, sample_rate, chunk_samples)
+
+    def stream_audio(self):
+        '''Asks the remote microphone for a streamed recording. Yields the int16 PCM chunks in order
+        together with their sample rate as they arrive, and returns after the end of the stream.
+        Out of order chunks are held back until the missing ones arrive.'''
+        request_id, responses = self.register(self.audio_topic)
+        chunks = {}
+        next_sequence = 0
+        chunk_count = None
+        timeout = None
+
+        try:
+            self.publish_request(request_id, pack_message(REQUEST_AUDIO, request_id, b"\x01"))
+            while chunk_count is None or next_sequence < chunk_count:
+                try:
+                    message = self.wait_response(responses, timeout)
+                except queue.Empty:
+                    raise TimeoutError("The MQTT audio stream stalled")
+
+                # the remote microphone may still answer with a single recording
+                if message.message_type == AUDIO:
+                    yield message.payload, message.sample_rate
+                    return
+
+                if message.message_type == AUDIO_CHUNK:
+                    chunks[message.sequence] = message
+                elif message.message_type == END_OF_STREAM:
+                    chunk_count = message.sequence
+
+                while next_sequence in chunks:
+                    chunk = chunks.pop(next_sequence)
+                    yield chunk.payload, chunk.sample_rate
+                    next_sequence += 1
+
+                # once the stream has started, gaps between chunks are limited
+                timeout = self.timeout
+        finally:
+            self.unregister(request_id)
+
+    def request_audio(self, streaming=config.MQTT_STREAMING):
+        '''Asks the remote microphone for a recording and waits for it, however long the speaker talks.
+        Returns the raw frame data, its sample rate and sample width in bytes. Raises RequestCancelled if the
+        transport is closed while waiting.'''
+        if self.binary_audio and streaming:
+            frames = []
+            sample_rate = 16000
+            for frame_data, sample_rate in self.stream_audio():
+                frames.append(frame_data)
+            return b"".join(frames), sample_rate, 2
+
+        if self.binary_audio:
+            recording = self.request(b"", self.audio_topic, message_type=REQUEST_AUDIO)
+            return recording.payload, recording.sample_rate, 2
+
+        recording = self.request(json.dumps({"REQUESTING AUDIO": ""}), self.audio_topic)
+        return recording.payload, 16000, 1
+
+
+class PlaybackStream():
+    '''Sends audio to the remote speaker as sequence-numbered chunks under one request id.
+    write() can be called repeatedly (e.g. once per sentence), close() sends the end-of-stream marker
+    and waits for the speaker's confirmation.'''
+
+    def __init__(self, transport, sample_rate, chunk_samples=config.MQTT_CHUNK_SAMPLES):
+        self.transport = transport
+        self.sample_rate = sample_rate
+        self.chunk_samples = chunk_samples
+        self.request_id, self.responses = transport.register(transport.ack_topic)
+        self.sequence = 0
+        self.seconds_sent = 0
+
+    def write(self, samples):
+        '''Sends int16 samples in chunks of chunk_samples.'''
+        samples = samples.astype('<i2')
+        for start in range(0, len(samples), self.chunk_samples):
+            chunk = samples[start:start + self.chunk_samples].tobytes()
+            self.transport.publish(pack_stream_message(AUDIO_CHUNK, self.request_id, self.sequence, chunk, self.sample_rate))
+            self.sequence += 1
+        self.seconds_sent += len(samples) / self.sample_rate
+
+    def close(self):
+        '''Marks the end of the stream and waits until the speaker confirms it. Returns the confirmation text.'''
+        try:
+            self.transport.publish(pack_stream_message(END_OF_STREAM, self.request_id, self.sequence, b"", self.sample_rate))
+            confirmation = self.transport.wait_response(self.responses, self.transport.timeout + self.seconds_sent)
+            return confirmation.payload.decode(errors="replace")
+
+        except queue.Empty:
+            raise TimeoutError("No confirmation from the MQTT speaker")
+
+        finally:
+            self.transport.unregister(self.request_id)
+
+
+class LoopbackMessage():
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class LoopbackBroker():
+    '''In-process stand-in for an MQTT broker, e.g. to run the transport without Mosquitto.
+    Messages are delivered to subscribed LoopbackClients on a background thread, like a network loop would.'''
+
+    def __init__(self):
+        self.subscriptions = []
+        self.lock = threading.Lock()
+        self.deliveries = queue.Queue()
+        threading.Thread(target=self._deliver_loop, daemon=True).start()
+
+    def client(self):
+        return LoopbackClient(self)
+
+    def subscribe(self, client, topic):
+        with self.lock:
+            self.subscriptions.append((client, topic))
+
+    def publish(self, topic, payload):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.deliveries.put(LoopbackMessage(topic, payload))
+
+    def _deliver_loop(self):
+        while True:
+            message = self.deliveries.get()
+            with self.lock:
+                receivers = [client for client, topic in self.subscriptions if topic == message.topic]
+            for client in receivers:
+                if client.on_message is not None:
+                    client.on_message(client, None, message)
+
+
+class LoopbackClient():
+    '''Implements the part of the paho client interface used by MQTTTransport on top of a LoopbackBroker.'''
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.on_connect = None
+        self.on_message = None
+
+    def connect(self, host=None, port=None, keepalive=60):
+        if self.on_connect is not None:
+            self.on_connect(self, None, {}, 0)
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def subscribe(self, topic, qos=0):
+        topics = topic if isinstance(topic, list) else [(topic, qos)]
+        for name, _ in topics:
+            self.broker.subscribe(self, name)
+
+    def publish(self, topic, payload=None, qos=0):
+        self.broker.publish(topic, payload)
+
+
+mqtt_transport = None
+mqtt_transport_lock = threading.Lock()
+
+
+def get_mqtt_transport():
+    '''Returns the shared MQTT transport, connecting it on first use.'''
+    global mqtt_transport
+    with mqtt_transport_lock:
+        if mqtt_transport is None:
+            mqtt_transport = MQTTTransport().connect()
+    return mqtt_transport
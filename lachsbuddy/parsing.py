@@ -0,0 +1,214 @@
+'''Handles parsing of the structured LLM output'''
+
+from functools import lru_cache
+import config
+import json
+import re
+
+# escape sequences inside double quoted values, other backslashes are kept as they are
+JSON_ESCAPE = re.compile(r'\\(u[0-9a-fA-F]{4}|["\\/bfnrt])')
+JSON_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+# start of a value that may still turn into a type hint (str = ...)
+UNFINISHED_PREFIX = re.compile(r'(?:s|st|str|l|li|lis|list)\s*')
+
+# end of an unfinished value that may still turn out to be an artifact: whitespace, commas, braces, quotes and
+# incomplete escape sequences
+HELD_END = re.compile(r'(?:[\s,}`"\']|\\+(?:u[0-9a-fA-F]{0,3})?)+$')
+
+
+class StreamingFieldExtractor():
+    '''Incrementally parses the structured output while it is being generated.
+    Text is passed in with feed() as the tokens arrive. The fields are split at the keys found by key_pattern, just
+    like scan_fields does, and all fields that are complete so far are collected in self.fields. The text of one
+    watched field (by default "response") is passed to on_text as soon as it can't change anymore, so e.g. TTS can
+    start before the rest of the output exists. A value only ends where the next key starts, so the end of the text
+    is held back while it may still be the start of a key or an artifact that scan_fields strips. The text passed to
+    on_text adds up to the value that parse_structured_output returns, a value of NA is not passed on at all.'''
+
+    def __init__(self, field="response", on_text=None, valid_variable_keys=tuple(config.VALID_VARIABLE_KEYS)):
+        self.field = field
+        self.on_text = on_text
+        self.pattern = key_pattern(tuple(valid_variable_keys))
+        self.partial_key = partial_key_pattern(tuple(valid_variable_keys))
+        self.text = ""
+        self.fields = {}
+        self.last_key = None
+        self.scan_position = 0
+        self.value_start = None
+        self.emitted = ""
+
+    @property
+    def field_complete(self):
+        return self.field in self.fields
+
+    def feed(self, text):
+        '''Processes the next piece of generated text.'''
+        self.text += text
+
+        # a key at the very end may still be followed by more whitespace, it is found again on the next call
+        for match in self.pattern.finditer(self.text, self.scan_position):
+            if match.end() == len(self.text):
+                break
+            self._finish_value(match.start())
+            self.last_key = match.group(1).lower().replace(' ', '_')
+            self.scan_position = match.end()
+            if self.last_key == self.field and self.value_start is None:
+                self.value_start = match.end()
+
+        if self.value_start is not None and not self.field_complete:
+            self._emit(self._settled_value())
+
+    def finish(self):
+        '''Completes a value that was cut off at the end of the output (e.g. by a stopping string).'''
+        match = self.pattern.search(self.text, self.scan_position)
+        if match is not None:
+            self._finish_value(match.start())
+            self.last_key = match.group(1).lower().replace(' ', '_')
+            self.scan_position = match.end()
+            if self.last_key == self.field and self.value_start is None:
+                self.value_start = match.end()
+        self._finish_value(len(self.text))
+        return self.fields
+
+    def _finish_value(self, end):
+        '''Stores the value of the current key, which ends at end.'''
+        if self.last_key is None:
+            return
+        self.fields.setdefault(self.last_key, clean_value(self.text[self.scan_position:end]))
+        if self.last_key == self.field and self.scan_position == self.value_start:
+            value = self.fields[self.field]
+            self._emit(value if value.lower() != 'na' else "")
+        self.last_key = None
+
+    def _settled_value(self):
+        '''Returns the part of the unfinished watched value that can't change anymore, cleaned like clean_value.'''
+        end = len(self.text)
+        match = self.partial_key.search(self.text, self.value_start)
+        if match is not None:
+            end = match.start()
+
+        value = self.text[self.value_start:end].lstrip()
+        if UNFINISHED_PREFIX.fullmatch(value):
+            return ""
+        value = VALUE_PREFIX.sub('', value)
+        quote = value[:1] if value[:1] in ['"', "'"] else ""
+        value = HELD_END.sub('', value[len(quote):]).lstrip()
+        if quote == '"':
+            value = decode_escapes(value)
+
+        # don't start speaking what may still turn out to be NA
+        return "" if 'na'.startswith(value.lower()) else value
+
+    def _emit(self, value):
+        if len(value) > len(self.emitted) and value.startswith(self.emitted):
+            text, self.emitted = value[len(self.emitted):], value
+            if self.on_text is not None:
+                self.on_text(text)
+
+
+def decode_escapes(value):
+    '''Decodes the JSON escape sequences in a value.'''
+    return JSON_ESCAPE.sub(lambda match: chr(int(match.group(1)[1:], 16)) if match.group(1)[0] == 'u'
+                           else JSON_ESCAPES[match.group(1)], value)
+
+
+def fields_to_output_dict(fields, valid_variable_keys=config.VALID_VARIABLE_KEYS):
+    '''Turns extracted fields into the output dict format of processing.parse_output.
+    Returns None if the response is missing or NA.'''
+    if fields.get("response", "").strip().lower() in ["", "na"]:
+        return None
+
+    output_dict = {key: "" for key in valid_variable_keys}
+    for key in valid_variable_keys:
+        value = fields.get(key, "")
+        output_dict[key] = value if value.strip().lower() != 'na' else ""
+    return output_dict
+
+
+@lru_cache(maxsize=8)
+def key_pattern(valid_variable_keys):
+    '''Returns a compiled regex matching any of the keys (quoted or not, with "_" or " ") followed by ":" or "=".
+    A key only counts at the start of a field, i.e. at the start of a line or after "{" or ",", so a key name
+    followed by a colon inside a value (e.g. "My intent: ...") stays part of the value.'''
+    keys = "|".join(key.replace("_", "[ _]") for key in sorted(valid_variable_keys, key=len, reverse=True))
+    return re.compile(r'(?:^|(?<=[{,]))[ \t]*["\']?\b(' + keys + r')\b["\']?\s*[:=]\s*', re.IGNORECASE | re.MULTILINE)
+
+
+@lru_cache(maxsize=8)
+def partial_key_pattern(valid_variable_keys):
+    '''Returns a compiled regex matching the end of a text that may still become a key of key_pattern once more text
+    is added, i.e. the start of a field followed by the beginning of a key, or a key at the very end of the text.'''
+    keys = [key.replace("_", "[ _]") for key in sorted(valid_variable_keys, key=len, reverse=True)]
+    prefixes = {re.escape(key[:length]) for key in valid_variable_keys for length in range(1, len(key))}
+    prefixes = "|".join(prefix.replace("_", "[ _]") for prefix in sorted(prefixes, key=len, reverse=True))
+    return re.compile(r'(?<=[{,\n])[ \t]*["\']?(?:(?:' + "|".join(keys) + r')["\']?\s*(?:[:=]\s*)?|' + prefixes + r')?$',
+                      re.IGNORECASE)
+
+
+# artifacts around values: type hints (str = ...), quotes, trailing commas and closing braces
+VALUE_PREFIX = re.compile(r'^(?:str|list)\s*=\s*')
+VALUE_SUFFIX = re.compile(r'[\s,}`]+$')
+
+
+def parse_structured_output(output_raw, valid_variable_keys=tuple(config.VALID_VARIABLE_KEYS)):
+    '''Parses the raw LLM output into a dict with all valid_variable_keys. Values that are NA are set to "".
+    The output is first parsed as strict JSON (adding the closing brace that the stopping string cuts off).
+    If that fails, a single scan over the text finds all keys and takes everything up to the next key as the value,
+    so values may contain colons, newlines or unescaped quotes.
+    Returns None if no response could be found.'''
+    output_dict = fields_to_output_dict(parse_json_fields(output_raw) or {}, valid_variable_keys)
+    if output_dict is None:
+        output_dict = fields_to_output_dict(scan_fields(output_raw, valid_variable_keys), valid_variable_keys)
+    return output_dict
+
+
+def parse_json_fields(output_raw):
+    '''Returns the fields of the first JSON object in the text, or None if it isn't valid JSON.'''
+    start = output_raw.find('{')
+    if start == -1:
+        return None
+
+    candidate = output_raw[start:output_raw.rfind('}') + 1] if '}' in output_raw[start:] else output_raw[start:] + '}'
+    try:
+        parsed = json.loads(candidate)
+    except ValueError:
+        return None
+    if not isinstance(parsed, dict):
+        return None
+
+    fields = {}
+    for key, value in parsed.items():
+        if isinstance(value, list):
+            value = ", ".join(str(item) for item in value)
+        fields[str(key).strip().lower().replace(' ', '_')] = "" if value is None else str(value)
+    return fields
+
+
+def scan_fields(output_raw, valid_variable_keys=tuple(config.VALID_VARIABLE_KEYS)):
+    '''Finds the keys in a malformed output and returns the text between them as their values.'''
+    matches = list(key_pattern(tuple(valid_variable_keys)).finditer(output_raw))
+    fields = {}
+
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(output_raw)
+        key = match.group(1).lower().replace(' ', '_')
+        fields.setdefault(key, clean_value(output_raw[match.end():end]))
+
+    return fields
+
+
+def clean_value(value):
+    '''Strips the artifacts around a value found between two keys and decodes the escapes of double quoted values.'''
+    value = VALUE_PREFIX.sub('', value.strip())
+    value = VALUE_SUFFIX.sub('', value)
+
+    # strip one pair of surrounding quotes
+    quote = value[:1] if value[:1] in ['"', "'"] else ""
+    if len(value) >= 2 and quote and value[-1] == quote:
+        value = value[1:-1]
+    elif quote:
+        value = value[1:]
+
+    value = value.strip()
+    return decode_escapes(value) if quote == '"' else value
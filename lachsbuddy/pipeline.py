@@ -0,0 +1,137 @@
+'''Handles the background stages of the overlapped conversation pipeline'''
+
+from concurrent.futures import Future
+import config
+import threading
+import traceback
+import queue
+import time
+
+
+class StageWorker():
+    '''Runs submitted calls one after another on a background thread and returns a Future for each of them.
+    Calls run in the order they were submitted. The queue is bounded, so a slow stage slows down the submitter
+    instead of piling up unbounded work.'''
+
+    def __init__(self, name, max_queued=config.PIPELINE_QUEUE_SIZE):
+        self.name = name
+        self.calls = queue.Queue(maxsize=max_queued)
+        self.thread = threading.Thread(target=self._run_loop, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        self.calls.put((future, func, args, kwargs))
+        return future
+
+    def flush(self):
+        '''Blocks until everything submitted so far has been run.'''
+        self.submit(lambda: None).result()
+
+    def _run_loop(self):
+        while True:
+            future, func, args, kwargs = self.calls.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as e:
+                traceback.print_exc()
+                print(f"({self.name} failed)")
+                future.set_exception(e)
+
+
+class InputStage():
+    '''Keeps collecting human input on a background thread while the rest of the turn is processed, so the
+    next utterance can be recorded and transcribed while the LLM is thinking or the response is played.
+    get_input is called repeatedly and must return (transcribed_text, timestamp). The stage stops by itself
+    after an input for which is_last returns True.'''
+
+    def __init__(self, get_input, is_last, max_queued=config.PIPELINE_QUEUE_SIZE):
+        self.get_input = get_input
+        self.is_last = is_last
+        self.inputs = queue.Queue(maxsize=max_queued)
+        self.thread = threading.Thread(target=self._run_loop, name="input stage", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def get(self):
+        '''Returns the next (transcribed_text, timestamp) pair, re-raising errors of the input stage.'''
+        human_input = self.inputs.get()
+        if isinstance(human_input, Exception):
+            raise human_input
+        return human_input
+
+    def _run_loop(self):
+        while True:
+            try:
+                human_input = self.get_input()
+            except Exception as e:
+                self.inputs.put(e)
+                return
+
+            self.inputs.put(human_input)
+            if self.is_last(human_input):
+                return
+
+
+class MicroBatcher():
+    '''Collects items submitted from several threads (e.g. utterances of concurrent sessions) and processes them
+    together. The first item of a batch waits at most max_wait seconds for more to arrive, then process_batch is
+    called with up to max_batch_size items and must return one result per item, in order.
+    submit() returns a Future for the item's result.'''
+
+    def __init__(self, name, process_batch, max_batch_size, max_wait):
+        self.name = name
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.items = queue.Queue()
+        self.thread = threading.Thread(target=self._run_loop, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self.items.put((future, item))
+        return future
+
+    def _next_batch(self):
+        batch = [self.items.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.items.get(timeout=remaining) if remaining > 0 else self.items.get_nowait())
+            except queue.Empty:
+                break
+        return [(future, item) for future, item in batch if future.set_running_or_notify_cancel()]
+
+    def _run_loop(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                results = self.process_batch([item for _, item in batch])
+            except Exception as e:
+                traceback.print_exc()
+                print(f"({self.name} failed)")
+                for future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            for (future, _), result in zip(batch, results):
+                future.set_result(result)
+
+
+database_worker = None
+
+
+def get_database_worker():
+    '''Returns the shared worker that runs database writes and history prefetches off the critical path.'''
+    global database_worker
+    if database_worker is None:
+        database_worker = StageWorker("database worker")
+    return database_worker
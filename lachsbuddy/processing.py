@@ -1,13 +1,21 @@
 '''Handles the processing of I/O and calls to the LLM or database'''
 
 import datetime
-import re
 from audio import *
 from database import *
 from llm import *
+from tts import initialize_tts
+from stt import initialize_stt
+from parsing import StreamingFieldExtractor, fields_to_output_dict, parse_structured_output
+from pipeline import InputStage, get_database_worker
+from history import HistoryManager
+from memory import get_memory, format_memories
+from startup import loader
+from timing import new_step_timer, NULL_TIMER
 import config
 import traceback
 import json
+import time
 
 
 def check_config():
@@ -49,7 +57,8 @@ def check_config():
         raise Exception('\n'.join(errors))
 
 
-def get_llm_response(llm, transcribed_text, prompt, confirm_send=config.CONFIRM_SEND):
+def get_llm_response(llm, transcribed_text, prompt, confirm_send=config.CONFIRM_SEND, speaker=None, tools=(), cache_key=None,
+                     timer=NULL_TIMER):
     ''' This function gets the response from the language model based on the input prompt and the mode set in the config.py file.
     Returns raw llm output and the parsed output dict
     It takes in the following parameters:
@@ -60,11 +69,13 @@ def get_llm_response(llm, transcribed_text, prompt, confirm_send=config.CONFIRM_
 
     confirm_send: A boolean value that indicates whether to confirm before sending the text to the language model or not.
     If set to True, the function prompts the user to confirm whether they want to send the transcribed text to the language model or not.
-    If confirm_send is False, the function directly sends the text to the language model and returns the response.'''
-    # manual copypasting to and from chatgpt
-    retries = 0
-
+    If confirm_send is False, the function directly sends the text to the language model and returns the response.
 
+    speaker: An optional SpeechStream. If config.LLM_STREAMING is set, the response is fed into it while it is generated.
+    tools: The tools available to the LLM, used to restrict the tool value in the generated grammar.
+    cache_key: Identifies the static prompt prefix, so the inference server can reuse its prompt cache for it.
+    timer: StepTimer that gets the time to the first token and the total time of the LLM requests, the parsing time
+    and the number of attempts.'''
     # confirm to send the transcribed text before sending if desired
     if confirm_send == True:
 
@@ -77,72 +88,84 @@ def get_llm_response(llm, transcribed_text, prompt, confirm_send=config.CONFIRM_
             return llm_output_raw, llm_output_raw
 
     print(config.style.GREEN + "\nTranscribed voice input: " + transcribed_text + config.style.RESET + "\n")
-    # try to get a valid response till fixed or an error is raised
-    while True:
 
-        llm_output_raw = llm.chat.completions.create(
+    # constrain the output to the expected format
+    if config.LLM_GENERATED_GRAMMAR:
+        grammar_string = get_output_grammar(tuple(tool.name for tool in tools))
+    else:
+        grammar_string = load_grammar()
+
+    # try to get a valid response till the maximum number of retries is reached
+    for attempt in range(config.LLM_PARSER_MAX_RETRIES + 1):
+        timer.set("parse_attempts", attempt + 1)
+        request_start = time.perf_counter()
+
+        request = dict(
             messages=[{"role": "user", "content": prompt}], 
-            max_tokens=300,
+            max_tokens=output_max_tokens(),
             temperature=0.7,
             model="gpt-3.5-turbo",
-            extra_body={"grammar_string":open("./grammars/json.gbnf").read(),
+            extra_body={"grammar_string":grammar_string,
             "repetition_penalty":1.15,
             "top_k":0.9,
             "stopping_strings":["<|im_end|>", "}"],
-            }).choices[0].message.content
-                    
+            })
+
+        # let llama.cpp based servers keep the static prompt prefix in their KV cache
+        if config.LLM_PROMPT_CACHE and cache_key is not None:
+            request["extra_body"].update({"cache_prompt": True, "prompt_cache_key": cache_key})
+
+        if config.LLM_STREAMING:
+            # speak the response while the rest of the output is still being generated
+            extractor = StreamingFieldExtractor("response", on_text=speaker.feed if speaker is not None else None)
+            output_chunks = []
+            for chunk in llm.complete(stream=True, **request):
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if not output_chunks and attempt == 0:
+                        timer.set("llm_first_token", time.perf_counter() - request_start)
+                    output_chunks.append(chunk.choices[0].delta.content)
+                    extractor.feed(chunk.choices[0].delta.content)
+            llm_output_raw = "".join(output_chunks)
+
+            # the response may already have been spoken, so use the streamed fields instead of retrying
+            streamed_output_dict = fields_to_output_dict(extractor.finish())
+        else:
+            llm_output_raw = llm.complete(**request).choices[0].message.content
+            streamed_output_dict = None
+            if attempt == 0:
+                timer.set("llm_first_token", time.perf_counter() - request_start)
+        timer.add("llm_total", time.perf_counter() - request_start)
+
         #print("Raw output: \n" + llm_output_raw)
         # fetch a new response
         try:
-            llm_output_dict = parse_output(llm_output_raw, prompt)
-            if llm_output_dict != "f":
-                return llm_output_dict, llm_output_raw
+            with timer.stage("parse"):
+                return parse_output(llm_output_raw, prompt), llm_output_raw
 
         # retry if parsing fails and the maximum number of retries is not reached
         except:
-            retries += 1
+            if streamed_output_dict is not None:
+                return streamed_output_dict, llm_output_raw
             traceback.print_exc()
-            print(f"Output parsing failed, attempt {retries}/{config.LLM_PARSER_MAX_RETRIES} to generate a new prompt.")
+            print(f"Output parsing failed, attempt {attempt + 1}/{config.LLM_PARSER_MAX_RETRIES + 1}.")
+
+            # back off before asking the shared inference server again
+            if attempt < config.LLM_PARSER_MAX_RETRIES:
+                time.sleep(config.LLM_RETRY_BACKOFF * 2 ** attempt)
+
+    return "f", "f"
 
 
 def parse_output(output_raw, prompt):
     '''
     This function takes in the raw output string from a language model and separates it into key-value pairs as specified in valid_variable_keys.
     Returns a dictionary containing the keys specified in valid_variable_keys and attempts to parse values for them from the output_raw string.
+    Strict JSON is tried first, malformed output is handled by a single tolerant scan (see parsing.parse_structured_output).
     '''
     print("raw output for formatting:\n" + output_raw)
-    # check for newline characters
-    if '\n' not in output_raw:
-        for key in config.VALID_VARIABLE_KEYS:
-            output_raw = re.sub(r'\b' + key + r'\b', '\n' + key, output_raw)
-
-    # split by newline characters
-    output_lines = output_raw.split('\n')
+    output_dict = parse_structured_output(output_raw, tuple(config.VALID_VARIABLE_KEYS))
 
-    # create dict with all values set to None
-    output_dict = {key: "" for key in config.VALID_VARIABLE_KEYS}
-    output_dict["response"] = None
-
-    # split each of the separated lines into key/value pairs
-    for line in output_lines:
-        if '}' in line:
-            break
-        # remove trailing commas
-        if line.endswith(',\n'):
-            line = line[:-1]
-        # remove trailing commas
-        if line.endswith('"') or line.endswith("'",):
-            line = line[:-1]
-
-        # remove artifacts and match keys to specified keys
-        if any(key in line for key in config.VALID_VARIABLE_KEYS) and len(line) > 3:
-            key, value = line.replace('"', "").replace('str = ', "").replace('list = ', "").split(':')
-            key = key.strip().lower().replace(' ', '_')
-            if key in config.VALID_VARIABLE_KEYS:
-                #print("Detected key " + key + " with value "+ value)
-                output_dict[key] = value.strip() if value.strip().lower() != 'na' else ""
-
-    if output_dict["response"] != None:
+    if output_dict is not None:
         print("Response parsed successfully")
         return output_dict
 
@@ -168,13 +191,14 @@ def parse_output(output_raw, prompt):
         #         continue
 
 
-def get_human_input(listening_mode, stt_model, log_chatter=config.LOG_CHATTER):
+def get_human_input(listening_mode, stt_model, log_chatter=config.LOG_CHATTER, timer=NULL_TIMER):
     '''
     Function to get the human input as a string. Parameters:
     input_mode: "voice" or "text", specifying the input medium
     listening_mode: "active" or "passive": Specify the current mode
     model: STT model, must be a whisper model name.
     log_chatter: Boolean. Whether to log chatter or not.
+    timer: StepTimer that gets the recording (or typing) and transcription time.
 
     Returns the transcribed text and a timestamp.
     '''
@@ -184,27 +208,34 @@ def get_human_input(listening_mode, stt_model, log_chatter=config.LOG_CHATTER):
     timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
     if input_mode == "voice":
+        if not loader.ready("speech recognition", "microphone"):
+            print(config.style.MAGENTA + "Waiting for the speech recognition to be ready..." + config.style.RESET)
+            loader.wait("speech recognition", "microphone")
+
         # listen for audio input from the microphone
-        transcribed_text = listen_mic(stt_model=stt_model)
+        transcribed_text = listen_mic(stt_model=stt_model, listening_mode=listening_mode, timer=timer)
 
         # switch to text input mode if the user says "text"
         if "Text." in transcribed_text:
             input_mode = "text"
-            return get_human_input(listening_mode, stt_model)
+            return get_human_input(listening_mode, stt_model, timer=timer)
 
         # log the conversation history if logging is enabled and the listening mode is passive
         if log_chatter == True and transcribed_text != "" and listening_mode == "passive":
             insert_chatter(timestamp, transcribed_text, listening_mode)
+            if config.MEMORY_ENABLED:
+                get_memory().remember(transcribed_text, timestamp, "chatter")
 
 
     elif input_mode == "text":
         # prompt the user to enter text input
-        transcribed_text = str(input(config.style.MAGENTA + "Write a text message: " + config.style.RESET))
+        with timer.stage("capture"):
+            transcribed_text = str(input(config.style.MAGENTA + "Write a text message: " + config.style.RESET))
 
         # switch to voice input mode if the user says "voice". Currently not working.
         if transcribed_text == "voice":
             input_mode = "voice"
-            return get_human_input(listening_mode, stt_model)
+            return get_human_input(listening_mode, stt_model, timer=timer)
 
     else:
         # raise an exception if an invalid input mode is specified
@@ -218,6 +249,20 @@ def startup_checks():
     global input_mode
     check_config()
     input_mode = config.INPUT_MODE
+
+    # load the STT and TTS models once so they stay warm across turns. Everything is loaded in the background,
+    # so text input is usable right away. Voice input and playback wait for their models if they aren't ready yet.
+    if config.INPUT_MODE == "voice":
+        loader.start("speech recognition", initialize_stt)
+
+        # open the microphone now so calibration is done before the first recording
+        if config.MIC_ALWAYS_ON and not config.MQTT_MIC:
+            loader.start("microphone", start_microphone)
+    if config.PLAY_SOUND:
+        loader.start("speech synthesis", initialize_tts)
+    loader.start("LLM", initialize_llm)
+    loader.on_ready(lambda durations: print(config.style.MAGENTA + "Ready (" + ", ".join(
+        f"{name} {seconds:.1f}s" for name, seconds in durations.items()) + ")" + config.style.RESET))
     if config.START_INACTIVE:
         print(config.style.MAGENTA + f"Welcome. You are currently in the inactive mode. Say the hotword '{config.HOTWORD}' to enter active mode" + config.style.RESET)
     else:
@@ -234,7 +279,8 @@ def run_in_background():
         # get human input
         transcribed_text, timestamp = get_human_input(listening_mode="passive",
                                                       stt_model=config.STT_MODEL)
-        print(config.style.BLUE + "Background chatter: " + transcribed_text + config.style.RESET)
+        if transcribed_text != "":
+            print(config.style.BLUE + "Background chatter: " + transcribed_text + config.style.RESET)
 
     # Check if the hotword is mentioned, enable active mode in that case.
         if config.HOTWORD in transcribed_text.lower():
@@ -244,7 +290,9 @@ def run_in_background():
 
 
 def run_conversation():
-    '''loop for the active mode. Prompts the user for input and provides a back and forth interaction with a LLM, on terms specified in the config.'''
+    '''loop for the active mode. Prompts the user for input and provides a back and forth interaction with a LLM, on terms specified in the config.
+    If config.PIPELINE_MODE is set, the next voice input is collected on a background thread, database writes and
+    history prefetches run on the database worker and the response playback isn't awaited before the next turn.'''
     # initialize LLM
     global tools, tool_descriptions, llm
 
@@ -252,40 +300,125 @@ def run_conversation():
     llm = llm_chain(model_name=config.LLM_NAME)
     tools, tool_descriptions = initialize_tools()
 
-    # initialize new conversation metadata
-    step, conv_history, listening_mode, conversation_id = start_new_conversation()
+    # initialize new conversation metadata or restore those of a past conversation
+    if config.RESUME_CONVERSATION is not None:
+        step, conv_history, listening_mode, conversation_id = resume_conversation(config.RESUME_CONVERSATION)
+    else:
+        step, conv_history, listening_mode, conversation_id = start_new_conversation()
+    history = HistoryManager(conversation_id, llm)
+
+    # confirming the input before sending needs the console in the main thread, so the pipeline can't be used with it.
+    # A microphone that is opened per recording can't be paused during playback, so recording the next input while
+    # the response plays would record the AI itself.
+    local_mic_per_recording = config.INPUT_MODE == "voice" and not config.MQTT_MIC and not config.MIC_ALWAYS_ON
+    pipelined = config.PIPELINE_MODE and not config.CONFIRM_SEND and not local_mic_per_recording
+    # only voice input is collected ahead, a text prompt on the background thread would be printed before the response
+    prefetch_input = pipelined and config.INPUT_MODE == "voice"
+
+    # every input starts the timing of its step
+    def timed_human_input():
+        timer = new_step_timer()
+        return get_human_input(listening_mode, stt_model=config.STT_MODEL, timer=timer) + (timer,)
+
+    if pipelined:
+        database_worker = get_database_worker()
+        # a resumed conversation already has a history for its first turn
+        if step != 0:
+            history_prefetch = database_worker.submit(get_current_turns)
+    if prefetch_input:
+        human_inputs = InputStage(get_input=timed_human_input,
+                                  is_last=lambda human_input: config.ENDWORD in human_input[0].lower()).start()
+    speaker = None
 
     while True:
         #transcribed_text, timestamp = "Test?", datetime.datetime.strptime("09/19/23 13:55:26", '%m/%d/%y %H:%M:%S') #For testing
-        transcribed_text, timestamp = get_human_input(listening_mode, stt_model=config.STT_MODEL)
+        if prefetch_input:
+            transcribed_text, timestamp, timer = human_inputs.get()
+        else:
+            transcribed_text, timestamp, timer = timed_human_input()
+
         # return to inactive mode if endword is mentioned
         if config.ENDWORD in transcribed_text.lower():
             print(config.style.MAGENTA + "Endword recognized, returning to background mode" + config.style.RESET)
             listening_mode = "passive"
             break
 
-        # fetch most recent history unless the conversation just started
+        # fetch most recent history unless the conversation just started, older turns are summarized to fit the budget
         if step != 0:
-            conv_history = get_current_history()
-
-        # assemble the prompt
-        prompt_template, prompt_formatted = baseline_prompt(transcribed_text, conv_history=conv_history)
+            with timer.stage("history"):
+                conv_history = history.render(history_prefetch.result() if pipelined else get_current_turns())
+
+        with timer.stage("prompt"):
+            # recall similar turns and chatter from earlier conversations
+            memories = ""
+            if config.MEMORY_ENABLED:
+                try:
+                    memories = format_memories(get_memory().recall(transcribed_text, exclude_conversation=conversation_id))
+                except Exception:
+                    traceback.print_exc()
+                    print("(Recalling memories failed)")
+
+            # assemble the prompt
+            prompt_template, prompt_formatted = baseline_prompt(transcribed_text, tools=tools, tool_descriptions=tool_descriptions,
+                                                                conv_history=conv_history, memories=memories)
+
+        # the previous response has to be played completely before the next one starts
+        if speaker is not None:
+            speaker.wait()
 
         # get the llm response to the human input, re-record if wished and checking is enabled
-        llm_output_dict, llm_output_raw = get_llm_response(llm=llm, transcribed_text=transcribed_text, prompt=prompt_formatted)
+        # with a streamed LLM output, the response is spoken while it is being generated
+        speaker = open_speech_stream(timer=timer) if (config.LLM_STREAMING or pipelined) and config.PLAY_SOUND else None
+        llm_output_dict, llm_output_raw = get_llm_response(llm=llm, transcribed_text=transcribed_text, prompt=prompt_formatted,
+                                                           speaker=speaker, tools=tools, cache_key=prompt_template.cache_key,
+                                                           timer=timer)
+        if speaker is not None and llm_output_dict in ["r", "e", "f"]:
+            speaker.finish()
+
         if llm_output_dict == "r":
             continue
 
+        elif llm_output_dict == "f":
+            print(config.style.MAGENTA + "The LLM output couldn't be parsed, please repeat your input." + config.style.RESET)
+            continue
+
         elif llm_output_dict == "e":
             print(
                 config.style.MAGENTA + f"You are now in the inactive mode again. Say the hotword '{config.HOTWORD}' to enter active mode" + config.style.RESET)
             break
 
-        # insert into DB
-        insert_conversation(conversation_id, step, timestamp, config.LLM_NAME, prompt_template, prompt_formatted,
-                            transcribed_text, llm_output_raw, llm_output_dict, conv_history, listening_mode)
+        # insert into DB, in the pipeline the history for the next turn is prefetched right after the insert
+        if pipelined:
+            database_worker.submit(insert_conversation, conversation_id, step, timestamp, config.LLM_NAME, prompt_template,
+                                   prompt_formatted, transcribed_text, llm_output_raw, llm_output_dict, conv_history, listening_mode)
+            history_prefetch = database_worker.submit(get_current_turns)
+        else:
+            insert_conversation(conversation_id, step, timestamp, config.LLM_NAME, prompt_template, prompt_formatted,
+                                transcribed_text, llm_output_raw, llm_output_dict, conv_history, listening_mode)
 
-        # print and play output
+        if config.MEMORY_ENABLED:
+            get_memory().remember(f"Human: {llm_output_dict['human_input']}\nAI: {llm_output_dict['response']}",
+                                  timestamp, "conversation", conversation_id)
+
+        # print and play output, the timings of the step are stored once the response has been played
         print(config.style.RED + "AI: " + llm_output_dict['response'] + config.style.RESET)
-        play_tts(llm_output_dict['response'])
+        if speaker is not None:
+            # the response wasn't streamed if the LLM didn't stick to the output format
+            if speaker.fed_text == "":
+                speaker.feed(llm_output_dict['response'])
+            if timer.enabled:
+                speaker.on_done = lambda step=step, timer=timer: insert_timings(conversation_id, step, timer.items())
+            speaker.finish()
+            if not pipelined:
+                speaker.wait()
+        else:
+            play_tts(llm_output_dict['response'], timer=timer)
+            if timer.enabled:
+                insert_timings(conversation_id, step, timer.items())
         step += 1
+
+    # let the last response and database writes finish before going back to the background mode
+    if speaker is not None:
+        speaker.wait()
+    if pipelined:
+        database_worker.flush()
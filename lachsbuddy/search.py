@@ -0,0 +1,165 @@
+'''Handles the full-text search over the conversation history and background chatter'''
+
+import heapq
+import config
+import re
+
+# columns of conversation_history that are searchable
+CONVERSATION_COLUMNS = ["human_input_raw", "human_input_corrected", "ai_response", "entities"]
+
+# FTS5 indexes using the tables themselves as external content, so the text isn't stored twice.
+# Triggers keep them in sync with every insert, update and delete.
+SEARCH_SCHEMA = [
+    f'''CREATE VIRTUAL TABLE IF NOT EXISTS conversation_history_fts USING fts5(
+        {", ".join(CONVERSATION_COLUMNS)}, content='conversation_history', tokenize='porter unicode61')''',
+    f'''CREATE TRIGGER IF NOT EXISTS conversation_history_fts_insert AFTER INSERT ON conversation_history BEGIN
+        INSERT INTO conversation_history_fts (rowid, {", ".join(CONVERSATION_COLUMNS)})
+        VALUES (new.rowid, {", ".join("new." + column for column in CONVERSATION_COLUMNS)});
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS conversation_history_fts_delete AFTER DELETE ON conversation_history BEGIN
+        INSERT INTO conversation_history_fts (conversation_history_fts, rowid, {", ".join(CONVERSATION_COLUMNS)})
+        VALUES ('delete', old.rowid, {", ".join("old." + column for column in CONVERSATION_COLUMNS)});
+    END''',
+    f'''CREATE TRIGGER IF NOT EXISTS conversation_history_fts_update AFTER UPDATE ON conversation_history BEGIN
+        INSERT INTO conversation_history_fts (conversation_history_fts, rowid, {", ".join(CONVERSATION_COLUMNS)})
+        VALUES ('delete', old.rowid, {", ".join("old." + column for column in CONVERSATION_COLUMNS)});
+        INSERT INTO conversation_history_fts (rowid, {", ".join(CONVERSATION_COLUMNS)})
+        VALUES (new.rowid, {", ".join("new." + column for column in CONVERSATION_COLUMNS)});
+    END''',
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS chatter_fts USING fts5(
+        human_input_raw, content='chatter', content_rowid='chatter_id', tokenize='porter unicode61')''',
+    '''CREATE TRIGGER IF NOT EXISTS chatter_fts_insert AFTER INSERT ON chatter BEGIN
+        INSERT INTO chatter_fts (rowid, human_input_raw) VALUES (new.chatter_id, new.human_input_raw);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS chatter_fts_delete AFTER DELETE ON chatter BEGIN
+        INSERT INTO chatter_fts (chatter_fts, rowid, human_input_raw) VALUES ('delete', old.chatter_id, old.human_input_raw);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS chatter_fts_update AFTER UPDATE ON chatter BEGIN
+        INSERT INTO chatter_fts (chatter_fts, rowid, human_input_raw) VALUES ('delete', old.chatter_id, old.human_input_raw);
+        INSERT INTO chatter_fts (rowid, human_input_raw) VALUES (new.chatter_id, new.human_input_raw);
+    END''',
+]
+
+# Searches run in two steps: the best matches are ranked first, then only those are joined with their rows and
+# given a snippet, so the cost of the snippets doesn't grow with the number of matches.
+# Only matches with rowid >= the cutoff from nth_recent_match are ranked.
+RANK_QUERY = "SELECT rowid, rank FROM {table} WHERE {table} MATCH ? AND rowid >= ? ORDER BY rank LIMIT ?"
+RECENT_QUERY = "SELECT rowid, 0.0 FROM {table} WHERE {table} MATCH ? ORDER BY rowid DESC LIMIT ?"
+
+# content table and its rowid column for every index
+CONTENT_TABLES = {"conversation_history_fts": ("conversation_history", "rowid"), "chatter_fts": ("chatter", "chatter_id")}
+
+DETAIL_QUERIES = {
+    "conversation_history_fts": '''
+        SELECT 'conversation', h.conversation_id, h.step, h.timestamp,
+            snippet(conversation_history_fts, -1, '[', ']', '...', ?)
+        FROM conversation_history_fts JOIN conversation_history AS h ON h.rowid = conversation_history_fts.rowid
+        WHERE conversation_history_fts MATCH ? AND conversation_history_fts.rowid = ?''',
+    "chatter_fts": '''
+        SELECT 'chatter', NULL, NULL, ch.timestamp, snippet(chatter_fts, -1, '[', ']', '...', ?)
+        FROM chatter_fts JOIN chatter AS ch ON ch.chatter_id = chatter_fts.rowid
+        WHERE chatter_fts MATCH ? AND chatter_fts.rowid = ?''',
+}
+
+SEARCH_FIELDS = ["source", "conversation_id", "step", "timestamp", "snippet", "rank"]
+
+WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def create_search_index(cursor):
+    '''Creates the search indexes and their triggers and indexes all existing rows.'''
+    for statement in SEARCH_SCHEMA:
+        cursor.execute(statement)
+    for table in CONTENT_TABLES:
+        cursor.execute(f"INSERT INTO {table} ({table}) VALUES ('rebuild')")
+
+
+def repair_search_index(cursor):
+    '''Rebuilds the indexes whose rowids don't match their tables any more. conversation_history has no INTEGER
+    PRIMARY KEY, so a VACUUM may renumber its rowids and leave the index pointing at the wrong rows.
+    Only the rowids are compared (with the index's docsize table), which is cheap next to a rebuild.
+    Returns the names of the rebuilt indexes.'''
+    rebuilt = []
+    for table, (content_table, rowid_column) in CONTENT_TABLES.items():
+        indexed, content, dangling = cursor.execute(
+            f'''SELECT (SELECT COUNT(*) FROM {table}_docsize), (SELECT COUNT(*) FROM {content_table}),
+                (SELECT COUNT(*) FROM {table}_docsize AS d
+                 WHERE NOT EXISTS (SELECT 1 FROM {content_table} WHERE {rowid_column} = d.id))''').fetchone()
+        if indexed != content or dangling:
+            cursor.execute(f"INSERT INTO {table} ({table}) VALUES ('rebuild')")
+            rebuilt.append(table)
+    return rebuilt
+
+
+def fts_query(words, match_any=False):
+    '''Turns words into an FTS5 query. Every word is quoted, so the text can't contain query syntax.
+    By default all words have to match, with match_any=True any of them does.'''
+    return (" OR " if match_any else " ").join('"' + word + '"' for word in words)
+
+
+def nth_recent_match(connection, table, query, n):
+    '''Returns the rowid of the n-th most recent match (counting from 1), or 0 if there are fewer matches.
+    Walking the matches in rowid order is cheap, unlike ranking them.'''
+    row = connection.execute(f"SELECT rowid FROM {table} WHERE {table} MATCH ? ORDER BY rowid DESC LIMIT 1 OFFSET ?",
+                             (query, n - 1)).fetchone()
+    return row[0] if row is not None else 0
+
+
+def is_common(connection, table, word, last_rowid, max_fraction=config.SEARCH_COMMON_TERM_FRACTION):
+    '''Whether a word occurs in more than max_fraction of the recent rows, like a stopword.
+    BM25 reads every row containing a word to weigh it, so common words make the ranking slow while adding little to it.'''
+    candidates = config.SEARCH_MAX_CANDIDATES
+    nth_rowid = nth_recent_match(connection, table, fts_query([word]), candidates)
+    return nth_rowid > 0 and candidates / (last_rowid - nth_rowid + 1) > max_fraction
+
+
+def rank_matches(connection, table, words, limit, match_any=False):
+    '''Returns the query used for the table and up to limit (score, rank, rowid) tuples of its best matches.
+    Common words are left out of the query. Only the config.SEARCH_MAX_CANDIDATES most recent matches are ranked with
+    BM25, which keeps the search time bounded. If all words are common, the most recent matches are returned
+    with a rank of 0.
+    BM25 ranks of different tables aren't comparable, so the score normalizes them: the best match of the table
+    scores 1 and the others their rank relative to it. Recent matches score by recency instead, newest first.'''
+    content_table, rowid_column = CONTENT_TABLES[table]
+    last_rowid = connection.execute(f"SELECT MAX({rowid_column}) FROM {content_table}").fetchone()[0]
+    if last_rowid is None:
+        return None, []
+
+    rare_words = [word for word in words if not is_common(connection, table, word, last_rowid)]
+    if not rare_words:
+        query = fts_query(words, match_any)
+        rows = connection.execute(RECENT_QUERY.format(table=table), (query, limit)).fetchall()
+        return query, [(1 - index / len(rows), rank, rowid) for index, (rowid, rank) in enumerate(rows)]
+
+    query = fts_query(rare_words, match_any)
+    cutoff = nth_recent_match(connection, table, query, config.SEARCH_MAX_CANDIDATES)
+    rows = connection.execute(RANK_QUERY.format(table=table), (query, cutoff, limit)).fetchall()
+    # BM25 ranks are negative, the best (lowest) one comes first
+    best_rank = rows[0][1] if rows else 0
+    return query, [(rank / best_rank if best_rank < 0 else 1.0, rank, rowid) for rowid, rank in rows]
+
+
+def search(connection, text, limit=config.SEARCH_RESULTS, include_chatter=True, match_any=False,
+           snippet_words=config.SEARCH_SNIPPET_WORDS):
+    '''Searches the conversation history (and chatter) for the words in text.
+    Matches are ranked with BM25, common words are ignored (see is_common). If there are more than
+    config.SEARCH_MAX_CANDIDATES matches, only the most recent ones are ranked. The matches of the tables are merged
+    by their normalized score (see rank_matches).
+    Returns up to limit dicts with the keys in SEARCH_FIELDS, best match first. The snippet marks matching words with [ ].'''
+    words = list(dict.fromkeys(word.lower() for word in WORD.findall(text)))
+    if not words:
+        return []
+
+    tables = ["conversation_history_fts", "chatter_fts"] if include_chatter else ["conversation_history_fts"]
+    best = []
+    queries = {}
+    for table in tables:
+        queries[table], matches = rank_matches(connection, table, words, limit, match_any)
+        best.extend((score, rowid, table, rank) for score, rank, rowid in matches)
+
+    results = []
+    for _, rowid, table, rank in heapq.nlargest(limit, best):
+        row = connection.execute(DETAIL_QUERIES[table], (snippet_words, queries[table], rowid)).fetchone()
+        if row is not None:
+            results.append(dict(zip(SEARCH_FIELDS, row + (rank,))))
+    return results
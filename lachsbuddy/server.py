@@ -0,0 +1,253 @@
+'''Serves several devices from one process (server mode).
+
+Every device is a remote microphone/speaker node (see mqtt_transport.py) that uses the topics below
+"lachsbuddy/<client id>/" and joins by publishing its client id on SESSION_TOPIC, or is listed in config.SERVER_CLIENTS.
+Each device gets a session with its own listening mode and conversation. The STT and TTS engines, the LLM backend
+and the database are loaded once and shared, STT and TTS requests of sessions that arrive together are batched.
+Run: python server.py'''
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import functools
+import traceback
+import speech_recognition as sr
+from pydub import AudioSegment
+import config
+from audio import MQTTAudioSink, play_audio
+from database import (connect_to_database, start_new_conversation, get_current_turns, insert_conversation,
+                      insert_chatter, insert_timings)
+from history import HistoryManager
+from llm import llm_chain, initialize_llm, initialize_tools, baseline_prompt
+from memory import get_memory, format_memories
+from mqtt_transport import MQTTTransport, SESSION_TOPIC
+from processing import get_llm_response
+from stt import audio_to_array, get_hotword_spotter, get_stt_batcher, initialize_stt
+from timing import new_step_timer
+from tts import SpeechStream, BatchedTTSEngine, initialize_tts
+
+
+class Session():
+    '''State of one device: its transport, listening mode and conversation.
+    The turns of a session run one after another, sessions run concurrently.'''
+
+    def __init__(self, server, client_id):
+        self.server = server
+        self.client_id = client_id
+        self.transport = MQTTTransport(client=server.new_client(), topic_prefix=f"lachsbuddy/{client_id}/")
+        self.listening_mode = "passive" if config.START_INACTIVE else "active"
+        self.conversation_id = None
+        self.step = 0
+        self.history = None
+        self.task = None
+
+    def log(self, text, color=config.style.MAGENTA):
+        print(color + f"[{self.client_id}] " + text + config.style.RESET)
+
+    async def run(self):
+        await self.server.run_blocking(self.transport.connect)
+        self.log("Session started")
+        try:
+            if self.listening_mode == "active":
+                await self.start_conversation()
+
+            while True:
+                transcribed_text, timestamp, timer = await self.get_human_input()
+
+                if self.listening_mode == "passive":
+                    await self.server.run_blocking(self.log_chatter, transcribed_text, timestamp)
+                    if config.HOTWORD in transcribed_text.lower():
+                        await self.start_conversation()
+
+                elif config.ENDWORD in transcribed_text.lower():
+                    self.log("Endword recognized, returning to background mode")
+                    self.listening_mode = "passive"
+
+                elif transcribed_text.strip() != "":
+                    await self.server.run_blocking(self.run_turn, transcribed_text, timestamp, timer)
+        finally:
+            # wakes up the executor thread that waits for the device's next recording
+            self.transport.close()
+
+    async def get_human_input(self):
+        '''Records an utterance on the device and transcribes it with the shared STT batcher.
+        In the passive mode, utterances without speech are skipped before transcription.
+        Returns the transcribed text, a timestamp and the StepTimer of the step.'''
+        timer = new_step_timer()
+        with timer.stage("capture"):
+            raw_audio, sample_rate, sample_width = await self.server.run_blocking(self.transport.request_audio)
+        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        audio = sr.AudioData(raw_audio, sample_rate, sample_width)
+
+        with timer.stage("stt"):
+            samples = audio_to_array(audio)
+            if self.listening_mode == "passive" and not get_hotword_spotter().is_speech(samples):
+                return "", timestamp, timer
+            transcribed_text = await asyncio.wrap_future(get_stt_batcher().submit(samples))
+
+        self.log(("Human: " if self.listening_mode == "active" else "Background chatter: ") + transcribed_text,
+                 config.style.GREEN if self.listening_mode == "active" else config.style.BLUE)
+        return transcribed_text, timestamp, timer
+
+    def log_chatter(self, transcribed_text, timestamp):
+        if config.LOG_CHATTER and transcribed_text != "":
+            insert_chatter(timestamp, transcribed_text, "passive")
+            if config.MEMORY_ENABLED:
+                get_memory().remember(transcribed_text, timestamp, "chatter")
+
+    async def start_conversation(self):
+        self.step, _, self.listening_mode, self.conversation_id = await self.server.run_blocking(start_new_conversation, False)
+        self.history = HistoryManager(self.conversation_id, self.server.llm)
+        self.log(f"Active mode enabled, conversation {self.conversation_id}")
+        await self.server.run_blocking(self.play_effect, ".//resources//enable_active_mode.wav")
+
+    def play_effect(self, file):
+        '''Plays a sound effect on the device.'''
+        try:
+            play_audio(AudioSegment.from_file(file).set_channels(1).set_sample_width(2), self.transport)
+        except Exception:
+            traceback.print_exc()
+            self.log("(Sound effect could not be played)")
+
+    def run_turn(self, transcribed_text, timestamp, timer):
+        '''One step of the conversation, like in processing.run_conversation. Runs on an executor thread.'''
+        conv_history = ""
+        if self.step != 0:
+            with timer.stage("history"):
+                conv_history = self.history.render(get_current_turns(conversation_id=self.conversation_id))
+
+        with timer.stage("prompt"):
+            memories = ""
+            if config.MEMORY_ENABLED:
+                try:
+                    memories = format_memories(get_memory().recall(transcribed_text, exclude_conversation=self.conversation_id))
+                except Exception:
+                    traceback.print_exc()
+                    self.log("(Recalling memories failed)")
+
+            prompt_template, prompt_formatted = baseline_prompt(transcribed_text, tools=self.server.tools,
+                                                                tool_descriptions=self.server.tool_descriptions,
+                                                                conv_history=conv_history, memories=memories)
+
+        speaker = SpeechStream(sink=MQTTAudioSink(self.transport), engine=BatchedTTSEngine(), timer=timer) if config.PLAY_SOUND else None
+        llm_output_dict, llm_output_raw = get_llm_response(llm=self.server.llm, transcribed_text=transcribed_text,
+                                                           prompt=prompt_formatted, confirm_send=False, speaker=speaker,
+                                                           tools=self.server.tools, cache_key=prompt_template.cache_key,
+                                                           timer=timer)
+        if llm_output_dict == "f":
+            if speaker is not None:
+                speaker.finish()
+            self.log("The LLM output couldn't be parsed, please repeat your input.")
+            return
+
+        insert_conversation(self.conversation_id, self.step, timestamp, config.LLM_NAME, prompt_template, prompt_formatted,
+                            transcribed_text, llm_output_raw, llm_output_dict, conv_history, self.listening_mode)
+        if config.MEMORY_ENABLED:
+            get_memory().remember(f"Human: {llm_output_dict['human_input']}\nAI: {llm_output_dict['response']}",
+                                  timestamp, "conversation", self.conversation_id)
+
+        self.log("AI: " + llm_output_dict['response'], config.style.RED)
+        if speaker is not None:
+            # the response wasn't streamed if the LLM didn't stick to the output format
+            if speaker.fed_text == "":
+                speaker.feed(llm_output_dict['response'])
+            speaker.finish()
+            speaker.wait()
+        if timer.enabled:
+            insert_timings(self.conversation_id, self.step, timer.items())
+        self.step += 1
+
+
+class SessionServer():
+    '''Runs one Session per device on an asyncio loop. Blocking work (waiting for recordings, LLM requests, database
+    access) runs on a thread pool, so sessions don't hold each other up.
+    client_factory returns a new paho compatible MQTT client, e.g. LoopbackBroker().client for tests.'''
+
+    def __init__(self, client_factory=None, max_sessions=config.SERVER_MAX_SESSIONS):
+        self.client_factory = client_factory
+        self.max_sessions = max_sessions
+        # client id -> running Session
+        self.sessions = {}
+        # each session may wait for a recording and run a turn at the same time
+        self.executor = ThreadPoolExecutor(max_workers=2 * max_sessions + 4, thread_name_prefix="session")
+        self.loop = None
+        self.stopped = None
+
+    def new_client(self):
+        if self.client_factory is not None:
+            return self.client_factory()
+        import paho.mqtt.client as mqtt
+        return mqtt.Client()
+
+    async def run_blocking(self, func, *args, **kwargs):
+        return await self.loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def serve(self):
+        '''Loads the shared models and serves sessions until stop() is called.'''
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        connect_to_database()
+
+        # shared models and backends, loaded once for all sessions
+        loading = [self.run_blocking(initialize_stt, config.STT_WARM_UP, batched=True), self.run_blocking(initialize_llm)]
+        if config.PLAY_SOUND:
+            loading.append(self.run_blocking(initialize_tts, config.TTS_WARM_UP))
+        await asyncio.gather(*loading)
+        self.llm = llm_chain(model_name=config.LLM_NAME)
+        self.tools, self.tool_descriptions = initialize_tools()
+
+        for client_id in config.SERVER_CLIENTS:
+            self.add_session(client_id)
+
+        # devices announce themselves with their client id
+        announcements = self.new_client()
+        announcements.on_connect = lambda client, userdata, flags, rc: client.subscribe(SESSION_TOPIC)
+        announcements.on_message = lambda client, userdata, message: self.loop.call_soon_threadsafe(
+            self.add_session, message.payload.decode(errors="replace").strip())
+        announcements.connect(config.BROKER_ADDRESS, config.BROKER_PORT, keepalive=60)
+        announcements.loop_start()
+        print(config.style.MAGENTA + f"Server ready, devices can join on '{SESSION_TOPIC}'" + config.style.RESET)
+
+        try:
+            await self.stopped.wait()
+        finally:
+            announcements.loop_stop()
+            announcements.disconnect()
+            tasks = [session.task for session in self.sessions.values()]
+            for task in tasks:
+                task.cancel()
+            # closing the transports lets the threads waiting for recordings return, work that hasn't started is dropped
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.stopped.set)
+
+    def add_session(self, client_id):
+        '''Starts a session for a device. A device that announces itself again while its session runs was restarted,
+        so the requests it lost are sent again. Called on the event loop.'''
+        if client_id == "":
+            return
+        if client_id in self.sessions:
+            self.sessions[client_id].transport.resend_pending()
+            return
+        if len(self.sessions) >= self.max_sessions:
+            print(config.style.MAGENTA + f"[{client_id}] Turned away, {self.max_sessions} sessions are running" + config.style.RESET)
+            return
+
+        session = Session(self, client_id)
+        session.task = self.loop.create_task(session.run())
+        self.sessions[client_id] = session
+        session.task.add_done_callback(functools.partial(self.session_done, client_id))
+
+    def session_done(self, client_id, task):
+        # the device can join again after its session ended
+        self.sessions.pop(client_id, None)
+        if not task.cancelled() and task.exception() is not None:
+            exception = task.exception()
+            traceback.print_exception(type(exception), exception, exception.__traceback__)
+            print(config.style.MAGENTA + f"[{client_id}] Session ended" + config.style.RESET)
+
+
+if __name__ == "__main__":
+    asyncio.run(SessionServer().serve())
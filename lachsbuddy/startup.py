@@ -0,0 +1,63 @@
+'''Handles loading of models and backends in the background at startup'''
+
+from concurrent.futures import Future, wait
+import threading
+import traceback
+import time
+
+
+class BackgroundLoader():
+    '''Runs loading steps (models, libraries, devices) on their own threads, so the program is usable before all of
+    them are done. Every step is started with start(name, func) and gets a Future.
+    ready() is the readiness signal, wait() blocks until steps are done. Steps that were never started count as done,
+    so callers don't have to know which steps the config selected.'''
+
+    def __init__(self):
+        self.steps = {}
+        self.durations = {}
+        self.lock = threading.Lock()
+
+    def start(self, name, func, *args, **kwargs):
+        future = Future()
+        with self.lock:
+            self.steps[name] = future
+
+        def run():
+            start_time = time.perf_counter()
+            # the duration is recorded before the future resolves, so on_ready callbacks see it
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                self.durations[name] = time.perf_counter() - start_time
+                traceback.print_exc()
+                print(f"({name} could not be loaded)")
+                future.set_exception(e)
+            else:
+                self.durations[name] = time.perf_counter() - start_time
+                future.set_result(result)
+
+        threading.Thread(target=run, name=f"load {name}", daemon=True).start()
+        return future
+
+    def _futures(self, names):
+        with self.lock:
+            if not names:
+                return list(self.steps.values())
+            return [self.steps[name] for name in names if name in self.steps]
+
+    def ready(self, *names):
+        '''Returns True if the given steps (or all steps if none are given) are done, without blocking.'''
+        return all(future.done() for future in self._futures(names))
+
+    def wait(self, *names, timeout=None):
+        '''Blocks until the given steps (or all steps if none are given) are done. Returns True if they are.'''
+        return not wait(self._futures(names), timeout=timeout).not_done
+
+    def on_ready(self, callback):
+        '''Calls callback with the loading times in seconds per step once all steps started so far are done.'''
+        futures = self._futures(())
+        threading.Thread(target=lambda: (wait(futures), callback(dict(self.durations))),
+                         name="loading monitor", daemon=True).start()
+
+
+loader = BackgroundLoader()
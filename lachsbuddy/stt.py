@@ -0,0 +1,333 @@
+'''Handles speech to text transcription. STT models are loaded once and kept in memory between utterances.'''
+
+from io import BytesIO
+import numpy as np
+import config
+import traceback
+import threading
+from pipeline import MicroBatcher
+from keys import OPENAI_API_BASE, OPENAI_API_KEY
+
+# sample rate all STT models expect
+STT_SAMPLE_RATE = 16000
+
+# whisper's encoder always takes windows of this many seconds
+WHISPER_WINDOW_SECONDS = 30
+
+# thresholds whisper.transcribe uses to detect failed decodes and silence
+WHISPER_COMPRESSION_RATIO_THRESHOLD = 2.4
+WHISPER_LOGPROB_THRESHOLD = -1.0
+WHISPER_NO_SPEECH_THRESHOLD = 0.6
+
+
+class STTEngine():
+    '''Wraps the speech to text model selected in config.STT_MODEL_TYPE.
+    "whisper" keeps the local whisper weights in memory, "whisper-api" keeps one OpenAI-compatible client
+    and "silero" keeps the torch.hub model. transcribe() accepts speech_recognition AudioData or a float32
+    numpy array sampled at 16 kHz.'''
+
+    def __init__(self, model_type=config.STT_MODEL_TYPE, model_name=config.STT_MODEL, language_short=config.LANGUAGE_SHORT):
+        self.model_type = model_type
+        self.model_name = model_name
+        self.language_short = language_short
+        self.model = None
+        self.load_lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.model is not None
+
+    def load(self):
+        '''Loads the model for the configured STT engine. Does nothing if it is already loaded.'''
+        # the model may be loaded in the background while it's already requested for a turn
+        with self.load_lock:
+            if self.loaded:
+                return self
+
+            if self.model_type == "whisper":
+                import whisper
+                import torch
+                self.model = whisper.load_model(self.model_name)
+                self.fp16 = torch.cuda.is_available()
+
+            elif self.model_type == "whisper-api":
+                import openai
+                self.model = openai.OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_API_BASE)
+
+            elif self.model_type == "silero":
+                import torch
+                self.torch = torch
+                self.model, self.decoder, _ = torch.hub.load(repo_or_dir='snakers4/silero-models',
+                                                             model='silero_stt', language=self.language_short,
+                                                             device="cpu", trust_repo=True)
+
+            else:
+                raise Exception("Invalid STT model, check STT_MODEL_TYPE in the config file.")
+
+        return self
+
+    def warm_up(self, seconds=1, batch_size=1):
+        '''Transcribes a short stretch of silence so the first real utterance doesn't pay for lazy initialization.
+        With a batch_size of 2 or more, that many stretches go through transcribe_batch, which also checks at startup
+        that the batched decode works with the installed model library.
+        The API model is skipped since warming it up would only cost a request.'''
+        self.load()
+        if self.model_type != "whisper-api":
+            silence = np.zeros(int(STT_SAMPLE_RATE * seconds), dtype=np.float32)
+            if batch_size > 1:
+                self.transcribe_batch([silence] * batch_size)
+            else:
+                self.transcribe(silence)
+        return self
+
+    def transcribe(self, audio):
+        '''Transcribes AudioData or a 16 kHz float32 array and returns the text.'''
+        self.load()
+
+        if self.model_type == "whisper-api":
+            wav_data = audio.get_wav_data(convert_rate=STT_SAMPLE_RATE) if not isinstance(audio, np.ndarray) else array_to_wav(audio)
+            return self.model.audio.transcriptions.create(model=self.model_name, file=("audio.wav", wav_data),
+                                                          response_format="text")
+
+        samples = audio if isinstance(audio, np.ndarray) else audio_to_array(audio)
+
+        if self.model_type == "whisper":
+            return self.model.transcribe(samples, language=self.language_short, fp16=self.fp16)["text"]
+
+        elif self.model_type == "silero":
+            return self.decoder(self.model(self.torch.from_numpy(samples).view(1, -1))[0])
+
+    def transcribe_batch(self, audios):
+        '''Transcribes a list of AudioData or 16 kHz float32 arrays and returns the texts in the same order.
+        The local models run one forward pass for the whole batch, the API model gets one request per utterance.'''
+        self.load()
+        if self.model_type == "whisper-api" or len(audios) == 1:
+            return [self.transcribe(audio) for audio in audios]
+
+        batch = [audio if isinstance(audio, np.ndarray) else audio_to_array(audio) for audio in audios]
+
+        if self.model_type == "whisper":
+            return self._transcribe_whisper_batch(batch)
+
+        elif self.model_type == "silero":
+            # pad with silence to the longest utterance
+            padded = np.zeros((len(batch), max(len(samples) for samples in batch)), dtype=np.float32)
+            for index, samples in enumerate(batch):
+                padded[index, :len(samples)] = samples
+            return [self.decoder(output) for output in self.model(self.torch.from_numpy(padded))]
+
+    def _transcribe_whisper_batch(self, batch):
+        '''Decodes utterances of up to WHISPER_WINDOW_SECONDS together, padded to the window length the encoder takes.
+        Longer utterances and decodes that whisper.transcribe would retry at a higher temperature are transcribed
+        one by one instead.'''
+        import whisper
+        import torch
+
+        texts = [None] * len(batch)
+        window_samples = WHISPER_WINDOW_SECONDS * STT_SAMPLE_RATE
+        indices = [index for index, samples in enumerate(batch) if len(samples) <= window_samples]
+
+        if indices:
+            mel = torch.stack([whisper.log_mel_spectrogram(whisper.pad_or_trim(batch[index]))
+                               for index in indices]).to(self.model.device)
+            options = whisper.DecodingOptions(language=self.language_short, without_timestamps=True, fp16=self.fp16)
+            for index, result in zip(indices, whisper.decode(self.model, mel, options)):
+                if result.no_speech_prob > WHISPER_NO_SPEECH_THRESHOLD and result.avg_logprob < WHISPER_LOGPROB_THRESHOLD:
+                    texts[index] = ""
+                elif result.compression_ratio <= WHISPER_COMPRESSION_RATIO_THRESHOLD and result.avg_logprob >= WHISPER_LOGPROB_THRESHOLD:
+                    texts[index] = result.text
+
+        return [text if text is not None else self.transcribe(samples) for text, samples in zip(texts, batch)]
+
+
+def audio_to_array(audio):
+    '''Converts speech_recognition AudioData to a 16 kHz mono float32 numpy array in the range [-1, 1].'''
+    raw_data = audio.get_raw_data(convert_rate=STT_SAMPLE_RATE, convert_width=2)
+    return np.frombuffer(raw_data, dtype=np.int16).astype(np.float32) / 32768
+
+
+def array_to_wav(samples):
+    '''Converts a 16 kHz float32 numpy array to WAV file bytes.'''
+    import wave
+    wav_fp = BytesIO()
+    with wave.open(wav_fp, "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(STT_SAMPLE_RATE)
+        wav_file.writeframes((np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16).tobytes())
+    return wav_fp.getvalue()
+
+
+class HotwordSpotter():
+    '''Cheap first stage for the passive mode, so the full STT model only runs when it's needed.
+    is_speech() is an energy gate over 30 ms frames, spot() decodes only a few tokens with a small whisper model
+    and checks them for the hotword.'''
+
+    def __init__(self, hotword=config.HOTWORD, model_name=config.HOTWORD_MODEL, min_rms=config.VAD_MIN_RMS,
+                 min_speech_seconds=config.VAD_MIN_SPEECH_SECONDS, max_tokens=config.HOTWORD_MAX_TOKENS):
+        self.hotword = hotword.lower()
+        self.model_name = model_name
+        self.min_rms = min_rms
+        self.min_speech_seconds = min_speech_seconds
+        self.max_tokens = max_tokens
+        self.frame_length = int(STT_SAMPLE_RATE * 0.03)
+        # None until load() tried to load the small whisper model
+        self.available = None
+        self.model = None
+
+    def is_speech(self, samples):
+        '''Returns True if the clip contains at least min_speech_seconds of frames louder than min_rms.'''
+        voiced_seconds = np.count_nonzero(frame_rms(samples, self.frame_length) > self.min_rms) * self.frame_length / STT_SAMPLE_RATE
+        return voiced_seconds >= self.min_speech_seconds
+
+    def load(self):
+        '''Loads the small whisper model on first use. Returns False if it can't be used, e.g. because whisper isn't
+        installed with STT_MODEL_TYPE "whisper-api" or "silero".'''
+        if self.available is None:
+            try:
+                self.model = get_stt_engine(self.model_name, model_type="whisper").model
+                self.available = True
+            except Exception:
+                traceback.print_exc()
+                print("(The hotword spotter needs a local whisper model, every utterance is transcribed instead)")
+                self.available = False
+        return self.available
+
+    def spot(self, samples):
+        '''Returns True if a short decode of the clip with the small whisper model contains the hotword.'''
+        import whisper
+        self.load()
+        mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(samples)).to(self.model.device)
+        options = whisper.DecodingOptions(language=config.LANGUAGE_SHORT, without_timestamps=True,
+                                          sample_len=self.max_tokens, fp16=False)
+        return self.hotword in whisper.decode(self.model, mel, options).text.lower()
+
+
+def frame_rms(samples, frame_length):
+    '''Returns the RMS of consecutive frames of frame_length samples, an incomplete last frame is dropped.'''
+    frame_count = len(samples) // frame_length
+    frames = samples[:frame_count * frame_length].reshape(frame_count, frame_length)
+    return np.sqrt(np.mean(np.square(frames), axis=1))
+
+
+def segment_speech(samples, min_rms=config.VAD_MIN_RMS, min_speech_seconds=config.VAD_MIN_SPEECH_SECONDS,
+                   min_silence_seconds=config.INGEST_MIN_SILENCE_SECONDS, max_segment_seconds=WHISPER_WINDOW_SECONDS,
+                   padding_seconds=0.2, frame_seconds=0.03):
+    '''Splits a long 16 kHz recording into utterances with the energy gate of the hotword spotter.
+    An utterance ends after min_silence_seconds of quiet frames or once it's max_segment_seconds long, utterances
+    with less than min_speech_seconds of speech are dropped. Returns (start, end) sample indices, padded by
+    padding_seconds on both sides.'''
+    frame_length = int(STT_SAMPLE_RATE * frame_seconds)
+    voiced = frame_rms(samples, frame_length) > min_rms
+    min_silence_frames = max(1, int(min_silence_seconds / frame_seconds))
+    max_segment_frames = int((max_segment_seconds - 2 * padding_seconds) / frame_seconds)
+    min_speech_frames = int(min_speech_seconds / frame_seconds)
+    padding = int(padding_seconds * STT_SAMPLE_RATE)
+
+    segments = []
+    start = None
+    for frame in np.flatnonzero(voiced):
+        # voiced frames close to the previous one extend the current utterance
+        if start is not None and frame - last_voiced <= min_silence_frames and frame - start < max_segment_frames:
+            last_voiced = frame
+            voiced_count += 1
+            continue
+        if start is not None and voiced_count >= min_speech_frames:
+            segments.append((start, last_voiced + 1))
+        start = last_voiced = frame
+        voiced_count = 1
+    if start is not None and voiced_count >= min_speech_frames:
+        segments.append((start, last_voiced + 1))
+
+    # the padding of an utterance that was cut at max_segment_seconds must not overlap the next one
+    padded = []
+    for start, end in segments:
+        start = max(start * frame_length - padding, padded[-1][1] if padded else 0)
+        padded.append((start, min(len(samples), end * frame_length + padding)))
+    return padded
+
+
+hotword_spotter = None
+
+
+def get_hotword_spotter():
+    '''Returns the shared hotword spotter.'''
+    global hotword_spotter
+    if hotword_spotter is None:
+        hotword_spotter = HotwordSpotter()
+    return hotword_spotter
+
+
+def transcribe_passive(audio, stt_model=config.STT_MODEL, log_chatter=config.LOG_CHATTER):
+    '''Transcribes background chatter in passive mode. Clips without speech are skipped, and unless the chatter
+    is logged, the configured STT model only runs if the hotword spotter picked up the hotword. Without a usable
+    spotter model, every clip with speech is transcribed.
+    Returns an empty string for skipped clips and if the transcription failed, so the passive mode keeps listening.'''
+    samples = audio if isinstance(audio, np.ndarray) else audio_to_array(audio)
+    spotter = get_hotword_spotter()
+
+    if not spotter.is_speech(samples):
+        return ""
+
+    if not log_chatter and spotter.load():
+        try:
+            if not spotter.spot(samples):
+                return ""
+        except Exception:
+            traceback.print_exc()
+            print("(Hotword spotting failed, transcribing the utterance)")
+
+    try:
+        return transcribe_utterance(samples, stt_model)
+    except Exception:
+        traceback.print_exc()
+        print("(Background chatter could not be transcribed)")
+        return ""
+
+
+stt_engines = {}
+stt_engines_lock = threading.Lock()
+
+
+def get_stt_engine(model_name=config.STT_MODEL, model_type=config.STT_MODEL_TYPE):
+    '''Returns the shared STT engine for a model, creating and loading it on first use.'''
+    with stt_engines_lock:
+        if (model_type, model_name) not in stt_engines:
+            stt_engines[(model_type, model_name)] = STTEngine(model_type=model_type, model_name=model_name)
+        engine = stt_engines[(model_type, model_name)]
+    return engine.load()
+
+
+stt_batchers = {}
+stt_batchers_lock = threading.Lock()
+
+
+def get_stt_batcher(model_name=config.STT_MODEL, model_type=config.STT_MODEL_TYPE):
+    '''Returns the shared MicroBatcher of a model. It collects the utterances of concurrent callers for up to
+    config.STT_BATCH_WINDOW seconds and transcribes them together.'''
+    with stt_batchers_lock:
+        if (model_type, model_name) not in stt_batchers:
+            stt_batchers[(model_type, model_name)] = MicroBatcher(
+                f"stt batcher {model_name}", lambda audios: get_stt_engine(model_name, model_type).transcribe_batch(audios),
+                config.STT_BATCH_SIZE, config.STT_BATCH_WINDOW)
+        return stt_batchers[(model_type, model_name)]
+
+
+def transcribe_utterance(audio, model_name=config.STT_MODEL):
+    '''Transcribes an utterance with the shared engine, batched with concurrent utterances if config.STT_BATCHING is set.'''
+    if config.STT_BATCHING:
+        return get_stt_batcher(model_name).submit(audio).result()
+    return get_stt_engine(model_name).transcribe(audio)
+
+
+def initialize_stt(warm_up=config.STT_WARM_UP, batched=config.STT_BATCHING):
+    '''Loads the shared STT engine at startup and optionally runs a warm-up pass, a batched one if utterances are
+    transcribed in batches.'''
+    try:
+        engine = get_stt_engine()
+        if warm_up:
+            engine.warm_up(batch_size=2 if batched else 1)
+        return engine
+    except:
+        traceback.print_exc()
+        print("(STT model could not be loaded)")
@@ -0,0 +1,152 @@
+'''Handles the per-stage timing of conversation steps and its export.
+
+Run as a script to export the timings stored in the database, e.g. for a Prometheus textfile collector:
+python timing.py --format prometheus --since "2026-10-01 00:00:00" > lachsbuddy.prom'''
+
+import argparse
+import contextlib
+import json
+import socket
+import sqlite3
+import threading
+import time
+import config
+
+# stages that count something instead of measuring seconds
+COUNT_STAGES = ("parse_attempts",)
+
+PROMETHEUS_QUANTILES = (0.5, 0.95, 0.99)
+
+
+class StepTimer():
+    '''Collects the durations of the stages of one conversation step, e.g. capture, stt, history, prompt,
+    llm_first_token, llm_total, parse, tts and playback. Durations of a stage that runs several times in a step
+    are added up. Stages may run on different threads (e.g. synthesis and playback of the SpeechStream).'''
+
+    enabled = True
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, value):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def set(self, name, value):
+        with self.lock:
+            self.values[name] = value
+
+    def items(self):
+        with self.lock:
+            return list(self.values.items())
+
+
+class NullTimer():
+    '''Stand-in for StepTimer if timing is disabled, every call is a no-op.'''
+
+    enabled = False
+    null_stage = contextlib.nullcontext()
+
+    def stage(self, name):
+        return self.null_stage
+
+    def add(self, name, value):
+        pass
+
+    def set(self, name, value):
+        pass
+
+    def items(self):
+        return []
+
+
+NULL_TIMER = NullTimer()
+
+
+def new_step_timer(enabled=None):
+    '''Returns a StepTimer for a new step if config.TIMING_ENABLED is set, otherwise the shared NullTimer.'''
+    if enabled is None:
+        enabled = config.TIMING_ENABLED
+    return StepTimer() if enabled else NULL_TIMER
+
+
+def node_name():
+    return config.TIMING_NODE_NAME or socket.gethostname()
+
+
+def load_timings(connection, since=None):
+    '''Returns the stored timings as (conversation_id, step, timestamp, {stage: value}) tuples, ordered by step.
+    since: only steps from this timestamp on ('%Y-%m-%d %H:%M:%S') are returned.'''
+    rows = connection.execute(
+        "SELECT t.conversation_id, t.step, h.timestamp, t.stage, t.value FROM step_timing t"
+        " LEFT JOIN conversation_history h ON h.conversation_id = t.conversation_id AND h.step = t.step"
+        " WHERE ? IS NULL OR h.timestamp >= ? ORDER BY t.conversation_id, t.step", (since, since))
+
+    steps = []
+    for conversation_id, step, timestamp, stage, value in rows:
+        if not steps or steps[-1][:2] != (conversation_id, step):
+            steps.append((conversation_id, step, timestamp, {}))
+        steps[-1][3][stage] = value
+    return steps
+
+
+def to_jsonl(steps, node=None):
+    '''Formats timings from load_timings as JSON lines, one object per step.'''
+    node = node or node_name()
+    return "".join(json.dumps({"node": node, "conversation_id": conversation_id, "step": step,
+                               "timestamp": timestamp, "stages": stages}) + "\n"
+                   for conversation_id, step, timestamp, stages in steps)
+
+
+def quantile(sorted_values, q):
+    position = q * (len(sorted_values) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def to_prometheus(steps, node=None):
+    '''Formats timings from load_timings in the Prometheus text format, as one summary per stage
+    (lachsbuddy_stage_seconds and lachsbuddy_parse_attempts), labelled with the node name.'''
+    node = node or node_name()
+    values = {}
+    for _, _, _, stages in steps:
+        for stage, value in stages.items():
+            values.setdefault(stage, []).append(value)
+
+    lines = []
+    for metric, help_text, count_metric in [("lachsbuddy_stage_seconds", "Duration of a stage of a conversation step.", False),
+                                            ("lachsbuddy_parse_attempts", "LLM requests needed for a parsable output.", True)]:
+        stages = sorted(stage for stage in values if (stage in COUNT_STAGES) == count_metric)
+        if not stages:
+            continue
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} summary"]
+        for stage in stages:
+            stage_values = sorted(values[stage])
+            labels = f'node="{node}"' + ("" if count_metric else f',stage="{stage}"')
+            lines += [f'{metric}{{{labels},quantile="{q}"}} {quantile(stage_values, q):.6g}' for q in PROMETHEUS_QUANTILES]
+            lines.append(f"{metric}_sum{{{labels}}} {sum(stage_values):.6g}")
+            lines.append(f"{metric}_count{{{labels}}} {len(stage_values)}")
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports the per-stage timings of conversation steps.")
+    parser.add_argument("--format", choices=["prometheus", "jsonl"], default="prometheus")
+    parser.add_argument("--since", help="only export steps from this timestamp on, e.g. '2026-10-01 00:00:00'")
+    parser.add_argument("--database", default=".//data//conversation_history.db")
+    parser.add_argument("--node", help="node label, defaults to config.TIMING_NODE_NAME or the host name")
+    args = parser.parse_args()
+
+    connection = sqlite3.connect(f"file:{args.database}?mode=ro", uri=True)
+    steps = load_timings(connection, args.since)
+    print((to_prometheus if args.format == "prometheus" else to_jsonl)(steps, args.node), end="")
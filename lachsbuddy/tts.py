@@ -0,0 +1,264 @@
+'''Handles text to speech synthesis. The TTS model is loaded once and kept in memory between turns.'''
+
+from io import BytesIO
+import numpy as np
+import config
+import traceback
+import threading
+import queue
+import re
+from timing import NULL_TIMER
+from pipeline import MicroBatcher
+
+# end of a sentence: terminal punctuation followed by whitespace (and a new sentence, see starts_sentence)
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?;])\s+')
+
+# characters that may come before the first letter of a sentence
+OPENING_CHARACTERS = '"\'([„“‘'
+
+
+def starts_sentence(text, index):
+    '''Whether a new sentence starts at text[index], i.e. with an uppercase letter or a digit, possibly after an
+    opening quote or bracket. This keeps abbreviations like "e.g. cold" together. Returns None if the text ends before
+    that can be decided.'''
+    while index < len(text) and text[index] in OPENING_CHARACTERS:
+        index += 1
+    if index >= len(text):
+        return None
+    return text[index].isupper() or text[index].isdigit()
+
+
+class TTSEngine():
+    '''Wraps the text to speech model selected in config.TTS_MODEL.
+    The model is loaded at most once on the first call to load() and reused for every following phrase.
+    synthesize() always returns a mono 16 bit pydub AudioSegment, regardless of the underlying model.'''
+
+    def __init__(self, model_type=config.TTS_MODEL, language_short=config.LANGUAGE_SHORT, playback_speed=config.TTS_PLAYBACK_SPEED):
+        self.model_type = model_type
+        self.language_short = language_short
+        self.playback_speed = playback_speed
+        self.model = None
+        self.load_lock = threading.Lock()
+        self.sample_rate = None
+
+        # silero specific settings
+        self.silero_language = 'en'
+        self.silero_model_id = 'v3_en'
+        self.silero_speaker = 'en_117'
+
+    @property
+    def loaded(self):
+        return self.model is not None
+
+    def load(self):
+        '''Loads the model for the configured TTS engine. Does nothing if it is already loaded.'''
+        # the model may be loaded in the background while it's already requested for a turn
+        with self.load_lock:
+            if self.loaded:
+                return self
+
+            if self.model_type == "silero":
+                import torch
+                self.model, _ = torch.hub.load(repo_or_dir='snakers4/silero-models',
+                                               model='silero_tts',
+                                               language=self.silero_language,
+                                               speaker=self.silero_model_id,
+                                               device=torch.device('cpu'))
+                self.sample_rate = 24000
+
+            elif self.model_type == "bark":
+                from bark import generate_audio, preload_models, SAMPLE_RATE
+                preload_models()
+                self.model = generate_audio
+                self.sample_rate = SAMPLE_RATE
+
+            elif self.model_type == "gtts":
+                # gtts is an API, the "model" is just the request class
+                from gtts import gTTS
+                self.model = gTTS
+                self.sample_rate = 24000
+
+            else:
+                raise Exception("Invalid TTS model, check TTS_MODEL in the config file.")
+
+        return self
+
+    def warm_up(self, phrase="Hello there."):
+        '''Synthesizes a short dummy phrase so that the first real response doesn't pay for lazy initialization.'''
+        self.load()
+        self.synthesize(phrase)
+        return self
+
+    def synthesize(self, phrase):
+        '''Converts a phrase to speech and returns it as a mono 16 bit AudioSegment.'''
+        self.load()
+
+        if self.model_type == "silero":
+            silero_audio = self.model.apply_tts(text=phrase, sample_rate=self.sample_rate, speaker=self.silero_speaker)
+            return float_to_segment(silero_audio.numpy(), self.sample_rate)
+
+        elif self.model_type == "bark":
+            bark_audio = self.model(phrase, history_prompt=f"v2/{self.language_short}_speaker_0")
+            return float_to_segment(bark_audio, self.sample_rate).speedup(playback_speed=self.playback_speed)
+
+        elif self.model_type == "gtts":
+            from pydub import AudioSegment
+            mp3_fp = BytesIO()
+            self.model(text=phrase, lang=self.language_short).write_to_fp(mp3_fp)
+            mp3_fp.seek(0)
+            gtts_audio = AudioSegment.from_file(mp3_fp, format="mp3")
+            mp3_fp.close()
+            gtts_audio = gtts_audio.set_channels(1).set_sample_width(2).set_frame_rate(self.sample_rate)
+            return gtts_audio.speedup(playback_speed=self.playback_speed)
+
+    def synthesize_batch(self, phrases):
+        '''Converts a list of phrases to speech and returns the AudioSegments in the same order.
+        None of the models takes a batch, so the phrases are synthesized one after another.'''
+        return [self.synthesize(phrase) for phrase in phrases]
+
+
+def float_to_segment(samples, sample_rate):
+    '''Converts a float waveform in the range [-1, 1] to a mono 16 bit AudioSegment.'''
+    from pydub import AudioSegment
+    samples = (np.clip(samples, -1.0, 1.0) * np.iinfo(np.int16).max).astype(np.int16)
+    return AudioSegment(data=samples.tobytes(), sample_width=2, frame_rate=sample_rate, channels=1)
+
+
+def segment_to_array(segment):
+    '''Returns the samples of a 16 bit AudioSegment as an int16 numpy array.'''
+    return np.frombuffer(segment.raw_data, dtype=np.int16)
+
+
+class SpeechStream():
+    '''Streaming TTS pipeline. Text is fed in (all at once or piece by piece), split into sentences,
+    and sentence N+1 is synthesized on a worker thread while sentence N is being played.
+    All sentences are written to a single output sink, an object with write(AudioSegment) and close() methods.
+    Call finish() once all text has been fed and wait() to block until playback is done.
+    Synthesis and playback durations are added to the "tts" and "playback" stages of timer.
+    on_done is called once playback is done, it may be set until finish() is called.'''
+
+    def __init__(self, sink, engine=None, min_chars=config.TTS_STREAM_MIN_CHARS, buffer_size=config.TTS_STREAM_BUFFER,
+                 timer=NULL_TIMER, on_done=None):
+        self.sink = sink
+        self.timer = timer
+        self.on_done = on_done
+        self.engine = engine if engine is not None else get_tts_engine()
+        self.min_chars = min_chars
+        self.fed_text = ""
+        self.pending_text = ""
+        self.sentences = queue.Queue()
+        self.segments = queue.Queue(maxsize=buffer_size)
+        self.done = threading.Event()
+
+        self.synth_thread = threading.Thread(target=self._synthesize_loop, daemon=True)
+        self.play_thread = threading.Thread(target=self._play_loop, daemon=True)
+        self.synth_thread.start()
+        self.play_thread.start()
+
+    def feed(self, text):
+        '''Adds text to the stream. Complete sentences are handed to the synthesis worker right away, sentences
+        shorter than min_chars are kept together with the following ones (with the whitespace between them).
+        A sentence only ends where the next one starts (see starts_sentence), so the end of the last fed piece
+        waits for the next one. Abbreviations followed by an uppercase word (e.g. "Mr. Smith") are still split.'''
+        self.fed_text += text
+        self.pending_text += text
+
+        # start of the text that hasn't been handed to the synthesis worker yet
+        start = 0
+        for boundary in SENTENCE_BOUNDARY.finditer(self.pending_text):
+            new_sentence = starts_sentence(self.pending_text, boundary.end())
+            if new_sentence is None:
+                break
+            if new_sentence and len(self.pending_text[start:boundary.start()].strip()) >= self.min_chars:
+                self.sentences.put(self.pending_text[start:boundary.start()].strip())
+                start = boundary.end()
+
+        # the rest may still be an incomplete sentence
+        self.pending_text = self.pending_text[start:]
+
+    def finish(self):
+        '''Flushes the remaining text. No more text may be fed afterwards.'''
+        if self.pending_text.strip():
+            self.sentences.put(self.pending_text.strip())
+        self.pending_text = ""
+        self.sentences.put(None)
+
+    def wait(self, timeout=None):
+        '''Blocks until the last sentence has been played.'''
+        return self.done.wait(timeout)
+
+    def _synthesize_loop(self):
+        while True:
+            sentence = self.sentences.get()
+            if sentence is None:
+                self.segments.put(None)
+                return
+            try:
+                with self.timer.stage("tts"):
+                    segment = self.engine.synthesize(sentence)
+                self.segments.put(segment)
+            except:
+                traceback.print_exc()
+                print("(Audio generation failed for: " + sentence + ")")
+
+    def _play_loop(self):
+        while True:
+            segment = self.segments.get()
+            if segment is None:
+                break
+            try:
+                with self.timer.stage("playback"):
+                    self.sink.write(segment)
+            except:
+                traceback.print_exc()
+                print("(Audio playback failed)")
+
+        try:
+            with self.timer.stage("playback"):
+                self.sink.close()
+        finally:
+            self.done.set()
+            if self.on_done is not None:
+                self.on_done()
+
+
+tts_engine = TTSEngine()
+
+
+def get_tts_engine():
+    '''Returns the shared TTS engine, loading it on first use.'''
+    return tts_engine.load()
+
+
+tts_batcher = None
+tts_batcher_lock = threading.Lock()
+
+
+def get_tts_batcher():
+    '''Returns the shared MicroBatcher that synthesizes phrases of concurrent callers together with the TTS engine.'''
+    global tts_batcher
+    with tts_batcher_lock:
+        if tts_batcher is None:
+            tts_batcher = MicroBatcher("tts batcher", lambda phrases: get_tts_engine().synthesize_batch(phrases),
+                                       config.TTS_BATCH_SIZE, config.TTS_BATCH_WINDOW)
+    return tts_batcher
+
+
+class BatchedTTSEngine():
+    '''Engine for SpeechStream that hands every phrase to the shared TTS batcher, so several streams can share
+    one TTS engine.'''
+
+    def synthesize(self, phrase):
+        return get_tts_batcher().submit(phrase).result()
+
+
+def initialize_tts(warm_up=config.TTS_WARM_UP):
+    '''Loads the shared TTS engine at startup and optionally runs a dummy phrase through it.'''
+    try:
+        engine = get_tts_engine()
+        if warm_up:
+            engine.warm_up()
+        return engine
+    except:
+        traceback.print_exc()
+        print("(TTS model could not be loaded)")